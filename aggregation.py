@@ -0,0 +1,514 @@
+"""
+Shared VAT aggregation engine for all report endpoints.
+
+Every report (/vat-report-quarterly, /vat-report-monthly, /vat-report-yearly
+and /dreport) is a projection of one VatAggregate: a single pass over the
+invoices splits each invoice into VAT lines (proportional VAT split, credit
+notes, fallback from vat_percentage) and accumulates totals for the whole
+year, each quarter and each month at the same time.
+
+Line amounts are rounded to cents once per VAT line; all totals are kept as
+integer cents (exact sums) and converted back to euros only in the reports.
+"""
+
+from processor import normalize_amount, amount_to_cents, round_to_cents, cents_to_amount
+
+# Categories shown in the quarterly / monthly / yearly reports (in report order)
+VAT_CATEGORY_NAMES = {
+    "1a": "Sales Taxed at Standard Rate (21%)",
+    "1b": "Sales Taxed at Reduced Rate (9%)",
+    "1c": "Sales Taxed at Other Rates (0%)",
+    "1d": "Private Use of Business Assets",
+    "1e": "Sales Exempt from VAT",
+    "2a": "Reverse-Charge Supplies",
+    "3a": "Supplies of Goods to EU Countries",
+    "3b": "Supplies of Services to EU Countries",
+    "3c": "Installation/Distance Sales to Private Individuals (EU)",
+    "4a": "Purchases of Goods From EU Countries",
+    "4b": "Purchases of Services From EU Countries",
+    "4c": "Purchases of Goods from Non-EU Countries (Imports)",
+    "5a": "Domestic purchases with Dutch VAT",
+    "5b": "Input VAT on Domestic Purchases"
+}
+
+# Category codes of the Dutch tax authority format (/dreport). Lines with any
+# other code (including 4c) are remapped, see get_dreport_code().
+DREPORT_CATEGORY_CODES = ["1a", "1b", "1c", "1d", "1e", "2a", "3a", "3b", "3c", "4a", "4b", "5a", "5b"]
+
+# EU country codes for the /dreport fallback mapping (includes NL)
+DREPORT_EU_COUNTRIES = ["DE", "FR", "BE", "IT", "ES", "PL", "RO", "NL", "GR", "PT", "CZ", "HU",
+                        "SE", "AT", "BG", "DK", "FI", "IE", "HR", "LT", "LV", "SK", "SI", "EE",
+                        "CY", "LU", "MT"]
+
+
+def get_dreport_code(vat_category, transaction_type, vat_percentage, vat_amount, country):
+    """
+    Category code a line is reported under in /dreport.
+
+    The provided VAT Category (NL) Code is used directly; only empty or unknown
+    codes are remapped from transaction type, VAT percentage and country
+    (fallback for backward compatibility).
+    """
+    if vat_category and vat_category in DREPORT_CATEGORY_CODES:
+        return vat_category
+
+    invoice_country = str(country or "").upper()
+
+    if transaction_type == "sale":
+        # Default mapping for sales based on VAT percentage
+        if vat_percentage == 21:
+            return "1a"
+        elif vat_percentage == 9:
+            return "1b"
+        elif vat_percentage == 0:
+            # Check country for 0% sales
+            if invoice_country in DREPORT_EU_COUNTRIES and invoice_country != "NL":
+                return "3b"
+            elif invoice_country and invoice_country not in DREPORT_EU_COUNTRIES:
+                return "3a"
+            else:
+                return "1e"
+        else:
+            return "1c"  # Other rates (not 0%, 9%, or 21%)
+    else:
+        # Purchase - default mapping
+        category_lower = str(vat_category).lower()
+        if "reverse" in category_lower or "reverse-charge" in category_lower:
+            return "2a"
+        elif "eu" in category_lower or invoice_country in DREPORT_EU_COUNTRIES:
+            return "4b"
+        elif "import" in category_lower or (invoice_country and invoice_country not in DREPORT_EU_COUNTRIES):
+            return "4a"
+        else:
+            # Default to 5a for domestic purchases with VAT, 5b for backward compatibility
+            if vat_amount > 0:
+                return "5a"
+            else:
+                return "5b"
+
+
+def invoice_lines(invoice):
+    """
+    Split a stored invoice into VAT lines, one per transaction.
+
+    Each line is a dict with the reporting period (month, quarter), the raw
+    vat_category, its /dreport code, whether it is a sale, the net and VAT
+    amounts in integer cents, the transaction as shown in the reports and its
+    sort key for transaction listings (see line_sort_key).
+    """
+    month = invoice.get("period_month")
+    quarter = invoice.get("period_quarter")
+    invoice_no = invoice.get("invoice_no", "")
+    date = invoice.get("date", "")
+    transaction_type = invoice.get("transaction_type", "sale")
+    invoice_to = invoice.get("invoice_to", "")
+
+    # Get invoice-level VAT amount (handle both string and numeric)
+    invoice_vat_total = normalize_amount(invoice.get("vat_amount", 0))
+    invoice_net_total = normalize_amount(invoice.get("subtotal", invoice.get("total_amount", 0)))
+
+    # Process transactions
+    transactions_list = invoice.get("transactions", [])
+    if not transactions_list:
+        # If no transactions, create one from invoice-level data
+        # Try to get VAT percentage from invoice if available
+        invoice_vat_percentage = invoice.get("vat_percentage", "0")
+        if isinstance(invoice_vat_percentage, str):
+            invoice_vat_percentage = invoice_vat_percentage.replace("%", "").strip()
+        try:
+            invoice_vat_pct = float(invoice_vat_percentage)
+        except:
+            invoice_vat_pct = 0.0
+
+        transactions_list = [{
+            "description": invoice.get("invoice_to", "N/A"),
+            "amount_pre_vat": invoice_net_total,
+            "vat_percentage": f"{invoice_vat_pct}%",
+            "vat_category": ""  # Only reported in /dreport (remapped from type and VAT percentage)
+        }]
+
+    # Distribute VAT proportionally if multiple transactions
+    total_net = sum(normalize_amount(tx.get("amount_pre_vat", 0)) for tx in transactions_list)
+
+    # If total_net is 0 but invoice has amount (positive or negative), use invoice amount for single transaction
+    if total_net == 0 and invoice_net_total != 0 and len(transactions_list) == 1:
+        total_net = invoice_net_total
+
+    # An invoice amount split over several transactions is allocated in whole
+    # cents (the first `remainder` transactions get one cent more), so the line
+    # totals add up to the invoice amount exactly
+    share_cents, remainder = divmod(round_to_cents(invoice_net_total), len(transactions_list))
+
+    lines = []
+    for index, tx in enumerate(transactions_list):
+        vat_category = tx.get("vat_category", "")
+        tx_amount = normalize_amount(tx.get("amount_pre_vat", 0))
+        net_cents = None
+
+        # CRITICAL FIX: Handle both positive and negative amounts (credit notes)
+        # Credit notes have negative amounts and must be preserved for correct VAT calculation
+        if tx_amount != 0:  # Use != 0 to handle both positive and negative
+            amount_pre_vat = tx_amount
+        elif invoice_net_total != 0:  # Use != 0 to handle both positive and negative
+            # Use invoice amount - distribute if multiple transactions
+            if len(transactions_list) == 1:
+                amount_pre_vat = invoice_net_total
+                # Update total_net for VAT calculation (preserve sign)
+                if total_net == 0:
+                    total_net = invoice_net_total
+            else:
+                # Multiple transactions - distribute invoice total proportionally (preserve sign)
+                if total_net == 0:
+                    total_net = invoice_net_total
+                amount_pre_vat = invoice_net_total / len(transactions_list)
+                net_cents = share_cents + (1 if index < remainder else 0)
+        else:
+            amount_pre_vat = 0.0
+        if net_cents is None:
+            net_cents = round_to_cents(amount_pre_vat)
+
+        vat_percentage_str = tx.get("vat_percentage", "0")
+        vat_percentage = float(vat_percentage_str.replace("%", "")) if isinstance(vat_percentage_str, str) else float(vat_percentage_str)
+
+        # Handle VAT calculation for both positive and negative amounts (credit notes)
+        # Credit notes have negative VAT that must be subtracted
+        if invoice_vat_total != 0 and total_net != 0:
+            # Distribute VAT proportionally (preserve sign for credit notes)
+            vat_amount = round((amount_pre_vat / total_net) * invoice_vat_total, 2)
+        elif invoice_vat_total != 0 and total_net == 0 and amount_pre_vat != 0:
+            # If total_net is 0 but we have amount_pre_vat, use it directly (preserve sign)
+            vat_amount = invoice_vat_total
+        elif vat_percentage != 0:
+            # Calculate from percentage (preserve sign - negative amount * positive % = negative VAT)
+            vat_amount = round(amount_pre_vat * vat_percentage / 100, 2)
+        else:
+            vat_amount = 0.0
+
+        transaction = {
+            "date": date,
+            "invoice_no": invoice_no,
+            "description": tx.get("description", ""),
+            "net_amount": round(amount_pre_vat, 2),
+            "vat_percentage": vat_percentage,
+            "vat_amount": vat_amount,
+            "vat_category": vat_category,
+            "vat_category_description": tx.get("vat_category_description", "")
+        }
+
+        # Add vendor_name for purchases, customer_name for sales (only if not empty)
+        if transaction_type == "purchase" and invoice_to:
+            transaction["vendor_name"] = invoice_to
+        elif transaction_type == "sale" and invoice_to:
+            transaction["customer_name"] = invoice_to
+
+        lines.append({
+            "month": month,
+            "quarter": quarter,
+            "category": vat_category,
+            "dreport_code": get_dreport_code(vat_category, transaction_type, vat_percentage, vat_amount, invoice.get("country", "")),
+            "is_sale": transaction_type == "sale",
+            "net": net_cents,
+            "vat": round_to_cents(vat_amount),
+            "transaction": transaction,
+            "sort_key": line_sort_key(invoice, index)
+        })
+
+    return lines
+
+
+def line_sort_key(invoice, index):
+    """
+    Position of a VAT line in transaction listings: (month, date, invoice_no, source_file,
+    line index). Orders by (date, invoice_no) and is unique, so it can serve as a cursor.
+    """
+    return (invoice.get("period_month") or 0, invoice.get("date_iso") or "",
+            str(invoice.get("invoice_no", "")), str(invoice.get("source_file", "")), index)
+
+
+class PeriodTotals:
+    """Running totals (integer cents) of one reporting period (year, quarter or month)"""
+
+    def __init__(self):
+        # {code: [net, vat, line_count]} for report categories and /dreport codes
+        self.categories = {}
+        self.dreport = {}
+        self.vat_collected = 0
+        self.vat_deductible = 0
+
+    def add(self, category, dreport_code, is_sale, net, vat, count=1):
+        totals = self.dreport.setdefault(dreport_code, [0, 0, 0])
+        totals[0] += net
+        totals[1] += vat
+        totals[2] += count
+
+        if category not in VAT_CATEGORY_NAMES:
+            return
+        totals = self.categories.setdefault(category, [0, 0, 0])
+        totals[0] += net
+        totals[1] += vat
+        totals[2] += count
+
+        if is_sale:
+            self.vat_collected += vat
+        else:
+            self.vat_deductible += vat
+
+
+def period_keys(month):
+    """Period keys a month contributes to: the year, its quarter and the month itself"""
+    return ("year", f"Q{(month - 1) // 3 + 1}", month)
+
+
+class VatAggregate:
+    """
+    Result of one pass over a set of invoices.
+
+    Totals are kept per period key: "year", "Q1".."Q4" and month numbers 1..12.
+    They are either accumulated line by line while scanning the invoices, or
+    taken from the materialized totals kept by the store (add_totals).
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.periods = {}
+
+    def period(self, key):
+        """Totals of a period (empty totals if it has no invoices)"""
+        return self.periods.get(key) or PeriodTotals()
+
+    def _period_totals(self, month):
+        return [self.periods.setdefault(key, PeriodTotals()) for key in period_keys(month)]
+
+    def add_invoice(self, invoice, accumulate=True):
+        """
+        Add one invoice; invoices with unparseable dates are not part of any period.
+        With accumulate=False only its lines (transactions) are kept.
+        """
+        month = invoice.get("period_month")
+        if not month:
+            return
+        totals = self._period_totals(month) if accumulate else []
+        for line in invoice_lines(invoice):
+            self.lines.append(line)
+            for period_totals in totals:
+                period_totals.add(line["category"], line["dreport_code"], line["is_sale"], line["net"], line["vat"])
+
+    def add_totals(self, rows):
+        """Add materialized totals rows (month, vat_category, dreport_code, is_sale, net_cents, vat_cents, line_count)"""
+        for month, category, dreport_code, is_sale, net, vat, line_count in rows:
+            for period_totals in self._period_totals(month):
+                period_totals.add(category, dreport_code, is_sale, net, vat, line_count)
+
+    def category_report(self, period_key="year", include_category_fields=True, include_transactions=True):
+        """
+        Categories dict of the quarterly / monthly / yearly reports:
+        {code: {"name", "transactions", "totals": {"net", "vat"}}}
+        Without transactions: {code: {"name", "transaction_count", "totals": {"net", "vat"}}}
+        """
+        categories = {}
+        for code, name in VAT_CATEGORY_NAMES.items():
+            categories[code] = {"name": name}
+            if include_transactions:
+                categories[code]["transactions"] = []
+            else:
+                categories[code]["transaction_count"] = 0
+            categories[code]["totals"] = {"net": 0.0, "vat": 0.0}
+
+        if include_transactions:
+            for line in self.lines:
+                if line["category"] not in categories or not _line_in_period(line, period_key):
+                    continue
+                categories[line["category"]]["transactions"].append(report_transaction(line, include_category_fields))
+
+        for code, (net, vat, line_count) in self.period(period_key).categories.items():
+            categories[code]["totals"]["net"] = cents_to_amount(net)
+            categories[code]["totals"]["vat"] = cents_to_amount(vat)
+            if not include_transactions:
+                categories[code]["transaction_count"] = line_count
+        return categories
+
+    def sorted_lines(self, category, after=None):
+        """Lines of a report category in listing order (line_sort_key), optionally only those after a sort key"""
+        lines = [
+            line for line in self.lines
+            if line["category"] == category and (after is None or line["sort_key"] > after)
+        ]
+        lines.sort(key=lambda line: line["sort_key"])
+        return lines
+
+    def vat_calculation(self, period_key="year"):
+        """VAT collected (sales), deductible (purchases) and payable of a period"""
+        totals = self.period(period_key)
+        return {
+            "vat_collected": cents_to_amount(totals.vat_collected),
+            "vat_deductible": cents_to_amount(totals.vat_deductible),
+            "vat_payable": cents_to_amount(totals.vat_collected - totals.vat_deductible)
+        }
+
+    def quarterly_breakdown(self, year):
+        """Per-quarter VAT collected / deductible / payable for the yearly report"""
+        breakdown = {}
+        for quarter, months in (("Q1", "Jan-Mar"), ("Q2", "Apr-Jun"), ("Q3", "Jul-Sep"), ("Q4", "Oct-Dec")):
+            breakdown[quarter] = {"period": f"{quarter} {year} ({months})", **self.vat_calculation(quarter)}
+        return breakdown
+
+    def dreport_totals(self, period_key="year"):
+        """{code: {"net_amount", "vat"}} in integer cents for every /dreport category code"""
+        totals = self.period(period_key).dreport
+        return {
+            code: {
+                "net_amount": totals[code][0] if code in totals else 0,
+                "vat": totals[code][1] if code in totals else 0
+            }
+            for code in DREPORT_CATEGORY_CODES
+        }
+
+
+def report_transaction(line, include_category_fields=True):
+    """Transaction of a line as listed in the reports (the yearly report leaves out the category fields)"""
+    transaction = line["transaction"]
+    if not include_category_fields:
+        transaction = {k: v for k, v in transaction.items() if k not in ("vat_category", "vat_category_description")}
+    return transaction
+
+
+def iter_category_transactions(invoices, category, include_category_fields=True):
+    """Transactions of one report category, generated invoice by invoice (same order as category_report)"""
+    for invoice in invoices:
+        if not invoice.get("period_month"):
+            continue
+        for line in invoice_lines(invoice):
+            if line["category"] == category:
+                yield report_transaction(line, include_category_fields)
+
+
+def _line_in_period(line, period_key):
+    if period_key == "year":
+        return True
+    if isinstance(period_key, int):
+        return line["month"] == period_key
+    return f"Q{line['quarter']}" == period_key
+
+
+def aggregate_invoices(invoices, totals=None):
+    """
+    Single pass over invoices -> VatAggregate with totals for the year, every quarter and every month.
+    If materialized totals rows are given, the totals come from them and the invoices only
+    provide the transaction lists.
+    """
+    aggregate = VatAggregate()
+    for invoice in invoices:
+        aggregate.add_invoice(invoice, accumulate=False)
+    if totals is None:
+        totals = [(*key, *values) for key, values in group_line_totals(aggregate.lines).items()]
+    aggregate.add_totals(totals)
+    return aggregate
+
+
+def group_line_totals(lines):
+    """
+    Totals of VAT lines per (month, vat_category, dreport_code, is_sale): [net_cents, vat_cents, line_count]
+    (vat_category is "" if it's not a report category)
+    """
+    line_totals = {}
+    for line in lines:
+        category = line["category"] if line["category"] in VAT_CATEGORY_NAMES else ""
+        totals = line_totals.setdefault((line["month"], category, line["dreport_code"], line["is_sale"]), [0, 0, 0])
+        totals[0] += line["net"]
+        totals[1] += line["vat"]
+        totals[2] += 1
+    return line_totals
+
+
+# ==================== MATERIALIZED TOTALS ====================
+
+# Lines of a batch are grouped in chunks of this size (bounds memory on a full rebuild)
+MERGE_CHUNK_LINES = 50000
+
+def invoice_totals(invoice):
+    """
+    Contribution of one invoice to the materialized totals kept by the store.
+
+    Returns (line_totals, invoice_key, invoice_vat):
+    - line_totals: {(month, vat_category, dreport_code, is_sale): [net_cents, vat_cents, line_count]}
+      (vat_category is "" if it's not a report category; empty for unparseable dates)
+    - invoice_key: (month, is_sale), month 0 for unparseable dates
+    - invoice_vat: invoice-level VAT amount in cents (used by /vat-payable)
+    """
+    lines, invoice_key, invoice_vat = invoice_contribution(invoice)
+    return group_line_totals(lines), invoice_key, invoice_vat
+
+
+def invoice_contribution(invoice):
+    """(VAT lines, (month, is_sale), invoice VAT in cents) of an invoice for the materialized totals"""
+    month = invoice.get("period_month") or 0
+    is_sale = invoice.get("transaction_type", "sale") == "sale"
+    lines = []
+    if month:
+        try:
+            lines = invoice_lines(invoice)
+        except Exception as e:
+            # Same data makes the report scan fail; don't block the upload because of it
+            print(f"⚠️ Could not compute VAT lines for invoice {invoice.get('invoice_no', '')}: {e}")
+    return lines, (month, is_sale), amount_to_cents(invoice.get("vat_amount", "0"))
+
+
+def merge_invoice_totals(invoices):
+    """
+    Materialized totals (in cents) of a batch of invoices:
+    ({(month, vat_category, dreport_code, is_sale): [net, vat, line_count]},
+     {(month, is_sale): [vat, invoice_count]})
+    """
+    line_totals = {}
+    invoice_totals_by_key = {}
+    lines = []
+    for invoice in invoices:
+        contribution, invoice_key, invoice_vat = invoice_contribution(invoice)
+        lines.extend(contribution)
+        if len(lines) >= MERGE_CHUNK_LINES:
+            add_line_totals(line_totals, group_line_totals(lines))
+            lines = []
+        totals = invoice_totals_by_key.setdefault(invoice_key, [0, 0])
+        totals[0] += invoice_vat
+        totals[1] += 1
+    add_line_totals(line_totals, group_line_totals(lines))
+    return line_totals, invoice_totals_by_key
+
+
+def add_line_totals(line_totals, other):
+    """Add grouped line totals (see group_line_totals) into line_totals"""
+    for key, values in other.items():
+        totals = line_totals.setdefault(key, [0, 0, 0])
+        for i, value in enumerate(values):
+            totals[i] += value
+
+
+def check_totals(store, user_id, year):
+    """
+    Consistency checker: compare the materialized totals of a year against a full
+    recompute from the stored invoices. Returns a list of mismatches (empty if consistent).
+    Amounts are integer cents, so counts and amounts must match exactly.
+    """
+    expected_lines, expected_invoices = merge_invoice_totals(store.get_invoices(user_id, year))
+    stored_lines = {tuple(row[:4]): list(row[4:]) for row in store.get_category_totals(user_id, year)}
+    stored_invoices = {tuple(row[:2]): list(row[2:]) for row in store.get_invoice_totals(user_id, year)}
+
+    mismatches = []
+    for table, expected, stored in (("category_totals", expected_lines, stored_lines),
+                                    ("invoice_totals", expected_invoices, stored_invoices)):
+        for key in list(expected) + [key for key in stored if key not in expected]:
+            expected_values = expected.get(key)
+            stored_values = stored.get(key)
+            if expected_values and stored_values:
+                if list(expected_values) == list(stored_values):
+                    continue
+            elif not expected_values and stored_values and not stored_values[-1]:
+                # Stored row with zero count (e.g. after removals) is consistent
+                continue
+            mismatches.append({
+                "table": table,
+                "key": list(key),
+                "stored": stored_values,
+                "expected": expected_values
+            })
+    return mismatches
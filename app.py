@@ -1,14 +1,31 @@
-from fastapi import FastAPI, HTTPException, Header, Body
+from fastapi import FastAPI, HTTPException, Header, Body, Response, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 import json
+import base64
+import asyncio
+import weakref
 from fastapi.middleware.cors import CORSMiddleware
 from processor import calculate_vat_amount, calculate_total_with_vat, validate_vat_calculation, get_vat_rate_by_category, calculate_vat_payable, get_user_company_details
-from collections import defaultdict
 from datetime import datetime
 # import boto3  # COMMENTED OUT - S3 integration disabled for now
 from processor import log_user_event
-from processor import normalize_amount
+from processor import normalize_amount, cents_to_amount
+from processor import get_period_keys
+from processor import llm_cache, llm_retry, pdf_preprocessor
+from storage import get_store, DuplicateIndex
+from aggregation import aggregate_invoices, check_totals, VatAggregate, VAT_CATEGORY_NAMES, report_transaction
+from aggregation import iter_category_transactions
+from report_cache import get_report_cache, report_etag, etag_matches
+from json_stream import JsonObjectStream, parse_json_objects
+from worker_pool import get_worker_pool, WorkerPoolFull
+from ingest_jobs import get_ingest_jobs
+from events import get_user_events, changed_periods, PROGRESS_EVERY
+from field_aliases import FieldResolver
+from vat_classifier import simple_classifier
 # import os  # COMMENTED OUT - Not needed without S3
 # from dotenv import load_dotenv  # COMMENTED OUT - Not needed without S3
 
@@ -27,32 +44,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ==================== IN-MEMORY STORAGE (Replaces S3) ====================
-# Simple in-memory storage dictionaries
-# TODO: Replace with S3 or database in production
+# ==================== STORAGE (Replaces S3) ====================
+# Invoices, company details and PDF counts live in a pluggable storage backend
+# (see storage.py). SQLite (WAL mode) is the default so data survives restarts
+# and is shared by all worker processes; set VAT_STORAGE_BACKEND=memory to keep
+# the old in-process dictionaries.
+store = get_store()
 
-# Store user VAT analysis data: {user_id: {year: {invoice_data}}}
-user_vat_data = defaultdict(dict)
+# Report responses cached per (endpoint, user, year, period, data version)
+report_cache = get_report_cache()
 
-# Store company details: {user_id: {company_name, company_vat, updated_at}}
-user_company_details = {}
+# Reports and uploads are built on a bounded thread pool, off the event loop
+worker_pool = get_worker_pool()
 
-# Store PDF count: {user_id: count}
-user_pdf_count = defaultdict(int)
+async def run_in_worker(func, *args):
+    """Run CPU-heavy work on the worker pool; 503 (with Retry-After) if its queue is full"""
+    try:
+        return await worker_pool.run(func, *args)
+    except WorkerPoolFull:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+async def shielded(awaitable):
+    """
+    await a worker pool call; if the request is cancelled meanwhile (client gone), wait
+    for the call to finish before the cancellation goes on. The thread can't be stopped,
+    and it may still be reading a snapshot or writing data that the caller is about to
+    release (the snapshot, or the user's write lock).
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        while not task.done():
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                pass
+        if not task.cancelled():
+            task.exception()  # Retrieved: the request is gone, nobody else will
+        raise
+
+# Background uploads (/process-invoices?background=true) run on their own pool
+ingest_jobs = get_ingest_jobs()
+
+# Upload progress and data changes are pushed to each user's GET /events subscribers
+user_events = get_user_events()
+
+# ==================== PER-USER WRITE LOCKS ====================
+# Uploads and other writes of one user run one at a time, so an upload's duplicate
+# checks see everything stored by earlier uploads. Worker pool calls made under a
+# lock are shielded: a cancelled request keeps the lock until its write is done.
+# Reads never take these locks: they read from store snapshots, which writes don't
+# change.
+# The locks are per process. With several worker processes SQLite still serializes
+# the writes themselves, but two uploads of one user landing on different processes
+# can both pass their duplicate checks: duplicate detection is only guaranteed
+# within one process (run one worker, or route each user to the same one).
+user_write_locks = weakref.WeakValueDictionary()
+
+def user_write_lock(user_id):
+    """asyncio.Lock serializing the writes of one user (kept while in use)"""
+    lock = user_write_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_write_locks[user_id] = lock
+    return lock
 
 # ==================== COMMENTED OUT - S3 Integration (for future use) ====================
 # # S3 Client
 # s3_client = boto3.client('s3')
 # bucket_name = os.getenv('S3_BUCKET_NAME', 'vat-analysis-new')
 
-def try_parse_date(date_str):
-    for fmt in ("%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y", "%d-%m-%y", "%d/%m/%y", "%d.%m.%y", "%d %B %Y", "%d %b %Y", "%b %d, %Y", "%B %d, %Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(date_str.strip(), fmt)
-        except:
-            continue
-    return None
-
 def get_quarter_from_month(month):
     """Convert month to quarter"""
     month_to_quarter = {
@@ -63,6 +125,16 @@ def get_quarter_from_month(month):
     }
     return month_to_quarter.get(month, 'Unknown')
 
+def get_quarter_month_numbers(quarter):
+    """Get month numbers (1-12) of a quarter, e.g. Q1 -> [1, 2, 3]"""
+    quarter_month_numbers = {
+        'Q1': [1, 2, 3],
+        'Q2': [4, 5, 6],
+        'Q3': [7, 8, 9],
+        'Q4': [10, 11, 12]
+    }
+    return quarter_month_numbers.get(quarter, [])
+
 def get_quarter_name(quarter):
     """Get full quarter name"""
     quarter_names = {
@@ -171,58 +243,277 @@ class InvoiceProcessingRequest(BaseModel):
 def parse_multiple_json_objects(text):
     """
     Parse multiple JSON objects from concatenated text
-    Handles: {...}{...}{...} format
+    Handles: {...}{...}{...} format (also NDJSON and JSON arrays of objects)
+    Malformed objects are skipped and logged with their byte offset
     """
-    objects = []
-    text = text.strip()
-    
-    if not text:
-        return objects
-    
-    # Try to find JSON object boundaries
-    depth = 0
-    start = -1
-    in_string = False
-    escape_next = False
-    
-    for i, char in enumerate(text):
-        if escape_next:
-            escape_next = False
-            continue
-        
-        if char == '\\':
-            escape_next = True
-            continue
-        
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            continue
-        
-        if not in_string:
-            if char == '{':
-                if depth == 0:
-                    start = i
-                depth += 1
-            elif char == '}':
-                depth -= 1
-                if depth == 0 and start >= 0:
-                    # Found complete JSON object
-                    json_str = text[start:i+1]
-                    try:
-                        obj = json.loads(json_str)
-                        objects.append(obj)
-                    except json.JSONDecodeError:
-                        pass
-                    start = -1
-    
+    objects, malformed = parse_json_objects(text)
+    for error in malformed:
+        print(f"⚠️ Skipping malformed JSON object at byte {error['offset']}: {error['error']}")
     return objects
 
+# ==================== INVOICE INGEST ====================
+
+class InvoiceBatch:
+    """
+    Converts analyzed invoice items to stored invoices for one user.
+
+    Invoices are queued by add() and written by flush() in a single transaction;
+    until then duplicates within the batch are detected with a separate index.
+    Items without a VAT code are classified at flush(), all at once: uploads repeat
+    a few category/type/rate/country combinations, each is classified once.
+    Progress and the changed years/months are published to the user's events.
+    """
+
+    def __init__(self, user_id, source="process-invoices", job_id=None):
+        self.user_id = user_id
+        self.source = source
+        self.job_id = job_id
+        self.processed_count = 0
+        self.skipped_count = 0
+        self.error_count = 0
+        self.updated_years = set()
+        self.new_invoices = []  # (year, invoice) pairs
+        self.unclassified = []  # (transaction, classifier input) of queued invoices without a VAT code
+        self.batch_index = DuplicateIndex()
+        # Field name variations, compiled once per key layout of this batch's items
+        self.field_resolver = FieldResolver()
+
+    def add(self, invoice_item):
+        """Convert one invoice item and queue it (duplicates are skipped, errors counted)"""
+        try:
+            # Fields with a value (None, "" and NaN from Excel/CSV exports count as missing)
+            fields = self.field_resolver.resolve(invoice_item)
+            
+            # Extract basic info - handle multiple field name formats
+            date_str = fields.get("date", "")
+            invoice_type = str(fields.get("type", "")).lower()
+            file_name = fields.get("file_name", "")
+            
+            # Extract year from date
+            year = "unknown"
+            if date_str:
+                try:
+                    # Try common date formats
+                    for fmt in ["%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%Y/%m/%d", "%m-%d-%Y", "%m/%d/%Y"]:
+                        try:
+                            dt = datetime.strptime(str(date_str).strip(), fmt)
+                            year = str(dt.year)
+                            break
+                        except ValueError:
+                            continue
+                except Exception:
+                    pass
+            
+            # Extract invoice number for duplicate checking
+            # Try to get actual invoice number from input, fallback to file_name if not provided
+            input_invoice_number = fields.get("invoice_number")
+            file_name_base = file_name.replace(".pdf", "")
+            
+            # Check if already exists in this year (by file_name/source_file OR invoice_number)
+            # Index lookups: stored invoices plus the ones queued earlier in this batch
+            duplicate_keys = {
+                # Check by file name (always check this)
+                "source_file": file_name,
+                "file_name": file_name,
+                # Check by invoice number (if provided and different from file_name)
+                # This catches cases where same invoice is uploaded with different file names
+                "invoice_no": input_invoice_number if (input_invoice_number and input_invoice_number != file_name_base) else None
+            }
+            is_duplicate = (
+                self.batch_index.has_invoice(year, **duplicate_keys) or
+                store.has_invoice(self.user_id, year, **duplicate_keys)
+            )
+            
+            if is_duplicate:
+                self.skipped_count += 1
+                return
+            
+            # Map transaction type
+            transaction_type = "sale" if invoice_type in ["sales", "sale"] else "purchase"
+            
+            # Get VAT category code and description - NEW APPROACH: Use provided NL codes directly
+            vat_category_code = fields.get("vat_category_code", "")
+            vat_category_description = fields.get("vat_category_description", "")
+            
+            # Fallback: If NL code not provided, try to map from old format (backward compatibility)
+            # (classified with the rest of the batch in flush(), see classify_queued)
+            classifier_input = None
+            if not vat_category_code:
+                vat_category_str = fields.get("vat_category", "")
+                vat_percentage_raw = fields.get("vat_percentage", "0")
+                # Clean VAT percentage (remove % symbol if present)
+                if isinstance(vat_percentage_raw, str):
+                    vat_percentage = vat_percentage_raw.replace("%", "").strip()
+                else:
+                    vat_percentage = str(vat_percentage_raw)
+                # Get country for country-based classification
+                country = fields.get("country", "")
+                classifier_input = (vat_category_str, transaction_type, vat_percentage, country)
+                # If still no description, use the old category string
+                if not vat_category_description:
+                    vat_category_description = vat_category_str
+            
+            # Get VAT percentage for display
+            vat_percentage_raw = fields.get("vat_percentage", "0")
+            if isinstance(vat_percentage_raw, str):
+                vat_percentage = vat_percentage_raw.replace("%", "").strip()
+            else:
+                vat_percentage = str(vat_percentage_raw)
+            
+            # Extract amounts - handle multiple field name formats and NaN values
+            net_amount_raw = fields.get("net_amount", 0)
+            vat_amount_raw = fields.get("vat_amount")
+            gross_amount_raw = fields.get("gross_amount", 0)
+            
+            # Normalize amounts (handle NaN)
+            net_amount = normalize_amount(net_amount_raw)
+            # Handle NaN for VAT amount - if NaN or None, set to 0
+            if vat_amount_raw is None or (isinstance(vat_amount_raw, float) and (vat_amount_raw != vat_amount_raw)):  # NaN check
+                vat_amount = 0.0
+            else:
+                vat_amount = normalize_amount(vat_amount_raw)
+            gross_amount = normalize_amount(gross_amount_raw)
+            
+            # Extract vendor/customer name - handle both field name formats
+            # For purchases: use vendor_name (the supplier)
+            # For sales: use customer_name (the buyer)
+            if transaction_type == "purchase":
+                # Try multiple field name variations for vendor
+                invoice_to = (
+                    fields.get("vendor_name", "")
+                )
+            else:  # sale
+                # Try multiple field name variations for customer
+                invoice_to = (
+                    fields.get("customer_name", "")
+                )
+            
+            # Build invoice structure
+            invoice = {
+                "invoice_no": input_invoice_number or file_name.replace(".pdf", ""),
+                "date": date_str,
+                "invoice_to": invoice_to,
+                "country": fields.get("country", ""),
+                "vat_no": fields.get("vendor_vat_id") if transaction_type == "purchase" else fields.get("customer_vat_id", ""),
+                "transactions": [{
+                    "description": fields.get("description", ""),
+                    "amount_pre_vat": net_amount,
+                    "vat_percentage": f"{vat_percentage}%",
+                    "vat_category": vat_category_code,
+                    "vat_category_description": vat_category_description
+                }],
+                "subtotal": net_amount,
+                "vat_amount": vat_amount,
+                "total_amount": gross_amount,
+                "transaction_type": transaction_type,
+                "source_file": file_name
+            }
+            
+            # Parse the date once: reports filter on these integer keys
+            invoice.update(get_period_keys(date_str))
+            
+            # Queue for storage
+            if classifier_input is not None:
+                self.unclassified.append((invoice["transactions"][0], classifier_input))
+            self.new_invoices.append((year, invoice))
+            self.batch_index.add(year, invoice)
+            self.updated_years.add(year)
+            self.processed_count += 1
+            
+        except Exception as e:
+            self.error_count += 1
+            print(f"Error processing invoice: {e}")
+
+    def add_many(self, invoice_items, chunk_size=None):
+        """
+        add() every item; with chunk_size, flush whenever that many invoices are queued.
+        Returns (items added, flushes).
+        """
+        added = 0
+        flushes = 0
+        for invoice_item in invoice_items:
+            added += 1
+            self.add(invoice_item)
+            if chunk_size and len(self.new_invoices) >= chunk_size:
+                self.flush()
+                flushes += 1
+            elif (self.processed_count + self.skipped_count + self.error_count) % PROGRESS_EVERY == 0:
+                self.publish_progress()
+        return added, flushes
+
+    def classify_queued(self):
+        """Set the VAT codes of queued invoices that came without one (each distinct input classified once)"""
+        if not self.unclassified:
+            return
+        codes = simple_classifier.classify_many([classifier_input for _, classifier_input in self.unclassified])
+        for (transaction, _), code in zip(self.unclassified, codes):
+            transaction["vat_category"] = code
+        self.unclassified = []
+
+    def flush(self):
+        """Write queued invoices to storage (single batched transaction)"""
+        self.classify_queued()
+        store.add_invoices(self.user_id, self.new_invoices)
+        years, months = changed_periods(self.new_invoices)
+        # Flushed invoices are found by the store's duplicate check from now on
+        self.new_invoices = []
+        self.batch_index = DuplicateIndex()
+        self.publish_progress()
+        if years:
+            user_events.publish(self.user_id, "invalidate", {"source": self.source, "years": years, "months": months})
+
+    def publish_progress(self, done=False, error=None):
+        """Publish the counts so far as a progress event (done=True once the upload has ended)"""
+        if not user_events.has_subscribers(self.user_id):
+            return
+        progress = {
+            "source": self.source,
+            "job_id": self.job_id,
+            "processed": self.processed_count,
+            "stored": self.processed_count - len(self.new_invoices),
+            "skipped": self.skipped_count,
+            "errors": self.error_count,
+            "done": done
+        }
+        if error is not None:
+            progress["error"] = error
+        user_events.publish(self.user_id, "progress", progress)
+
+def store_invoice_batch(user_id, invoice_items):
+    """Convert and store a complete upload (on the worker pool); returns the InvoiceBatch with its counts"""
+    batch = InvoiceBatch(user_id)
+    try:
+        batch.add_many(invoice_items)
+        # Add to storage (single batched transaction)
+        batch.flush()
+    except Exception as e:
+        batch.publish_progress(done=True, error=str(e))
+        raise
+    batch.publish_progress(done=True)
+    return batch
+
+# Background jobs commit every INGEST_JOB_CHUNK_SIZE invoices, so their status shows stored progress
+INGEST_JOB_CHUNK_SIZE = 1000
+
+def run_ingest_job(job, invoice_items):
+    """Convert and store a background upload (on the ingest pool), counting into the job"""
+    batch = InvoiceBatch(job.user_id, source="ingest-job", job_id=job.id)
+    job.start(batch)
+    try:
+        batch.add_many(invoice_items, INGEST_JOB_CHUNK_SIZE)
+        batch.flush()
+    except Exception as e:
+        batch.publish_progress(done=True, error=str(e))
+        raise
+    batch.publish_progress(done=True)
+
 # ==================== NEW SIMPLE APPROACH: DIRECT JSON ARRAY ====================
 
 @app.post("/process-invoices", response_model=Dict[str, Any])
 async def process_invoices_simple(
     user_id: str = Header(..., alias="X-User-ID"),
-    invoices: List[Dict[str, Any]] = Body(..., description="Array of analyzed invoice data. Each invoice should have: date, type, net_amount, vat_amount, vat_category, etc.")
+    invoices: List[Dict[str, Any]] = Body(..., description="Array of analyzed invoice data. Each invoice should have: date, type, net_amount, vat_amount, vat_category, etc."),
+    background: bool = False
 ):
     """
     Store analyzed invoice data directly (UPDATED APPROACH - Uses provided NL VAT codes)
@@ -254,6 +545,11 @@ async def process_invoices_simple(
     **Backward Compatibility:**
     If NL codes are not provided, the system will attempt to map from old `vat_category` field.
     
+    **Background Mode:**
+    With `?background=true` the upload is queued as a job and the response (202)
+    only holds its `job_id`; poll `GET /ingest-jobs/{job_id}` for the counts.
+    Background jobs commit every 1000 invoices.
+    
     **Required Header:**
     - `X-User-ID`: Your user identifier
     """
@@ -263,201 +559,149 @@ async def process_invoices_simple(
     if not invoices or not isinstance(invoices, list):
         raise HTTPException(status_code=400, detail="Expected a JSON array of invoices")
     
+    if background:
+        return submit_ingest_job(user_id, invoices)
+    
     try:
-        processed_count = 0
-        skipped_count = 0
-        error_count = 0
-        updated_years = set()
-        
-        # Load existing data
-        if user_id not in user_vat_data:
-            user_vat_data[user_id] = {}
-        
-        # Process each invoice
-        for invoice_item in invoices:
-            try:
-                # Helper function to get value with multiple field name variations
-                def get_field_value(*field_names, default=None):
-                    for field_name in field_names:
-                        value = invoice_item.get(field_name)
-                        if value is not None and value != "":
-                            # Handle NaN values from Excel/CSV exports
-                            if isinstance(value, float) and (value != value):  # NaN check
-                                return default
-                            return value
-                    return default
-                
-                # Extract basic info - handle multiple field name formats
-                date_str = get_field_value("date", "Date", default="")
-                invoice_type = str(get_field_value("type", "Type", default="")).lower()
-                file_name = get_field_value("file_name", "File Name", "file_name", default="")
-                
-                # Extract year from date
-                year = "unknown"
-                if date_str:
-                    try:
-                        # Try common date formats
-                        for fmt in ["%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%Y/%m/%d", "%m-%d-%Y", "%m/%d/%Y"]:
-                            try:
-                                dt = datetime.strptime(str(date_str).strip(), fmt)
-                                year = str(dt.year)
-                                break
-                            except ValueError:
-                                continue
-                    except Exception:
-                        pass
-                
-                # Check for duplicate by file_name and invoice_number
-                if year not in user_vat_data[user_id]:
-                    user_vat_data[user_id][year] = {"invoices": []}
-                
-                # Extract invoice number for duplicate checking
-                # Try to get actual invoice number from input, fallback to file_name if not provided
-                input_invoice_number = get_field_value("invoice_number", "invoice_no", "Invoice Number", "Invoice No")
-                file_name_base = file_name.replace(".pdf", "")
-                
-                # Check if already exists (by file_name/source_file OR invoice_number)
-                existing_invoices = user_vat_data[user_id][year].get("invoices", [])
-                is_duplicate = any(
-                    # Check by file name (always check this)
-                    inv.get("source_file") == file_name or inv.get("file_name") == file_name or
-                    # Check by invoice number (if provided and different from file_name)
-                    # This catches cases where same invoice is uploaded with different file names
-                    (input_invoice_number and 
-                     input_invoice_number != file_name_base and 
-                     inv.get("invoice_no") == input_invoice_number)
-                    for inv in existing_invoices
-                )
-                
-                if is_duplicate:
-                    skipped_count += 1
-                    continue
-                
-                # Map transaction type
-                transaction_type = "sale" if invoice_type in ["sales", "sale"] else "purchase"
-                
-                # Get VAT category code and description - NEW APPROACH: Use provided NL codes directly
-                vat_category_code = get_field_value(
-                    "VAT Category (NL) Code", 
-                    "vat_category_nl_code", 
-                    "vat_category_code",
-                    "VAT Category Code",
-                    default=""
-                )
-                vat_category_description = get_field_value(
-                    "VAT Category (NL) Description",
-                    "vat_category_nl_description",
-                    "vat_category_description", 
-                    "VAT Category Description",
-                    default=""
-                )
-                
-                # Fallback: If NL code not provided, try to map from old format (backward compatibility)
-                if not vat_category_code:
-                    vat_category_str = get_field_value("vat_category", "VAT Category", default="")
-                    vat_percentage_raw = get_field_value("vat_percentage", "VAT %", "VAT Percentage", default="0")
-                    # Clean VAT percentage (remove % symbol if present)
-                    if isinstance(vat_percentage_raw, str):
-                        vat_percentage = vat_percentage_raw.replace("%", "").strip()
-                    else:
-                        vat_percentage = str(vat_percentage_raw)
-                    # Get country for country-based classification
-                    country = get_field_value("country", "Country", default="")
-                    vat_category_code = map_vat_category_simple(vat_category_str, transaction_type, vat_percentage, country)
-                    # If still no description, use the old category string
-                    if not vat_category_description:
-                        vat_category_description = vat_category_str
-                
-                # Get VAT percentage for display
-                vat_percentage_raw = get_field_value("vat_percentage", "VAT %", "VAT Percentage", default="0")
-                if isinstance(vat_percentage_raw, str):
-                    vat_percentage = vat_percentage_raw.replace("%", "").strip()
-                else:
-                    vat_percentage = str(vat_percentage_raw)
-                
-                # Extract amounts - handle multiple field name formats and NaN values
-                net_amount_raw = get_field_value("net_amount", "Net Amount", default=0)
-                vat_amount_raw = get_field_value("vat_amount", "VAT Amount", default=None)
-                gross_amount_raw = get_field_value("gross_amount", "Gross Amount", default=0)
-                
-                # Normalize amounts (handle NaN)
-                net_amount = normalize_amount(net_amount_raw)
-                # Handle NaN for VAT amount - if NaN or None, set to 0
-                if vat_amount_raw is None or (isinstance(vat_amount_raw, float) and (vat_amount_raw != vat_amount_raw)):  # NaN check
-                    vat_amount = 0.0
-                else:
-                    vat_amount = normalize_amount(vat_amount_raw)
-                gross_amount = normalize_amount(gross_amount_raw)
-                
-                # Extract vendor/customer name - handle both field name formats
-                # For purchases: use vendor_name (the supplier)
-                # For sales: use customer_name (the buyer)
-                if transaction_type == "purchase":
-                    # Try multiple field name variations for vendor
-                    invoice_to = (
-                        get_field_value("vendor_name", "Vendor Name", "vendor", default="")
-                    )
-                else:  # sale
-                    # Try multiple field name variations for customer
-                    invoice_to = (
-                        get_field_value("customer_name", "Customer Name", "customer", default="")
-                    )
-                
-                # Build invoice structure
-                invoice = {
-                    "invoice_no": input_invoice_number or file_name.replace(".pdf", ""),
-                    "date": date_str,
-                    "invoice_to": invoice_to,
-                    "country": get_field_value("country", "Country", default=""),
-                    "vat_no": get_field_value("vendor_vat_id", "Vendor VAT ID") if transaction_type == "purchase" else get_field_value("customer_vat_id", "Customer VAT ID", default=""),
-                    "transactions": [{
-                        "description": get_field_value("description", "Description", default=""),
-                        "amount_pre_vat": net_amount,
-                        "vat_percentage": f"{vat_percentage}%",
-                        "vat_category": vat_category_code,
-                        "vat_category_description": vat_category_description
-                    }],
-                    "subtotal": net_amount,
-                    "vat_amount": vat_amount,
-                    "total_amount": gross_amount,
-                    "transaction_type": transaction_type,
-                    "source_file": file_name
-                }
-                
-                # Add to storage
-                user_vat_data[user_id][year]["invoices"].append(invoice)
-                updated_years.add(year)
-                processed_count += 1
-                
-            except Exception as e:
-                error_count += 1
-                print(f"Error processing invoice: {e}")
-                continue
+        async with user_write_lock(user_id):
+            batch = await shielded(run_in_worker(store_invoice_batch, user_id, invoices))
         
         return {
             "status": "success",
-            "message": f"Processed {processed_count} invoices, skipped {skipped_count}, errors: {error_count}",
+            "message": f"Processed {batch.processed_count} invoices, skipped {batch.skipped_count}, errors: {batch.error_count}",
             "details": {
-                "processed": processed_count,
-                "skipped": skipped_count,
-                "errors": error_count,
-                "updated_years": list(updated_years)
+                "processed": batch.processed_count,
+                "skipped": batch.skipped_count,
+                "errors": batch.error_count,
+                "updated_years": list(batch.updated_years)
             },
             "total_invoices_received": len(invoices)
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing invoices: {str(e)}")
 
-# Jurisdiction Constants
-DOMESTIC_COUNTRY = "NL"
+def submit_ingest_job(user_id, invoices):
+    """Queue an upload as a background job; 202 with the job id (503 if too many jobs are pending)"""
+    async def run(job):
+        # Waits for the user's other writes like a direct upload would
+        async with user_write_lock(user_id):
+            await shielded(ingest_jobs.pool.run(run_ingest_job, job, invoices))
+    
+    try:
+        job = ingest_jobs.submit(user_id, len(invoices), run)
+    except WorkerPoolFull:
+        raise HTTPException(status_code=503, detail="Too many uploads queued, please retry", headers={"Retry-After": "5"})
+    
+    print(f"📥 Queued ingest job {job.id} for user {user_id}: {len(invoices)} invoices")
+    return JSONResponse(status_code=202, content={
+        "status": "accepted",
+        "message": f"Queued {len(invoices)} invoices for processing",
+        "job_id": job.id,
+        "status_url": f"/ingest-jobs/{job.id}",
+        "total_invoices_received": len(invoices)
+    })
+
+@app.get("/ingest-jobs/{job_id}")
+async def get_ingest_job(job_id: str, user_id: str = Header(..., alias="X-User-ID")):
+    """Status of a background upload: queued, running, completed or failed, with processed/skipped/error counts"""
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing X-User-ID header")
+    
+    job = ingest_jobs.get(user_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingest job {job_id} not found")
+    return job.to_dict()
+
+@app.get("/ingest-job-stats")
+async def get_ingest_job_stats():
+    """Background upload jobs per status and the ingest pool's counters"""
+    return ingest_jobs.stats()
+
+# ==================== STREAMING UPLOAD: NDJSON ====================
 
-# List of EU Countries (excluding NL)
-EU_COUNTRIES = [
-    "AT", "BE", "BG", "HR", "CY", "CZ", "DK", "EE", "FI", "FR", "DE", "GR", 
-    "HU", "IE", "IT", "LV", "LT", "LU", "MT", "PL", "PT", "RO", "SK", "SI", 
-    "ES", "SE"
-]
-# Note: GB (United Kingdom) is NON-EU.
+@app.post("/process-invoices-stream", response_model=Dict[str, Any])
+async def process_invoices_stream(
+    request: Request,
+    user_id: str = Header(..., alias="X-User-ID"),
+    chunk_size: int = 1000
+):
+    """
+    Store analyzed invoice data from a streamed request body (for very large uploads)
+    
+    **Input Format:**
+    Newline-delimited JSON (one invoice object per line), concatenated objects
+    (`{...}{...}{...}`) or a JSON array. Each invoice has the same fields as in
+    `/process-invoices`:
+    ```
+    {"date": "2025-09-25", "type": "Purchase", "net_amount": 4357.46, "file_name": "Invoice_26411.pdf", "VAT Category (NL) Code": "4a"}
+    {"date": "2025-09-26", "type": "Sales", "net_amount": 1200.00, "vat_amount": 252.00, "file_name": "Invoice_26412.pdf", "VAT Category (NL) Code": "1a"}
+    ```
+    
+    The body is parsed while it is received and invoices are committed every
+    `chunk_size` invoices, so memory use doesn't grow with the upload size.
+    If the upload fails half-way, the chunks committed before stay stored
+    (uploading again skips them as duplicates).
+    
+    **Required Header:**
+    - `X-User-ID`: Your user identifier
+    """
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing X-User-ID header")
+    
+    chunk_size = max(1, chunk_size)
+    batch = InvoiceBatch(user_id, source="process-invoices-stream")
+    parser = JsonObjectStream()
+    received_count = 0
+    committed_chunks = 0
+    
+    def ingest(body_chunk, final=False):
+        # Parse a piece of the body and queue/commit its invoices (on the worker pool)
+        invoice_items = parser.close() if final else parser.feed(body_chunk)
+        return batch.add_many(invoice_items, chunk_size)
+    
+    try:
+        # Held for the whole upload: other uploads of the user wait, reports don't
+        async with user_write_lock(user_id):
+            async for body_chunk in request.stream():
+                added, flushes = await shielded(run_in_worker(ingest, body_chunk))
+                received_count += added
+                committed_chunks += flushes
+            
+            added, flushes = await shielded(run_in_worker(ingest, b"", True))
+            received_count += added
+            committed_chunks += flushes
+            
+            if batch.new_invoices:
+                await shielded(run_in_worker(batch.flush))
+                committed_chunks += 1
+    except HTTPException as e:
+        batch.publish_progress(done=True, error=str(e.detail))
+        raise
+    except Exception as e:
+        batch.publish_progress(done=True, error=str(e))
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing invoice stream after {received_count} invoices "
+                   f"({batch.processed_count - len(batch.new_invoices)} stored): {str(e)}"
+        )
+    
+    batch.publish_progress(done=True)
+    return {
+        "status": "success",
+        "message": f"Processed {batch.processed_count} invoices, skipped {batch.skipped_count}, errors: {batch.error_count}",
+        "details": {
+            "processed": batch.processed_count,
+            "skipped": batch.skipped_count,
+            "errors": batch.error_count,
+            "parse_errors": parser.errors,
+            "malformed_objects": parser.malformed,
+            "committed_chunks": committed_chunks,
+            "updated_years": list(batch.updated_years)
+        },
+        "total_invoices_received": received_count
+    }
 
 def map_vat_category_simple(vat_category_str, transaction_type, vat_percentage, country=""):
     """
@@ -486,178 +730,12 @@ def map_vat_category_simple(vat_category_str, transaction_type, vat_percentage,
     - "EU Services" + Purchase → 4b
     - "Reverse Charge" + Purchase → 2a
     - "Import" + Purchase → 4c
-    """
-    # Normalize inputs
-    category = str(vat_category_str).strip() if vat_category_str else ""
-    category_lower = category.lower()
-    tx_type = str(transaction_type).strip().lower()
-    country_upper = str(country).strip().upper() if country else ""
-    
-    # Parse percentage (handle string "21" or "21%" to float 21.0)
-    percentage_str = str(vat_percentage).replace("%", "").strip()
-    try:
-        percentage = float(percentage_str)
-    except (ValueError, TypeError):
-        percentage = 0.0
-    
-    # --- LOGIC FOR STANDARD / REDUCED RATES (Priority: Check Percentage) ---
-    if "standard vat" in category_lower or "standard rate" in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            if percentage == 21:
-                return "1a"  # Standard rate sales (21%)
-            elif percentage == 9:
-                return "1b"  # Reduced rate labeled as standard (9%)
-            else:
-                # Default to 1a if percentage doesn't match
-                return "1a"
-        elif tx_type == "purchase":
-            return "5b"  # Domestic input VAT (any percentage)
-    
-    if "reduced rate" in category_lower or "reduced" in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            return "1b"  # Reduced rate sales (9%)
-        elif tx_type == "purchase":
-            return "5b"  # Alternative label for domestic input VAT
-    
-    # --- LOGIC FOR ZERO RATED / EU (WITH COUNTRY-BASED CLASSIFICATION) ---
-    if "zero rated" in category_lower or "zero-rated" in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            # For Sales with 0% VAT, check country to determine correct code
-            if percentage == 0:
-                if country_upper == DOMESTIC_COUNTRY:
-                    return "1e"  # Domestic 0% / Exempt (NL customer)
-                elif country_upper in EU_COUNTRIES:
-                    return "3b"  # Intra-Community Supply (EU customer)
-                elif country_upper and country_upper not in EU_COUNTRIES:
-                    return "3a"  # Export to Non-EU (Non-EU customer)
-                else:
-                    # No country info - default to 1c (general zero-rated)
-                    return "1c"  # General Exports / Zero Rated sales
-            else:
-                return "1c"  # Non-zero percentage with zero-rated category (shouldn't happen, but fallback)
-        elif tx_type == "purchase":
-            # For Purchases with 0% VAT, check country to determine correct code
-            if percentage == 0:
-                if country_upper in EU_COUNTRIES:
-                    return "4b"  # Services/Goods from EU
-                elif country_upper and country_upper not in EU_COUNTRIES:
-                    return "4a"  # Services/Goods from Non-EU
-                else:
-                    # No country info - default to 4a (assumes EU Goods Purchase)
-                    return "4a"  # Assumes EU Goods Purchase
-            else:
-                return "4a"  # Non-zero percentage with zero-rated category (shouldn't happen, but fallback)
-    
-    if "eu goods" in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            return "3a"  # Specific EU Supply
-        elif tx_type == "purchase":
-            return "4a"  # Same code as Zero Rated Purchase
-    
-    if "eu services" in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            return "3b"  # EU Service Supply
-        elif tx_type == "purchase":
-            return "4b"  # EU Service Purchase
-    
-    # Handle generic "EU" category
-    if "eu" in category_lower and "goods" not in category_lower and "services" not in category_lower:
-        if tx_type == "sale" or tx_type == "sales":
-            return "3a"  # Default to goods for EU sales
-        elif tx_type == "purchase":
-            return "4a"  # Default to goods for EU purchases
-    
-    # --- LOGIC FOR OTHERS ---
-    if ("reverse charge" in category_lower or "reverse-charge" in category_lower) and tx_type == "purchase":
-        return "2a"  # Reverse Charge Mechanism
-    
-    if "import" in category_lower and tx_type == "purchase":
-        return "4c"  # Non-EU Import
-    
-    # --- FALLBACK LOGIC (if category not recognized) ---
-    # Default based on transaction type, VAT percentage, and country
-    if tx_type == "sale" or tx_type == "sales":
-        if percentage == 21:
-            return "1a"
-        elif percentage == 9:
-            return "1b"
-        elif percentage == 0:
-            # For 0% sales, check country in fallback too
-            if country_upper == DOMESTIC_COUNTRY:
-                return "1e"  # Domestic 0% / Exempt
-            elif country_upper in EU_COUNTRIES:
-                return "3b"  # Intra-Community Supply
-            elif country_upper and country_upper not in EU_COUNTRIES:
-                return "3a"  # Export to Non-EU
-            else:
-                return "1c"  # Default zero-rated sales
-        else:
-            return "1a"  # Default to standard rate
-    elif tx_type == "purchase":
-        if percentage == 0:
-            # For 0% purchases, check country in fallback too
-            if country_upper in EU_COUNTRIES:
-                return "4b"  # Services/Goods from EU
-            elif country_upper and country_upper not in EU_COUNTRIES:
-                return "4a"  # Services/Goods from Non-EU
-            else:
-                return "2a"  # Default to reverse charge for zero-rated purchases (no country info)
-        else:
-            return "5b"  # Default to domestic input VAT
     
-    # Final fallback
-    return "5b"  # Default to domestic input VAT
-
-# ==================== HELPER FUNCTIONS ====================
-
-def parse_multiple_json_objects(text):
-    """
-    Parse multiple JSON objects from concatenated text
-    Handles: {...}{...}{...} format
+    The rules are the SIMPLE_RULES decision table in vat_classifier.py (memoized per
+    distinct input). InvoiceBatch classifies a whole batch at once with
+    simple_classifier.classify_many (the same codes).
     """
-    objects = []
-    text = text.strip()
-    
-    if not text:
-        return objects
-    
-    # Try to find JSON object boundaries
-    depth = 0
-    start = -1
-    in_string = False
-    escape_next = False
-    
-    for i, char in enumerate(text):
-        if escape_next:
-            escape_next = False
-            continue
-        
-        if char == '\\':
-            escape_next = True
-            continue
-        
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            continue
-        
-        if not in_string:
-            if char == '{':
-                if depth == 0:
-                    start = i
-                depth += 1
-            elif char == '}':
-                depth -= 1
-                if depth == 0 and start >= 0:
-                    # Found complete JSON object
-                    json_str = text[start:i+1]
-                    try:
-                        obj = json.loads(json_str)
-                        objects.append(obj)
-                    except json.JSONDecodeError:
-                        pass
-                    start = -1
-    
-    return objects
+    return simple_classifier.classify(vat_category_str, transaction_type, vat_percentage, country)
 
 # ==================== REMOVED ENDPOINTS ====================
 # The following endpoints were removed as they are redundant:
@@ -681,12 +759,8 @@ async def update_company_details(
     if not company_vat:
         raise HTTPException(status_code=400, detail="Missing X-Company-VAT header")
 
-    # In-memory storage
-    user_company_details[user_id] = {
-        "company_name": company_name,
-        "company_vat": company_vat,
-        "updated_at": datetime.utcnow().isoformat() + "Z"
-    }
+    async with user_write_lock(user_id):
+        store.set_company_details(user_id, company_name, company_vat)
     
     # ==================== COMMENTED OUT - S3 Integration ====================
     # # Store company details in S3
@@ -722,8 +796,7 @@ async def get_company_details(user_id: str = Header(..., alias="X-User-ID")):
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing X-User-ID header")
 
-    # In-memory storage
-    company_data = user_company_details.get(user_id)
+    company_data = store.get_company_details(user_id)
     if company_data:
         return {
             "company_name": company_data.get("company_name"),
@@ -843,11 +916,9 @@ async def get_vat_payable(user_id: str = Header(..., alias="X-User-ID"), year: s
     if not year:
         year = str(datetime.now().year)
     
-    # In-memory storage
+    # Invoice-level VAT totals are kept per month by the store (no invoice scan)
     try:
-        data = user_vat_data.get(user_id, {}).get(year, {"invoices": []})
-        if not isinstance(data, dict) or "invoices" not in data:
-            data = {"invoices": []}
+        invoice_totals = store.get_invoice_totals(user_id, year)
     except:
         return {
             "vat_collected": 0,
@@ -869,35 +940,128 @@ async def get_vat_payable(user_id: str = Header(..., alias="X-User-ID"), year: s
     #         "year": year
     #     }
     
-    vat_collected = 0.0
-    vat_paid = 0.0
+    # Summed in integer cents
+    vat_collected = 0
+    vat_paid = 0
     
-    for invoice in data.get("invoices", []):
-        vat_amount = normalize_amount(invoice.get("vat_amount", "0"))
-        
-        # Determine if this is VAT collected (sales) or VAT paid (purchases)
-        transaction_type = invoice.get("transaction_type", "sale")
-        
-        if transaction_type == "sale":
-            vat_collected += vat_amount
+    for month, is_sale, vat_cents, invoice_count in invoice_totals:
+        # VAT collected (sales) or VAT paid (purchases)
+        if is_sale:
+            vat_collected += vat_cents
         else:
-            vat_paid += vat_amount
+            vat_paid += vat_cents
     
+    vat_collected = cents_to_amount(vat_collected)
+    vat_paid = cents_to_amount(vat_paid)
     vat_payable = calculate_vat_payable(vat_collected, vat_paid)
     
     return {
         "year": year,
-        "vat_collected": round(vat_collected, 2),
-        "vat_paid": round(vat_paid, 2),
+        "vat_collected": vat_collected,
+        "vat_paid": vat_paid,
         "vat_payable": vat_payable,
         "status": "refund_due" if vat_payable < 0 else "payment_due" if vat_payable > 0 else "balanced"
     }
 
+# ==================== REPORT CACHE ====================
+
+async def cached_report(endpoint, user_id, year, period, if_none_match, build_report):
+    """
+    Serve a report from the report cache.
+
+    The cache key includes the user's data version, so any write makes a new key.
+    Responses carry an ETag; a matching If-None-Match gets 304 Not Modified
+    without building or even looking up the report. A cached body is replayed as
+    built: its generated_at is the time the report was built for this data version.
+
+    build_report(reader) reads from a snapshot of the user's data (see
+    InvoiceStore.snapshot) and runs on the worker pool. The key and ETag use the
+    version of that snapshot, so uploads running meanwhile never show up half in
+    a report or under the wrong version.
+    """
+    with store.snapshot(user_id) as reader:
+        key, headers = report_key_headers(endpoint, user_id, year, period, reader.data_version)
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        body = report_cache.get(key)
+
+    if body is None:
+        # Data may have changed since the lookup: cache under the version that was built
+        data_version, body = await run_in_worker(render_report, user_id, build_report)
+        key, headers = report_key_headers(endpoint, user_id, year, period, data_version)
+        report_cache.put(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def render_report(user_id, build_report):
+    """(data version, JSON body) of a report built from a new snapshot (on the worker pool)"""
+    with store.snapshot(user_id) as reader:
+        report = jsonable_encoder(build_report(reader))
+    # Serialized piece by piece: one json.dumps call on a large report would hold
+    # the GIL (and stall the event loop) for as long as it runs
+    return reader.data_version, "".join(iter_json_parts(report)).encode("utf-8")
+
+# Long lists are serialized this many items at a time
+JSON_PART_ITEMS = 256
+
+def iter_json_parts(value):
+    """Serialize a value like dump_json (byte-identical) in parts: long lists in slices, dicts key by key"""
+    if isinstance(value, list) and len(value) > JSON_PART_ITEMS:
+        yield "["
+        for start in range(0, len(value), JSON_PART_ITEMS):
+            yield ("," if start else "") + dump_json(value[start:start + JSON_PART_ITEMS])[1:-1]
+        yield "]"
+    elif (isinstance(value, dict) and all(type(key) is str for key in value)
+          and any(isinstance(item, (list, dict)) for item in value.values())):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield ("," if i else "") + dump_json(key) + ":"
+            yield from iter_json_parts(item)
+        yield "}"
+    else:
+        yield dump_json(value)
+
+def report_key_headers(endpoint, user_id, year, period, data_version):
+    """Cache key of a report (includes the user's data version) and its response headers (ETag)"""
+    key = (endpoint, user_id, year, period, data_version)
+    return key, {"ETag": report_etag(key, store.instance_id), "Cache-Control": "no-cache"}
+
+@app.get("/report-cache-stats")
+async def get_report_cache_stats():
+    """Report cache hit/miss counters and memory usage"""
+    return report_cache.stats()
+
+@app.get("/worker-pool-stats")
+async def get_worker_pool_stats():
+    """Worker pool size, running and queued calls, and completed/rejected counters"""
+    return worker_pool.stats()
+
+@app.get("/llm-cache-stats")
+async def get_llm_cache_stats():
+    """OpenAI response cache entries, size and hit/miss counters"""
+    return llm_cache.stats()
+
+@app.get("/llm-retry-stats")
+async def get_llm_retry_stats():
+    """OpenAI call retries, circuit breaker state and trips"""
+    return llm_retry.stats()
+
+@app.get("/pdf-preprocess-stats")
+async def get_pdf_preprocess_stats():
+    """PDFs sent as text / page images / PDF, and payload sizes before and after"""
+    return pdf_preprocessor.stats()
+
 # ==================== SIMPLIFIED VAT REPORTS ====================
 
 @app.get("/vat-report-quarterly")
-async def get_vat_report_quarterly(user_id: str = Header(..., alias="X-User-ID"), year: str = "", quarter: str = ""):
-    """Get simplified quarterly VAT report in the requested format"""
+async def get_vat_report_quarterly(user_id: str = Header(..., alias="X-User-ID"), year: str = "", quarter: str = "",
+                                   include_transactions: bool = True, stream: bool = False,
+                                   if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    """
+    Get simplified quarterly VAT report in the requested format.
+    With include_transactions=false only the totals are returned, plus a cursor per
+    category for paging through its transactions (/report-transactions).
+    With stream=true the full report is streamed from the store (for large exports).
+    """
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing X-User-ID header")
 
@@ -918,11 +1082,23 @@ async def get_vat_report_quarterly(user_id: str = Header(..., alias="X-User-ID")
         # Normalize quarter to uppercase (handle q1, Q1, etc.)
         quarter = quarter.upper()
 
-    # In-memory storage
+    if stream and include_transactions:
+        return await streamed_report("vat-report-quarterly", user_id, year, quarter, if_none_match,
+                                     lambda reader: build_vat_report_quarterly(reader, user_id, year, quarter,
+                                                                               include_transactions=False),
+                                     months=get_quarter_month_numbers(quarter), include_category_fields=True)
+
+    return await cached_report("vat-report-quarterly", user_id, year, report_cache_period(quarter, include_transactions),
+                         if_none_match,
+                         lambda reader: build_vat_report_quarterly(reader, user_id, year, quarter, include_transactions))
+
+def build_vat_report_quarterly(reader, user_id, year, quarter, include_transactions=True):
+    """Build the quarterly VAT report from reader (a store snapshot)"""
+    # Read only the quarter's months (indexed by user, year and month) and their stored totals
     try:
-        data = user_vat_data.get(user_id, {}).get(year, {"invoices": []})
-        if not isinstance(data, dict) or "invoices" not in data:
-            data = {"invoices": []}
+        quarter_months = get_quarter_month_numbers(quarter)
+        invoices = reader.get_invoices(user_id, year, months=quarter_months) if include_transactions else []
+        totals = reader.get_category_totals(user_id, year, months=quarter_months)
     except:
         return {
             "report_type": "vat_tax_return",
@@ -946,152 +1122,13 @@ async def get_vat_report_quarterly(user_id: str = Header(..., alias="X-User-ID")
     #         "vat_calculation": {"vat_collected": 0, "vat_deductible": 0, "vat_payable": 0},
     #     }
 
-    # Get company details (pass in-memory storage)
-    company_details = get_user_company_details(user_id, storage_dict=user_company_details)
+    # Get company details from storage
+    company_details = get_user_company_details(user_id, store=reader)
     if company_details is None:
         company_details = {}
     
-    # Filter transactions by quarter
-    quarter_months = {
-        "Q1": ["Jan", "Feb", "Mar"],
-        "Q2": ["Apr", "May", "Jun"], 
-        "Q3": ["Jul", "Aug", "Sep"],
-        "Q4": ["Oct", "Nov", "Dec"]
-    }
-    
-    target_months = quarter_months.get(quarter, [])
-    
-    # Categorize transactions
-    categories = {
-        "1a": {"name": "Sales Taxed at Standard Rate (21%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1b": {"name": "Sales Taxed at Reduced Rate (9%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1c": {"name": "Sales Taxed at Other Rates (0%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1d": {"name": "Private Use of Business Assets", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1e": {"name": "Sales Exempt from VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "2a": {"name": "Reverse-Charge Supplies", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3a": {"name": "Supplies of Goods to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3b": {"name": "Supplies of Services to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3c": {"name": "Installation/Distance Sales to Private Individuals (EU)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4a": {"name": "Purchases of Goods From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4b": {"name": "Purchases of Services From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4c": {"name": "Purchases of Goods from Non-EU Countries (Imports)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5a": {"name": "Domestic purchases with Dutch VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5b": {"name": "Input VAT on Domestic Purchases", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}}
-    }
-    
-    vat_collected = 0.0
-    vat_deductible = 0.0
-    
-    for invoice in data.get("invoices", []):
-        dt = try_parse_date(invoice.get("date", ""))
-        if not dt: continue
-        
-        month = dt.strftime("%b")
-        if month not in target_months: continue
-        
-        invoice_no = invoice.get("invoice_no", "")
-        date = invoice.get("date", "")
-        transaction_type = invoice.get("transaction_type", "sale")
-        
-        # Get invoice-level VAT amount (handle both string and numeric)
-        invoice_vat_total = normalize_amount(invoice.get("vat_amount", 0))
-        invoice_net_total = normalize_amount(invoice.get("subtotal", invoice.get("total_amount", 0)))
-        
-        # Process transactions
-        transactions_list = invoice.get("transactions", [])
-        if not transactions_list:
-            # If no transactions, create one from invoice-level data
-            transactions_list = [{
-                "description": invoice.get("invoice_to", "N/A"),
-                "amount_pre_vat": invoice_net_total,
-                "vat_percentage": "0%",
-                "vat_category": ""
-            }]
-        
-        # Distribute VAT proportionally if multiple transactions
-        total_net = sum(normalize_amount(tx.get("amount_pre_vat", 0)) for tx in transactions_list)
-        
-        # If total_net is 0 but invoice has amount (positive or negative), use invoice amount for single transaction
-        if total_net == 0 and invoice_net_total != 0 and len(transactions_list) == 1:
-            total_net = invoice_net_total
-        
-        for tx in transactions_list:
-            vat_category = tx.get("vat_category", "")
-            description = tx.get("description", "")
-            tx_amount = normalize_amount(tx.get("amount_pre_vat", 0))
-            
-            # CRITICAL FIX: Handle both positive and negative amounts (credit notes)
-            # Credit notes have negative amounts and must be preserved for correct VAT calculation
-            if tx_amount != 0:  # Use != 0 to handle both positive and negative
-                amount_pre_vat = tx_amount
-            elif invoice_net_total != 0:  # Use != 0 to handle both positive and negative
-                # Use invoice amount - distribute if multiple transactions
-                if len(transactions_list) == 1:
-                    amount_pre_vat = invoice_net_total
-                    # Update total_net for VAT calculation (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                else:
-                    # Multiple transactions - distribute invoice total proportionally (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                    amount_pre_vat = invoice_net_total / len(transactions_list)
-            else:
-                amount_pre_vat = 0.0
-            
-            vat_percentage_str = tx.get("vat_percentage", "0")
-            vat_percentage = float(vat_percentage_str.replace("%", "")) if isinstance(vat_percentage_str, str) else float(vat_percentage_str)
-            
-            # Handle VAT calculation for both positive and negative amounts (credit notes)
-            # Credit notes have negative VAT that must be subtracted
-            if invoice_vat_total != 0 and total_net != 0:
-                # Distribute VAT proportionally (preserve sign for credit notes)
-                vat_amount = round((amount_pre_vat / total_net) * invoice_vat_total, 2)
-            elif invoice_vat_total != 0 and total_net == 0 and amount_pre_vat != 0:
-                # If total_net is 0 but we have amount_pre_vat, use it directly (preserve sign)
-                vat_amount = invoice_vat_total
-            elif vat_percentage != 0:
-                # Calculate from percentage (preserve sign - negative amount * positive % = negative VAT)
-                vat_amount = round(amount_pre_vat * vat_percentage / 100, 2)
-            else:
-                vat_amount = 0.0
-            
-            # Get vendor/customer name from invoice
-            invoice_to = invoice.get("invoice_to", "")
-            
-            transaction = {
-                "date": date,
-                "invoice_no": invoice_no,
-                "description": description,
-                "net_amount": round(amount_pre_vat, 2),
-                "vat_percentage": vat_percentage,
-                "vat_amount": vat_amount,
-                "vat_category": vat_category,
-                "vat_category_description": tx.get("vat_category_description", "")
-            }
-            
-            # Add vendor_name for purchases, customer_name for sales (only if not empty)
-            if transaction_type == "purchase" and invoice_to:
-                transaction["vendor_name"] = invoice_to
-            elif transaction_type == "sale" and invoice_to:
-                transaction["customer_name"] = invoice_to
-            
-            if vat_category in categories:
-                categories[vat_category]["transactions"].append(transaction)
-                categories[vat_category]["totals"]["net"] += amount_pre_vat
-                categories[vat_category]["totals"]["vat"] += vat_amount
-                
-                if transaction_type == "sale":
-                    vat_collected += vat_amount
-                else:
-                    vat_deductible += vat_amount
-    
-    vat_payable = vat_collected - vat_deductible
-    
-    # Round all totals in categories
-    for cat_code, cat_data in categories.items():
-        cat_data["totals"]["net"] = round(cat_data["totals"]["net"], 2)
-        cat_data["totals"]["vat"] = round(cat_data["totals"]["vat"], 2)
+    # Transactions from the quarter's invoices, totals from the materialized totals
+    aggregate = aggregate_invoices(invoices, totals=totals)
     
     return {
         "report_type": "vat_tax_return",
@@ -1102,28 +1139,39 @@ async def get_vat_report_quarterly(user_id: str = Header(..., alias="X-User-ID")
             "company_vat": company_details.get("company_vat", "N/A") if company_details else "N/A",
             "reporting_period": f"{quarter} {year}"
         },
-        "categories": categories,
-        "vat_calculation": {
-            "vat_collected": round(vat_collected, 2),
-            "vat_deductible": round(vat_deductible, 2),
-            "vat_payable": round(vat_payable, 2)
-        }
+        "categories": report_categories(aggregate, year, quarter, include_transactions),
+        "vat_calculation": aggregate.vat_calculation(quarter)
     }
 
 @app.get("/vat-report-yearly")
-async def get_vat_report_yearly(user_id: str = Header(..., alias="X-User-ID"), year: str = ""):
-    """Get simplified yearly VAT report in the requested format"""
+async def get_vat_report_yearly(user_id: str = Header(..., alias="X-User-ID"), year: str = "",
+                                include_transactions: bool = True, stream: bool = False,
+                                if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    """
+    Get simplified yearly VAT report in the requested format.
+    With include_transactions=false only the totals are returned, plus a cursor per
+    category for paging through its transactions (/report-transactions).
+    With stream=true the full report is streamed from the store (for large exports).
+    """
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing X-User-ID header")
 
     if not year:
         year = str(datetime.now().year)
 
-    # In-memory storage
+    if stream and include_transactions:
+        return await streamed_report("vat-report-yearly", user_id, year, "", if_none_match,
+                                     lambda reader: build_vat_report_yearly(reader, user_id, year, include_transactions=False),
+                                     months=None, include_category_fields=False)
+
+    return await cached_report("vat-report-yearly", user_id, year, report_cache_period("", include_transactions),
+                         if_none_match, lambda reader: build_vat_report_yearly(reader, user_id, year, include_transactions))
+
+def build_vat_report_yearly(reader, user_id, year, include_transactions=True):
+    """Build the yearly VAT report from reader (a store snapshot)"""
     try:
-        data = user_vat_data.get(user_id, {}).get(year, {"invoices": []})
-        if not isinstance(data, dict) or "invoices" not in data:
-            data = {"invoices": []}
+        invoices = reader.get_invoices(user_id, year) if include_transactions else []
+        totals = reader.get_category_totals(user_id, year)
     except:
         return {
             "report_type": "vat_tax_return",
@@ -1147,157 +1195,14 @@ async def get_vat_report_yearly(user_id: str = Header(..., alias="X-User-ID"), y
     #         "vat_calculation": {"vat_collected": 0, "vat_deductible": 0, "vat_payable": 0},
     #     }
 
-    # Get company details (pass in-memory storage)
-    company_details = get_user_company_details(user_id, storage_dict=user_company_details)
+    # Get company details from storage
+    company_details = get_user_company_details(user_id, store=reader)
     if company_details is None:
         company_details = {}
     
-    # Categorize transactions
-    categories = {
-        "1a": {"name": "Sales Taxed at Standard Rate (21%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1b": {"name": "Sales Taxed at Reduced Rate (9%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1c": {"name": "Sales Taxed at Other Rates (0%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1d": {"name": "Private Use of Business Assets", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1e": {"name": "Sales Exempt from VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "2a": {"name": "Reverse-Charge Supplies", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3a": {"name": "Supplies of Goods to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3b": {"name": "Supplies of Services to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3c": {"name": "Installation/Distance Sales to Private Individuals (EU)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4a": {"name": "Purchases of Goods From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4b": {"name": "Purchases of Services From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4c": {"name": "Purchases of Goods from Non-EU Countries (Imports)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5a": {"name": "Domestic purchases with Dutch VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5b": {"name": "Input VAT on Domestic Purchases", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}}
-    }
-    
-    # Quarterly breakdown
-    quarterly_breakdown = {
-        "Q1": {"period": f"Q1 {year} (Jan-Mar)", "vat_collected": 0.0, "vat_deductible": 0.0, "vat_payable": 0.0},
-        "Q2": {"period": f"Q2 {year} (Apr-Jun)", "vat_collected": 0.0, "vat_deductible": 0.0, "vat_payable": 0.0},
-        "Q3": {"period": f"Q3 {year} (Jul-Sep)", "vat_collected": 0.0, "vat_deductible": 0.0, "vat_payable": 0.0},
-        "Q4": {"period": f"Q4 {year} (Oct-Dec)", "vat_collected": 0.0, "vat_deductible": 0.0, "vat_payable": 0.0}
-    }
-    
-    vat_collected = 0.0
-    vat_deductible = 0.0
-    
-    for invoice in data.get("invoices", []):
-        dt = try_parse_date(invoice.get("date", ""))
-        if not dt: continue
-        
-        month = dt.strftime("%b")
-        quarter = get_quarter_from_month(month)
-        invoice_no = invoice.get("invoice_no", "")
-        date = invoice.get("date", "")
-        transaction_type = invoice.get("transaction_type", "sale")
-        
-        # Get invoice-level VAT amount (handle both string and numeric)
-        invoice_vat_total = normalize_amount(invoice.get("vat_amount", 0))
-        invoice_net_total = normalize_amount(invoice.get("subtotal", invoice.get("total_amount", 0)))
-        
-        # Process transactions
-        transactions_list = invoice.get("transactions", [])
-        if not transactions_list:
-            # If no transactions, create one from invoice-level data
-            transactions_list = [{
-                "description": invoice.get("invoice_to", "N/A"),
-                "amount_pre_vat": invoice_net_total,
-                "vat_percentage": "0%",
-                "vat_category": ""
-            }]
-        
-        # Distribute VAT proportionally if multiple transactions
-        total_net = sum(normalize_amount(tx.get("amount_pre_vat", 0)) for tx in transactions_list)
-        
-        # If total_net is 0 but invoice has amount (positive or negative), use invoice amount for single transaction
-        if total_net == 0 and invoice_net_total != 0 and len(transactions_list) == 1:
-            total_net = invoice_net_total
-        
-        for tx in transactions_list:
-            vat_category = tx.get("vat_category", "")
-            description = tx.get("description", "")
-            tx_amount = normalize_amount(tx.get("amount_pre_vat", 0))
-            
-            # CRITICAL FIX: Handle both positive and negative amounts (credit notes)
-            # Credit notes have negative amounts and must be preserved for correct VAT calculation
-            if tx_amount != 0:  # Use != 0 to handle both positive and negative
-                amount_pre_vat = tx_amount
-            elif invoice_net_total != 0:  # Use != 0 to handle both positive and negative
-                # Use invoice amount - distribute if multiple transactions
-                if len(transactions_list) == 1:
-                    amount_pre_vat = invoice_net_total
-                    # Update total_net for VAT calculation (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                else:
-                    # Multiple transactions - distribute invoice total proportionally (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                    amount_pre_vat = invoice_net_total / len(transactions_list)
-            else:
-                amount_pre_vat = 0.0
-            
-            vat_percentage_str = tx.get("vat_percentage", "0")
-            vat_percentage = float(vat_percentage_str.replace("%", "")) if isinstance(vat_percentage_str, str) else float(vat_percentage_str)
-            
-            # Handle VAT calculation for both positive and negative amounts (credit notes)
-            # Credit notes have negative VAT that must be subtracted
-            if invoice_vat_total != 0 and total_net != 0:
-                # Distribute VAT proportionally (preserve sign for credit notes)
-                vat_amount = round((amount_pre_vat / total_net) * invoice_vat_total, 2)
-            elif invoice_vat_total != 0 and total_net == 0 and amount_pre_vat != 0:
-                # If total_net is 0 but we have amount_pre_vat, use it directly (preserve sign)
-                vat_amount = invoice_vat_total
-            elif vat_percentage != 0:
-                # Calculate from percentage (preserve sign - negative amount * positive % = negative VAT)
-                vat_amount = round(amount_pre_vat * vat_percentage / 100, 2)
-            else:
-                vat_amount = 0.0
-            
-            # Get vendor/customer name from invoice
-            invoice_to = invoice.get("invoice_to", "")
-            
-            transaction = {
-                "date": date,
-                "invoice_no": invoice_no,
-                "description": description,
-                "net_amount": round(amount_pre_vat, 2),
-                "vat_percentage": vat_percentage,
-                "vat_amount": vat_amount
-            }
-            
-            # Add vendor_name for purchases, customer_name for sales (only if not empty)
-            if transaction_type == "purchase" and invoice_to:
-                transaction["vendor_name"] = invoice_to
-            elif transaction_type == "sale" and invoice_to:
-                transaction["customer_name"] = invoice_to
-            
-            if vat_category in categories:
-                categories[vat_category]["transactions"].append(transaction)
-                categories[vat_category]["totals"]["net"] += amount_pre_vat
-                categories[vat_category]["totals"]["vat"] += vat_amount
-                
-                if transaction_type == "sale":
-                    vat_collected += vat_amount
-                    quarterly_breakdown[quarter]["vat_collected"] += vat_amount
-                else:
-                    vat_deductible += vat_amount
-                    quarterly_breakdown[quarter]["vat_deductible"] += vat_amount
-    
-    # Calculate quarterly VAT payable
-    for quarter in quarterly_breakdown:
-        q_vat_collected = quarterly_breakdown[quarter]["vat_collected"]
-        q_vat_deductible = quarterly_breakdown[quarter]["vat_deductible"]
-        quarterly_breakdown[quarter]["vat_payable"] = round(q_vat_collected - q_vat_deductible, 2)
-        quarterly_breakdown[quarter]["vat_collected"] = round(quarterly_breakdown[quarter]["vat_collected"], 2)
-        quarterly_breakdown[quarter]["vat_deductible"] = round(quarterly_breakdown[quarter]["vat_deductible"], 2)
-    
-    vat_payable = vat_collected - vat_deductible
-    
-    # Round all totals in categories
-    for cat_code, cat_data in categories.items():
-        cat_data["totals"]["net"] = round(cat_data["totals"]["net"], 2)
-        cat_data["totals"]["vat"] = round(cat_data["totals"]["vat"], 2)
+    # Transactions from one pass over the year; category totals and the quarterly
+    # breakdown from the materialized totals
+    aggregate = aggregate_invoices(invoices, totals=totals)
     
     return {
         "report_type": "vat_tax_return",
@@ -1308,13 +1213,9 @@ async def get_vat_report_yearly(user_id: str = Header(..., alias="X-User-ID"), y
             "company_vat": company_details.get("company_vat", "N/A") if company_details else "N/A",
             "reporting_period": f"{year} (January - December {year})"
         },
-        "quarterly_breakdown": quarterly_breakdown,
-        "categories": categories,
-        "vat_calculation": {
-            "vat_collected": round(vat_collected, 2),
-            "vat_deductible": round(vat_deductible, 2),
-            "vat_payable": round(vat_payable, 2)
-        }
+        "quarterly_breakdown": aggregate.quarterly_breakdown(year),
+        "categories": report_categories(aggregate, year, "", include_transactions),
+        "vat_calculation": aggregate.vat_calculation()
     }
 
 # ==================== MONTHLY VAT REPORT ====================
@@ -1359,8 +1260,15 @@ def normalize_month(month_str):
     return datetime.now().strftime("%b")
 
 @app.get("/vat-report-monthly")
-async def get_vat_report_monthly(user_id: str = Header(..., alias="X-User-ID"), year: str = "", month: str = ""):
-    """Get monthly VAT report for a specific month"""
+async def get_vat_report_monthly(user_id: str = Header(..., alias="X-User-ID"), year: str = "", month: str = "",
+                                 include_transactions: bool = True, debug: bool = True,
+                                 if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    """
+    Get monthly VAT report for a specific month.
+    With include_transactions=false only the totals are returned, plus a cursor per
+    category for paging through its transactions (/report-transactions).
+    With debug=false the _debug block is left out.
+    """
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing X-User-ID header")
 
@@ -1370,11 +1278,30 @@ async def get_vat_report_monthly(user_id: str = Header(..., alias="X-User-ID"),
     # Normalize month to abbreviated format (Jan, Feb, etc.)
     month = normalize_month(month)
 
-    # In-memory storage
+    return await cached_report("vat-report-monthly", user_id, year, report_cache_period(month, include_transactions, debug),
+                         if_none_match,
+                         lambda reader: build_vat_report_monthly(reader, user_id, year, month, include_transactions, debug))
+
+def invoice_counts(reader, user_id, year, months):
+    """
+    (invoices in the year, invoices in the given months) for the _debug blocks, from
+    the per-month invoice counts kept with the materialized totals (no invoice scan)
+    """
+    try:
+        invoice_totals = reader.get_invoice_totals(user_id, year)
+    except:
+        return 0, 0
+    total_invoices = sum(invoice_count for _, _, _, invoice_count in invoice_totals)
+    invoices_in_period = sum(invoice_count for month, _, _, invoice_count in invoice_totals if month in months)
+    return total_invoices, invoices_in_period
+
+def build_vat_report_monthly(reader, user_id, year, month, include_transactions=True, debug=True):
+    """Build the monthly VAT report from reader (a store snapshot)"""
+    # Read only the requested month (indexed by user, year and month)
     try:
-        data = user_vat_data.get(user_id, {}).get(year, {"invoices": []})
-        if not isinstance(data, dict) or "invoices" not in data:
-            data = {"invoices": []}
+        month_number = datetime.strptime(month, "%b").month
+        invoices = reader.get_invoices(user_id, year, months=[month_number]) if include_transactions else []
+        totals = reader.get_category_totals(user_id, year, months=[month_number])
     except:
         return {
             "report_type": "vat_tax_return",
@@ -1400,150 +1327,15 @@ async def get_vat_report_monthly(user_id: str = Header(..., alias="X-User-ID"),
     #         "notes": f"No data found for {month} {year}"
     #     }
 
-    # Get company details (pass in-memory storage)
-    company_details = get_user_company_details(user_id, storage_dict=user_company_details)
+    # Get company details from storage
+    company_details = get_user_company_details(user_id, store=reader)
     if company_details is None:
         company_details = {}
     
-    # Categorize transactions
-    categories = {
-        "1a": {"name": "Sales Taxed at Standard Rate (21%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1b": {"name": "Sales Taxed at Reduced Rate (9%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1c": {"name": "Sales Taxed at Other Rates (0%)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1d": {"name": "Private Use of Business Assets", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "1e": {"name": "Sales Exempt from VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "2a": {"name": "Reverse-Charge Supplies", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3a": {"name": "Supplies of Goods to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3b": {"name": "Supplies of Services to EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "3c": {"name": "Installation/Distance Sales to Private Individuals (EU)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4a": {"name": "Purchases of Goods From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4b": {"name": "Purchases of Services From EU Countries", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "4c": {"name": "Purchases of Goods from Non-EU Countries (Imports)", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5a": {"name": "Domestic purchases with Dutch VAT", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}},
-        "5b": {"name": "Input VAT on Domestic Purchases", "transactions": [], "totals": {"net": 0.0, "vat": 0.0}}
-    }
-    
-    vat_collected = 0.0
-    vat_deductible = 0.0
-    
-    for invoice in data.get("invoices", []):
-        dt = try_parse_date(invoice.get("date", ""))
-        if not dt: continue
-        
-        invoice_month = dt.strftime("%b")
-        if invoice_month != month: continue
-        
-        invoice_no = invoice.get("invoice_no", "")
-        date = invoice.get("date", "")
-        transaction_type = invoice.get("transaction_type", "sale")
-        
-        # Get invoice-level VAT amount (handle both string and numeric)
-        invoice_vat_total = normalize_amount(invoice.get("vat_amount", 0))
-        invoice_net_total = normalize_amount(invoice.get("subtotal", invoice.get("total_amount", 0)))
-        
-        # Process transactions
-        transactions_list = invoice.get("transactions", [])
-        if not transactions_list:
-            # If no transactions, create one from invoice-level data
-            transactions_list = [{
-                "description": invoice.get("invoice_to", "N/A"),
-                "amount_pre_vat": invoice_net_total,
-                "vat_percentage": "0%",
-                "vat_category": ""
-            }]
-        
-        # Distribute VAT proportionally if multiple transactions
-        total_net = sum(normalize_amount(tx.get("amount_pre_vat", 0)) for tx in transactions_list)
-        
-        # If total_net is 0 but invoice has amount (positive or negative), use invoice amount for single transaction
-        if total_net == 0 and invoice_net_total != 0 and len(transactions_list) == 1:
-            total_net = invoice_net_total
-        
-        for tx in transactions_list:
-            vat_category = tx.get("vat_category", "")
-            description = tx.get("description", "")
-            tx_amount = normalize_amount(tx.get("amount_pre_vat", 0))
-            
-            # CRITICAL FIX: Handle both positive and negative amounts (credit notes)
-            # Credit notes have negative amounts and must be preserved for correct VAT calculation
-            if tx_amount != 0:  # Use != 0 to handle both positive and negative
-                amount_pre_vat = tx_amount
-            elif invoice_net_total != 0:  # Use != 0 to handle both positive and negative
-                # Use invoice amount - distribute if multiple transactions
-                if len(transactions_list) == 1:
-                    amount_pre_vat = invoice_net_total
-                    # Update total_net for VAT calculation (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                else:
-                    # Multiple transactions - distribute invoice total proportionally (preserve sign)
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                    amount_pre_vat = invoice_net_total / len(transactions_list)
-            else:
-                amount_pre_vat = 0.0
-            
-            vat_percentage_str = tx.get("vat_percentage", "0")
-            vat_percentage = float(vat_percentage_str.replace("%", "")) if isinstance(vat_percentage_str, str) else float(vat_percentage_str)
-            
-            # Handle VAT calculation for both positive and negative amounts (credit notes)
-            # Credit notes have negative VAT that must be subtracted
-            if invoice_vat_total != 0 and total_net != 0:
-                # Distribute VAT proportionally (preserve sign for credit notes)
-                vat_amount = round((amount_pre_vat / total_net) * invoice_vat_total, 2)
-            elif invoice_vat_total != 0 and total_net == 0 and amount_pre_vat != 0:
-                # If total_net is 0 but we have amount_pre_vat, use it directly (preserve sign)
-                vat_amount = invoice_vat_total
-            elif vat_percentage != 0:
-                # Calculate from percentage (preserve sign - negative amount * positive % = negative VAT)
-                vat_amount = round(amount_pre_vat * vat_percentage / 100, 2)
-            else:
-                vat_amount = 0.0
-            
-            # Get vendor/customer name from invoice
-            invoice_to = invoice.get("invoice_to", "")
-            
-            transaction = {
-                "date": date,
-                "invoice_no": invoice_no,
-                "description": description,
-                "net_amount": round(amount_pre_vat, 2),
-                "vat_percentage": vat_percentage,
-                "vat_amount": vat_amount,
-                "vat_category": vat_category,
-                "vat_category_description": tx.get("vat_category_description", "")
-            }
-            
-            # Add vendor_name for purchases, customer_name for sales (only if not empty)
-            if transaction_type == "purchase" and invoice_to:
-                transaction["vendor_name"] = invoice_to
-            elif transaction_type == "sale" and invoice_to:
-                transaction["customer_name"] = invoice_to
-            
-            if vat_category in categories:
-                categories[vat_category]["transactions"].append(transaction)
-                categories[vat_category]["totals"]["net"] += amount_pre_vat
-                categories[vat_category]["totals"]["vat"] += vat_amount
-                
-                if transaction_type == "sale":
-                    vat_collected += vat_amount
-                else:
-                    vat_deductible += vat_amount
-    
-    vat_payable = vat_collected - vat_deductible
+    # Transactions from the month's invoices, totals from the materialized totals
+    aggregate = aggregate_invoices(invoices, totals=totals)
     
-    # Round all totals in categories
-    for cat_code, cat_data in categories.items():
-        cat_data["totals"]["net"] = round(cat_data["totals"]["net"], 2)
-        cat_data["totals"]["vat"] = round(cat_data["totals"]["vat"], 2)
-    
-    # Debug: Check if we have any invoices
-    total_invoices = len(data.get("invoices", []))
-    invoices_in_month = sum(1 for inv in data.get("invoices", []) 
-                           if try_parse_date(inv.get("date", "")) and 
-                           try_parse_date(inv.get("date", "")).strftime("%b") == month)
-    
-    return {
+    report = {
         "report_type": "vat_tax_return",
         "period": f"{month} {year}",
         "generated_at": datetime.now().isoformat(),
@@ -1552,35 +1344,281 @@ async def get_vat_report_monthly(user_id: str = Header(..., alias="X-User-ID"),
             "company_vat": company_details.get("company_vat", "N/A") if company_details else "N/A",
             "reporting_period": f"{month} {year}"
         },
-        "categories": categories,
-        "vat_calculation": {
-            "vat_collected": round(vat_collected, 2),
-            "vat_deductible": round(vat_deductible, 2),
-            "vat_payable": round(vat_payable, 2)
-        },
-        "_debug": {
+        "categories": report_categories(aggregate, year, month, include_transactions),
+        "vat_calculation": aggregate.vat_calculation(month_number)
+    }
+    if debug:
+        total_invoices, invoices_in_month = invoice_counts(reader, user_id, year, [month_number])
+        report["_debug"] = {
             "total_invoices_in_year": total_invoices,
             "invoices_in_month": invoices_in_month,
             "month_requested": month,
             "year_requested": year
         }
+    return report
+
+# ==================== TRANSACTION PAGES ====================
+
+# Transactions per page of /report-transactions (default and maximum)
+TRANSACTION_PAGE_SIZE = 100
+MAX_TRANSACTION_PAGE_SIZE = 1000
+
+MONTH_ABBREVIATIONS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+def normalize_report_period(period):
+    """Normalize a report period: "" (whole year), "Q1".."Q4" or a month abbreviation (Jan, Feb, etc.); other values are kept"""
+    period = str(period or "").strip()
+    if not period or period.lower() == "year":
+        return ""
+    if period.upper() in ("Q1", "Q2", "Q3", "Q4"):
+        return period.upper()
+    for number, abbreviation in enumerate(MONTH_ABBREVIATIONS, 1):
+        if period.lower() in (str(number), f"{number:02d}", abbreviation.lower(),
+                              datetime(2000, number, 1).strftime("%B").lower()):
+            return abbreviation
+    # Not a quarter or month: kept as is, so it selects no months (empty, like the reports)
+    return period
+
+def report_period_months(period):
+    """(aggregation period key, month numbers) of a normalized report period"""
+    if not period:
+        return "year", list(range(1, 13))
+    if period in MONTH_ABBREVIATIONS:
+        month_number = MONTH_ABBREVIATIONS.index(period) + 1
+        return month_number, [month_number]
+    # Q1..Q4; anything else (e.g. quarter=1 or quarter=X) has no months: an empty report
+    return period, get_quarter_month_numbers(period)
+
+def report_cache_period(period, include_transactions=True, debug=True):
+    """Report cache key part: totals-only reports and reports without _debug are cached separately"""
+    options = tuple(name for name, enabled in (("totals", not include_transactions), ("no-debug", not debug)) if enabled)
+    return (period, *options) if options else period
+
+def encode_cursor(year, period, category, after=None):
+    """Opaque cursor for /report-transactions: the listing and the sort key of the last transaction returned"""
+    data = json.dumps([year, period, category, after], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Decode a cursor into (year, period, category, after); raises HTTPException 400 if it's invalid"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        year, period, category, after = json.loads(data)
+        if after is not None:
+            month, date_iso, invoice_no, source_file, index = after
+            if not (isinstance(month, int) and isinstance(index, int)
+                    and all(isinstance(value, str) for value in (date_iso, invoice_no, source_file))):
+                raise ValueError("Invalid sort key")
+            after = tuple(after)
+        return str(year), str(period), str(category), after
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def report_categories(aggregate, year, period, include_transactions=True):
+    """
+    Categories of a report. Without transactions each category gets a next_cursor
+    for its first transaction page (None if it has no transactions).
+    """
+    period_key, _ = report_period_months(period)
+    categories = aggregate.category_report(period_key, include_category_fields=bool(period),
+                                           include_transactions=include_transactions)
+    if not include_transactions:
+        for code, category in categories.items():
+            category["next_cursor"] = encode_cursor(year, period, code) if category["transaction_count"] else None
+    return categories
+
+@app.get("/report-transactions")
+async def get_report_transactions(user_id: str = Header(..., alias="X-User-ID"), year: str = "", period: str = "",
+                                  category: str = "", cursor: str = "", limit: int = TRANSACTION_PAGE_SIZE,
+                                  if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    """
+    Page through the transactions of one report category in (date, invoice_no) order.
+
+    period: empty for the whole year, Q1-Q4 or a month (Jan, 1, january, ...). Pass a
+    next_cursor from a totals-only report or from the previous page as cursor (it
+    already contains year, period and category); next_cursor is null on the last page.
+    """
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing X-User-ID header")
+
+    if cursor:
+        year, period, category, after = decode_cursor(cursor)
+        period = normalize_report_period(period)
+    else:
+        if not year:
+            year = str(datetime.now().year)
+        period = normalize_report_period(period)
+        after = None
+
+    if category not in VAT_CATEGORY_NAMES:
+        raise HTTPException(status_code=400, detail=f"Unknown VAT category: {category}")
+
+    limit = max(1, min(limit, MAX_TRANSACTION_PAGE_SIZE))
+    return await cached_report("report-transactions", user_id, year, (period, category, after, limit), if_none_match,
+                         lambda reader: build_transaction_page(reader, user_id, year, period, category, after, limit))
+
+def build_transaction_page(reader, user_id, year, period, category, after=None, limit=TRANSACTION_PAGE_SIZE):
+    """
+    Build one page of a category's transactions. Months are read one at a time from
+    the month of the cursor on, only until the page is full.
+    """
+    _, months = report_period_months(period)
+    lines = []
+    for month in months:
+        if after is not None and month < after[0]:
+            continue
+        aggregate = VatAggregate()
+        for invoice in reader.get_invoices(user_id, year, months=[month]):
+            aggregate.add_invoice(invoice, accumulate=False)
+        lines.extend(aggregate.sorted_lines(category, after))
+        if len(lines) > limit:
+            break
+
+    page = lines[:limit]
+    return {
+        "period": f"{period} {year}" if period else year,
+        "category": category,
+        "name": VAT_CATEGORY_NAMES[category],
+        # The yearly report lists transactions without their category fields
+        "transactions": [report_transaction(line, include_category_fields=bool(period)) for line in page],
+        "next_cursor": encode_cursor(year, period, category, list(page[-1]["sort_key"])) if len(lines) > limit else None
     }
 
+# ==================== STREAMED REPORTS ====================
+
+# Streamed reports are written in chunks of about this size
+STREAM_CHUNK_BYTES = 64 * 1024
+
+def dump_json(value):
+    """Serialize a value like JSONResponse does (streamed and buffered reports are byte-identical)"""
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+class SnapshotStreamingResponse(StreamingResponse):
+    """StreamingResponse whose body is read from a store snapshot; the snapshot is closed when the response ends"""
+
+    def __init__(self, snapshot, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.snapshot = snapshot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Also when the client disconnected before (or while) the body was sent
+            self.snapshot.close()
+
+async def streamed_report(endpoint, user_id, year, period, if_none_match, build_summary, months, include_category_fields):
+    """
+    Stream a full report. build_summary(reader) builds the report without transactions
+    (from the materialized totals) on the worker pool before the response starts, so a
+    full pool is a 503 like for the other reports; the transactions are then written
+    category by category while the invoices are read from the same snapshot.
+    Same ETag as the buffered report.
+
+    The snapshot stays open while the body is sent and is closed by the response
+    when it ends, also if the client disconnects early.
+    """
+    reader = store.snapshot(user_id)
+    try:
+        _, headers = report_key_headers(endpoint, user_id, year, period, reader.data_version)
+        if etag_matches(if_none_match, headers["ETag"]):
+            reader.close()
+            return Response(status_code=304, headers=headers)
+        report = await shielded(run_in_worker(build_summary, reader))
+    except BaseException:
+        reader.close()
+        raise
+
+    chunks = iterate_in_threadpool(iter_report_chunks(report, reader, user_id, year, months, include_category_fields))
+    return SnapshotStreamingResponse(reader, chunks, media_type="application/json", headers=headers)
+
+def iter_report_chunks(report, reader, user_id, year, months, include_category_fields):
+    """Join the parts of the report document into UTF-8 chunks of about STREAM_CHUNK_BYTES"""
+    buffer = []
+    size = 0
+    for part in iter_report_json_parts(report, reader, user_id, year, months, include_category_fields):
+        buffer.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_BYTES or part == "{":
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+def iter_report_json_parts(report, reader, user_id, year, months, include_category_fields):
+    """Generate the report document piece by piece; one store pass per category with transactions"""
+    yield "{"
+    for i, (key, value) in enumerate(report.items()):
+        yield ("," if i else "") + dump_json(key) + ":"
+        if key != "categories":
+            yield dump_json(jsonable_encoder(value))
+            continue
+
+        yield "{"
+        for j, (code, category) in enumerate(value.items()):
+            yield ("," if j else "") + dump_json(code) + ":{" + '"name":' + dump_json(category["name"]) + ',"transactions":['
+            if category.get("transaction_count"):
+                invoices = reader.iter_invoices(user_id, year, months=months, vat_category=code)
+                for k, transaction in enumerate(iter_category_transactions(invoices, code, include_category_fields)):
+                    yield ("," if k else "") + dump_json(transaction)
+            yield '],"totals":' + dump_json(category["totals"]) + "}"
+        yield "}"
+    yield "}"
+
+# ==================== EVENTS ====================
+
+# A comment line is sent when nothing else was, so proxies keep the connection open
+EVENT_KEEPALIVE_SECONDS = 15
+
+@app.get("/events")
+async def user_event_stream(
+    user_id: Optional[str] = Header(None, alias="X-User-ID"),
+    user_id_param: str = Query("", alias="user_id")
+):
+    """
+    Server-sent events for one user (text/event-stream)
+    
+    **Events:**
+    - `connected`: sent first; refetch anything that may have changed while disconnected
+    - `progress`: counts of a running upload (`source`, `job_id`, `processed`, `stored`, `skipped`, `errors`, `done`)
+    - `invalidate`: data changed; `years` and `months` (`{"2025": [1, 3]}`) to refetch, or `cleared: true`
+    - `reset`: events were missed (client too slow); refetch everything
+    
+    **User:**
+    `X-User-ID` header, or `?user_id=` for browser `EventSource` (which can't send headers)
+    """
+    user_id = user_id or user_id_param
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing X-User-ID header")
+    
+    async def stream():
+        # Unsubscribed when the client disconnects (the response cancels this generator)
+        with user_events.subscribe(user_id) as subscription:
+            yield "retry: 3000\nevent: connected\ndata: {}\n\n"
+            while True:
+                message = await subscription.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                yield message if message is not None else ": keep-alive\n\n"
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/event-stats")
+async def get_event_stats():
+    """Connected event subscribers and published event count"""
+    return user_events.stats()
+
 # ==================== HEALTH CHECK ====================
 
 @app.delete("/clear-user-data")
 async def clear_user_data(user_id: str = Header(..., alias="X-User-ID")):
-    """Clear all stored data for a user (in-memory storage only)"""
+    """Clear all stored data for a user"""
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing X-User-ID header")
     
-    # Clear in-memory storage
-    if user_id in user_vat_data:
-        del user_vat_data[user_id]
-    if user_id in user_company_details:
-        del user_company_details[user_id]
-    if user_id in user_pdf_count:
-        user_pdf_count[user_id] = 0
+    async with user_write_lock(user_id):
+        store.clear_user(user_id)
+    user_events.publish(user_id, "invalidate", {"source": "clear-user-data", "cleared": True, "years": [], "months": {}})
     
     return {
         "status": "success",
@@ -1592,8 +1630,33 @@ async def clear_user_data(user_id: str = Header(..., alias="X-User-ID")):
         }
     }
 
+@app.get("/check-totals")
+async def check_totals_endpoint(user_id: str = Header(..., alias="X-User-ID"), year: str = ""):
+    """Consistency check: compare the stored report totals of a year against a full recompute from the invoices"""
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing X-User-ID header")
+
+    if not year:
+        year = str(datetime.now().year)
+
+    mismatches = await run_in_worker(check_user_totals, user_id, year)
+    if mismatches:
+        print(f"⚠️ Totals mismatch for user {user_id}, year {year}: {len(mismatches)} row(s)")
+
+    return {
+        "year": year,
+        "consistent": not mismatches,
+        "mismatches": mismatches
+    }
+
+def check_user_totals(user_id, year):
+    """check_totals on a snapshot (on the worker pool): uploads running meanwhile are no mismatch"""
+    with store.snapshot(user_id) as reader:
+        return check_totals(reader, user_id, year)
+
 @app.get("/dreport")
-async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str = "", quarter: str = ""):
+async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str = "", quarter: str = "",
+                     debug: bool = True, if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
     """
     Generate VAT return report in Dutch tax authority format (Dreport)
     
@@ -1603,6 +1666,7 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
     Query Parameters:
     - year: Year (e.g., "2025")
     - quarter: Quarter (e.g., "Q1", "Q2", "Q3", "Q4")
+    - debug: Include the _debug block (default: true)
     
     Returns:
     - report_meta: Report metadata (company info, period, etc.)
@@ -1627,16 +1691,23 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
     else:
         quarter = quarter.upper()
 
-    # Get data from storage
+    # The submission date is part of the cache key: a cached Dreport is never from an earlier day
+    submission_date = datetime.now().strftime("%Y-%m-%d")
+    return await cached_report("dreport", user_id, year, (report_cache_period(quarter, debug=debug), submission_date),
+                         if_none_match,
+                         lambda reader: build_dreport(reader, user_id, year, quarter, debug, submission_date))
+
+def build_dreport(reader, user_id, year, quarter, debug=True, submission_date=None):
+    """Build the Dreport (Dutch tax authority format) from reader (a store snapshot)"""
+    # Get the materialized totals from storage (no invoice scan)
+    quarter_month_numbers = get_quarter_month_numbers(quarter)
     try:
-        data = user_vat_data.get(user_id, {}).get(year, {"invoices": []})
-        if not isinstance(data, dict) or "invoices" not in data:
-            data = {"invoices": []}
+        totals = reader.get_category_totals(user_id, year, months=quarter_month_numbers)
     except:
-        data = {"invoices": []}
+        totals = []
     
     # Get company details
-    company_details = get_user_company_details(user_id, storage_dict=user_company_details)
+    company_details = get_user_company_details(user_id, store=reader)
     if company_details is None:
         company_details = {}
     
@@ -1650,146 +1721,9 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
     
     target_months = quarter_months.get(quarter, [])
     
-    # Initialize category totals - using the new format codes
-    category_totals = {
-        "1a": {"net_amount": 0.0, "vat": 0.0},  # Standard rate (21%)
-        "1b": {"net_amount": 0.0, "vat": 0.0},  # Reduced rate (9%)
-        "1c": {"net_amount": 0.0, "vat": 0.0},  # Other rates (not 0%)
-        "1d": {"net_amount": 0.0, "vat": 0.0},  # Private use
-        "1e": {"net_amount": 0.0, "vat": 0.0},  # 0% or not taxed
-        "2a": {"net_amount": 0.0, "vat": 0.0},  # Reverse charge
-        "3a": {"net_amount": 0.0, "vat": 0.0},  # Exports (non-EU)
-        "3b": {"net_amount": 0.0, "vat": 0.0},  # EU supplies
-        "3c": {"net_amount": 0.0, "vat": 0.0},  # Installation/distance sales
-        "4a": {"net_amount": 0.0, "vat": 0.0},  # Purchases from non-EU
-        "4b": {"net_amount": 0.0, "vat": 0.0},  # Purchases from EU
-        "5a": {"net_amount": 0.0, "vat": 0.0},  # Domestic purchases with Dutch VAT
-        "5b": {"net_amount": 0.0, "vat": 0.0},  # Input VAT (deductible) - backward compatibility
-    }
-    
-    # Process invoices
-    invoices_processed = 0
-    invoices_skipped = 0
-    
-    for invoice in data.get("invoices", []):
-        dt = try_parse_date(invoice.get("date", ""))
-        if not dt: 
-            invoices_skipped += 1
-            continue
-        
-        month = dt.strftime("%b")
-        if month not in target_months: 
-            invoices_skipped += 1
-            continue
-        
-        invoices_processed += 1
-        transaction_type = invoice.get("transaction_type", "sale")
-        invoice_vat_total = normalize_amount(invoice.get("vat_amount", 0))
-        invoice_net_total = normalize_amount(invoice.get("subtotal", invoice.get("total_amount", 0)))
-        
-        # Process transactions
-        transactions_list = invoice.get("transactions", [])
-        if not transactions_list:
-            # If no transactions, create one from invoice-level data
-            # Try to get VAT percentage from invoice if available
-            invoice_vat_percentage = invoice.get("vat_percentage", "0")
-            if isinstance(invoice_vat_percentage, str):
-                invoice_vat_percentage = invoice_vat_percentage.replace("%", "").strip()
-            try:
-                invoice_vat_pct = float(invoice_vat_percentage)
-            except:
-                invoice_vat_pct = 0.0
-            
-            transactions_list = [{
-                "description": invoice.get("invoice_to", "N/A"),
-                "amount_pre_vat": invoice_net_total,
-                "vat_percentage": f"{invoice_vat_pct}%",
-                "vat_category": ""  # Will be determined from transaction type and VAT percentage
-            }]
-        
-        total_net = sum(normalize_amount(tx.get("amount_pre_vat", 0)) for tx in transactions_list)
-        if total_net == 0 and invoice_net_total != 0 and len(transactions_list) == 1:
-            total_net = invoice_net_total
-        
-        for tx in transactions_list:
-            vat_category = tx.get("vat_category", "")
-            tx_amount = normalize_amount(tx.get("amount_pre_vat", 0))
-            
-            if tx_amount != 0:
-                amount_pre_vat = tx_amount
-            elif invoice_net_total != 0:
-                if len(transactions_list) == 1:
-                    amount_pre_vat = invoice_net_total
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                else:
-                    if total_net == 0:
-                        total_net = invoice_net_total
-                    amount_pre_vat = invoice_net_total / len(transactions_list)
-            else:
-                amount_pre_vat = 0.0
-            
-            vat_percentage_str = tx.get("vat_percentage", "0")
-            vat_percentage = float(vat_percentage_str.replace("%", "")) if isinstance(vat_percentage_str, str) else float(vat_percentage_str)
-            
-            # Calculate VAT amount
-            if invoice_vat_total != 0 and total_net != 0:
-                vat_amount = round((amount_pre_vat / total_net) * invoice_vat_total, 2)
-            elif invoice_vat_total != 0 and total_net == 0 and amount_pre_vat != 0:
-                vat_amount = invoice_vat_total
-            elif vat_percentage != 0:
-                vat_amount = round(amount_pre_vat * vat_percentage / 100, 2)
-            else:
-                vat_amount = 0.0
-            
-            # Use provided VAT Category (NL) Code directly - no remapping needed
-            # The category code is already provided in the correct format
-            target_code = vat_category
-            
-            # Only do remapping if category is empty or invalid (fallback for backward compatibility)
-            if not target_code or target_code not in category_totals:
-                # EU country codes for fallback mapping
-                eu_countries = ["DE", "FR", "BE", "IT", "ES", "PL", "RO", "NL", "GR", "PT", "CZ", "HU", 
-                               "SE", "AT", "BG", "DK", "FI", "IE", "HR", "LT", "LV", "SK", "SI", "EE", 
-                               "CY", "LU", "MT"]
-                
-                invoice_country = invoice.get("country", "").upper()
-                
-                if transaction_type == "sale":
-                    # Default mapping for sales based on VAT percentage
-                    if vat_percentage == 21:
-                        target_code = "1a"
-                    elif vat_percentage == 9:
-                        target_code = "1b"
-                    elif vat_percentage == 0:
-                        # Check country for 0% sales
-                        if invoice_country in eu_countries and invoice_country != "NL":
-                            target_code = "3b"
-                        elif invoice_country and invoice_country not in eu_countries:
-                            target_code = "3a"
-                        else:
-                            target_code = "1e"
-                    else:
-                        target_code = "1c"  # Other rates (not 0%, 9%, or 21%)
-                else:
-                    # Purchase - default mapping
-                    if "reverse" in str(vat_category).lower() or "reverse-charge" in str(vat_category).lower():
-                        target_code = "2a"
-                    elif "eu" in str(vat_category).lower() or invoice_country in eu_countries:
-                        target_code = "4b"
-                    elif "import" in str(vat_category).lower() or (invoice_country and invoice_country not in eu_countries):
-                        target_code = "4a"
-                    else:
-                        # Default to 5a for domestic purchases with VAT, 5b for backward compatibility
-                        if vat_amount > 0:
-                            target_code = "5a"
-                        else:
-                            target_code = "5b"
-            
-            # Add to totals
-            if target_code and target_code in category_totals:
-                category_totals[target_code]["net_amount"] += amount_pre_vat
-                category_totals[target_code]["vat"] += vat_amount
+    # Category totals in integer cents; lines with empty or unknown VAT Category (NL)
+    # Codes were remapped at ingest (see aggregation.get_dreport_code)
+    category_totals = aggregate_invoices([], totals=totals).dreport_totals(quarter)
     
     # Calculate section 5 totals
     # 5a: Turnover Tax (sum of sections 1-4 VAT)
@@ -1808,15 +1742,15 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
     # Total: Same as 5c (final VAT payable)
     vat_total = vat_5c
     
-    # Round all values
+    # Convert all values from cents
     for code in category_totals:
-        category_totals[code]["net_amount"] = round(category_totals[code]["net_amount"], 2)
-        category_totals[code]["vat"] = round(category_totals[code]["vat"], 2)
+        category_totals[code]["net_amount"] = cents_to_amount(category_totals[code]["net_amount"])
+        category_totals[code]["vat"] = cents_to_amount(category_totals[code]["vat"])
     
-    vat_5a = round(vat_5a, 2)
-    vat_5b = round(vat_5b, 2)
-    vat_5c = round(vat_5c, 2)
-    vat_total = round(vat_total, 2)
+    vat_5a = cents_to_amount(vat_5a)
+    vat_5b = cents_to_amount(vat_5b)
+    vat_5c = cents_to_amount(vat_5c)
+    vat_total = cents_to_amount(vat_total)
     
     # Build report structure
     report_meta = {
@@ -1825,7 +1759,7 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
         "company_name": company_details.get("company_name", "N/A") if company_details else "N/A",
         "vat_number": company_details.get("company_vat", "N/A") if company_details else "N/A",
         "period": f"{quarter} {year}",
-        "submission_date": datetime.now().strftime("%Y-%m-%d")
+        "submission_date": submission_date or datetime.now().strftime("%Y-%m-%d")
     }
     
     sections = [
@@ -1969,21 +1903,25 @@ async def get_dreport(user_id: str = Header(..., alias="X-User-ID"), year: str =
         }
     ]
     
-    # Debug info (can be removed in production)
-    debug_info = {
-        "total_invoices_in_year": len(data.get("invoices", [])),
-        "invoices_in_quarter": invoices_processed,
-        "invoices_skipped": invoices_skipped,
-        "target_months": target_months,
-        "quarter_requested": quarter,
-        "year_requested": year
-    }
-    
-    return {
+    report = {
         "report_meta": report_meta,
-        "sections": sections,
-        "_debug": debug_info  # Remove this in production if not needed
+        "sections": sections
     }
+    
+    # Debug info (opt out with debug=false)
+    if debug:
+        # Invoices outside the quarter or with unparseable dates are skipped
+        total_invoices, invoices_processed = invoice_counts(reader, user_id, year, quarter_month_numbers)
+        report["_debug"] = {
+            "total_invoices_in_year": total_invoices,
+            "invoices_in_quarter": invoices_processed,
+            "invoices_skipped": total_invoices - invoices_processed,
+            "target_months": target_months,
+            "quarter_requested": quarter,
+            "year_requested": year
+        }
+    
+    return report
 
 @app.get("/health")
 async def health_check():
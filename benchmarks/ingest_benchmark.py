@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Ingest benchmark for /process-invoices
+
+Feeds N generated invoices through process_invoices_simple in upload-sized
+batches and reports the time per invoice. With the duplicate-detection index
+the time per invoice stays flat as the store grows (linear total time); the
+previous per-invoice scan over the stored year made it grow with N.
+
+Run from the project root:
+    python benchmarks/ingest_benchmark.py
+    python benchmarks/ingest_benchmark.py --sizes 10000 100000 1000000 --backend sqlite
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")  # don't create vat_data.db on import
+
+import app
+from storage import get_store
+
+CATEGORY_CODES = ["1a", "1b", "1c", "2a", "3a", "3b", "4a", "4b", "5b"]
+
+
+def generate_invoices(start, count):
+    """Generate `count` unique invoices in the /process-invoices input format"""
+    invoices = []
+    for i in range(start, start + count):
+        month = i % 12 + 1
+        invoices.append({
+            "date": f"2025-{month:02d}-{i % 28 + 1:02d}",
+            "type": "Sales" if i % 2 else "Purchase",
+            "net_amount": 100.0 + i % 1000,
+            "vat_amount": 21.0,
+            "vat_percentage": "21",
+            "description": f"Benchmark invoice {i}",
+            "vendor_name": "Benchmark Vendor",
+            "customer_name": "Benchmark Customer",
+            "file_name": f"INV_{i}.pdf",
+            "invoice_number": f"NO-{i}",
+            "VAT Category (NL) Code": CATEGORY_CODES[i % len(CATEGORY_CODES)],
+            "VAT Category (NL) Description": "Benchmark category"
+        })
+    return invoices
+
+
+def run_size(size, backend, batch_size, tmp_dir):
+    """Ingest `size` invoices into a fresh store, return (total seconds, seconds of the last batch, last batch size)"""
+    db_path = os.path.join(tmp_dir, f"bench_{size}.db")
+    app.store = get_store(backend, db_path)
+    
+    total = 0.0
+    last = 0.0
+    last_count = 0
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        batch = generate_invoices(start, count)
+        t0 = time.perf_counter()
+        result = asyncio.run(app.process_invoices_simple(user_id="bench_user", invoices=batch))
+        elapsed = time.perf_counter() - t0
+        if result["details"]["processed"] != count:
+            raise RuntimeError(f"Expected {count} processed invoices, got {result['details']}")
+        total += elapsed
+        last, last_count = elapsed, count
+    
+    # Re-uploading the last batch must be detected as duplicates
+    t0 = time.perf_counter()
+    result = asyncio.run(app.process_invoices_simple(user_id="bench_user", invoices=batch))
+    reupload = time.perf_counter() - t0
+    if result["details"]["skipped"] != len(batch):
+        raise RuntimeError(f"Expected {len(batch)} duplicates, got {result['details']}")
+    return total, last, last_count, reupload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+    
+    print(f"🏁 Ingest benchmark ({args.backend} backend, batches of {args.batch_size})")
+    print(f"{'invoices':>10} {'total s':>9} {'us/invoice':>11} {'last batch us/inv':>18} {'re-upload us/inv':>17}")
+    
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            total, last, last_count, reupload = run_size(size, args.backend, args.batch_size, tmp_dir)
+            per_invoice = total / size * 1e6
+            baseline = baseline or per_invoice
+            print(f"{size:>10} {total:>9.2f} {per_invoice:>11.1f} {last / last_count * 1e6:>18.1f} "
+                  f"{reupload / last_count * 1e6:>17.1f}   ({per_invoice / baseline:.2f}x per invoice vs smallest)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for parse_multiple_json_objects
+
+Compares the previous character-by-character scanner (kept below as
+legacy_parse_multiple_json_objects) with the raw_decode-based parser on
+multi-megabyte inputs in the concatenated {...}{...} and NDJSON formats.
+
+Run from the project root:
+    python benchmarks/json_parse_benchmark.py
+    python benchmarks/json_parse_benchmark.py --sizes-mb 1 10 50 --repeat 3
+"""
+
+import argparse
+import gc
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from json_stream import JsonObjectStream, parse_json_objects
+
+
+def legacy_parse_multiple_json_objects(text):
+    """The scanner parse_multiple_json_objects used before (reference implementation)"""
+    objects = []
+    text = text.strip()
+
+    if not text:
+        return objects
+
+    depth = 0
+    start = -1
+    in_string = False
+    escape_next = False
+
+    for i, char in enumerate(text):
+        if escape_next:
+            escape_next = False
+            continue
+
+        if char == '\\':
+            escape_next = True
+            continue
+
+        if char == '"' and not escape_next:
+            in_string = not in_string
+            continue
+
+        if not in_string:
+            if char == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0 and start >= 0:
+                    json_str = text[start:i+1]
+                    try:
+                        obj = json.loads(json_str)
+                        objects.append(obj)
+                    except json.JSONDecodeError:
+                        pass
+                    start = -1
+
+    return objects
+
+
+def generate_text(size_mb, separator):
+    """Generate about size_mb MB of extracted invoices (json_results format) joined by separator"""
+    parts = []
+    size = 0
+    i = 0
+    while size < size_mb * 1024 * 1024:
+        part = json.dumps({
+            "invoice_no": f"INV-{i:07d}",
+            "date": f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}",
+            "invoice_to": "Café \"De Hoek\" B.V., Prinsengracht 263, 1016 GV Amsterdam, Netherlands",
+            "country": "NL",
+            "vat_no": f"NL{i:09d}B01",
+            "transactions": [
+                {"description": f"Consulting services {{project {i % 50}}}, {i % 40 + 1} hours at EUR 95.00/hour "
+                                "as agreed in the framework contract of January 2025",
+                 "amount_pre_vat": 100.0 + i % 1000, "vat_percentage": "21%", "vat_category": "1a"}
+            ],
+            "subtotal": 100.0 + i % 1000,
+            "vat_amount": 21.0,
+            "total_amount": 121.0 + i % 1000,
+            "transaction_type": "sale",
+            "source_file": f"invoice_{i:07d}.pdf"
+        }, ensure_ascii=False)
+        parts.append(part)
+        size += len(part) + len(separator)
+        i += 1
+    return separator.join(parts), i
+
+
+def timed(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        # Each run starts without the previous run's objects (the garbage collector would scan them)
+        result = None
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (best is reported)")
+    parser.add_argument("--chunk-kb", type=int, default=64, help="chunk size for the streaming run")
+    args = parser.parse_args()
+
+    print(f"{'format':>12} {'size':>8} {'objects':>9} {'legacy MB/s':>12} {'raw_decode MB/s':>16} "
+          f"{'stream MB/s':>12} {'speedup':>8}")
+    for size_mb in args.sizes_mb:
+        for name, separator in (("concatenated", ""), ("ndjson", "\n")):
+            text, count = generate_text(size_mb, separator)
+            data = text.encode("utf-8")
+            mb = len(data) / (1024 * 1024)
+
+            legacy_time, legacy_objects = timed(lambda: legacy_parse_multiple_json_objects(text), args.repeat)
+            new_time, (new_objects, _) = timed(lambda: parse_json_objects(text), args.repeat)
+
+            def stream():
+                stream_parser = JsonObjectStream()
+                chunk = args.chunk_kb * 1024
+                objects = 0
+                for i in range(0, len(data), chunk):
+                    objects += len(stream_parser.feed(data[i:i + chunk]))
+                return objects + len(stream_parser.close())
+            stream_time, stream_count = timed(stream, args.repeat)
+
+            assert len(legacy_objects) == len(new_objects) == stream_count == count
+            assert legacy_objects == new_objects
+            print(f"{name:>12} {mb:>6.1f}MB {count:>9} {mb / legacy_time:>12.1f} {mb / new_time:>16.1f} "
+                  f"{mb / stream_time:>12.1f} {legacy_time / new_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
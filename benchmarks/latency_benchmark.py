@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark: small requests while large reports are built
+
+Stores N generated invoices for one user, then (on one event loop, through the
+ASGI app) keeps requesting that user's full yearly report - with the report
+cache off, so every request rebuilds it - while probing /health and another
+user's small monthly report every few milliseconds. Reports probe latency
+percentiles with the report work on the event loop (VAT_WORKER_THREADS=0, the
+previous behaviour) and on the worker pool, next to an idle baseline.
+
+Probes are sent on a fixed schedule, each as its own task (open loop), and
+their latency is measured from the time they were due, so probes that couldn't
+even be sent while the event loop was blocked count as slow.
+
+Run from the project root:
+    python benchmarks/latency_benchmark.py
+    python benchmarks/latency_benchmark.py --invoices 100000 --seconds 10 --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")  # don't create vat_data.db on import
+
+import app
+from report_cache import ReportCache
+from storage import get_store
+from worker_pool import WorkerPool
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from ingest_benchmark import generate_invoices
+
+PROBES = {"health": "/health", "monthly": "/vat-report-monthly?year=2025&month=Mar"}
+
+
+async def request(path, user_id):
+    """GET path through the ASGI app; returns the status code"""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"x-user-id", user_id.encode())], "server": ("bench", 80), "client": ("bench", 1),
+    }
+    sent = False
+    disconnect = asyncio.Event()
+    status = []
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await asyncio.sleep(0)  # like reading the request from a socket: other tasks may run
+    await app.app(scope, receive, send)
+    disconnect.set()
+    return status[0]
+
+
+async def heavy_reports(stop, concurrency, durations):
+    """Request the big user's yearly report back to back until stop is set"""
+    async def loop():
+        while not stop.is_set():
+            start = time.perf_counter()
+            status = await request("/vat-report-yearly?year=2025", "big_user")
+            if status != 200:
+                raise RuntimeError(f"Yearly report failed: {status}")
+            durations.append(time.perf_counter() - start)
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+
+
+async def probe(seconds, interval, heavy_concurrency):
+    """
+    Probe latencies ({probe: [seconds]}) during `seconds` with heavy_concurrency report
+    loops running, and the durations of the reports
+    """
+    stop = asyncio.Event()
+    durations = []
+    heavy = asyncio.create_task(heavy_reports(stop, heavy_concurrency, durations)) if heavy_concurrency else None
+    latencies = {name: [] for name in PROBES}
+
+    async def send_probe(name, due):
+        if await request(PROBES[name], "small_user") != 200:
+            raise RuntimeError(f"Probe {name} failed")
+        latencies[name].append(time.perf_counter() - due)
+
+    names = list(PROBES)
+    count = int(seconds / interval)
+    probes = []
+    start = time.perf_counter()
+    while len(probes) < count:
+        # Send every probe that is due (all at once if the event loop was blocked)
+        now = time.perf_counter()
+        while len(probes) < count and start + len(probes) * interval <= now:
+            i = len(probes)
+            probes.append(asyncio.create_task(send_probe(names[i % len(names)], start + i * interval)))
+        if len(probes) < count:
+            await asyncio.sleep(start + len(probes) * interval - now)
+    await asyncio.gather(*probes)
+    stop.set()
+    if heavy:
+        await heavy
+    return latencies, durations
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices", type=int, default=50000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--interval-ms", type=float, default=5.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=2, help="yearly reports requested at the same time")
+    args = parser.parse_args()
+
+    app.store = get_store("memory")
+    app.report_cache = ReportCache(max_bytes=0)
+    for start in range(0, args.invoices, 1000):
+        batch = generate_invoices(start, min(1000, args.invoices - start))
+        app.store_invoice_batch("big_user", batch)
+    app.store_invoice_batch("small_user", generate_invoices(0, 120))
+
+    print(f"{args.invoices} invoices, {args.concurrency} yearly reports at a time, probes every {args.interval_ms:g} ms")
+    header = "".join(f" {name + ' p50':>12} {name + ' p99':>12}" for name in PROBES)
+    print(f"{'mode':<12} {'probes':>7}{header} {'reports':>8} {'report s':>9}   (latencies in ms)")
+    modes = [("idle", 0, 0), ("event loop", 0, args.concurrency), (f"pool ({args.workers})", args.workers, args.concurrency)]
+    for name, workers, concurrency in modes:
+        app.worker_pool = WorkerPool(workers=workers)
+        latencies, durations = asyncio.run(probe(args.seconds, args.interval_ms / 1000, concurrency))
+        app.worker_pool.shutdown()
+        report_time = f"{statistics.mean(durations):>9.2f}" if durations else f"{'-':>9}"
+        columns = "".join(f" {percentile(values, 0.5) * 1000:>12.1f} {percentile(values, 0.99) * 1000:>12.1f}"
+                          for values in latencies.values())
+        probes = sum(len(values) for values in latencies.values())
+        print(f"{name:<12} {probes:>7}{columns} {len(durations):>8} {report_time}")
+
+
+if __name__ == "__main__":
+    main()
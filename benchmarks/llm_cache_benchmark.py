@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+LLM response cache benchmark
+
+Classifies and extracts N generated "PDF" documents with
+classify_invoice_with_openai() / extract_with_openai() against a local fake
+OpenAI server (answers /v1/chat/completions after --latency seconds), twice:
+- cold: empty cache, every document costs two API calls
+- warm: the same documents again, answered from the cache
+
+and reports the time per document, the number of API calls and the cache
+statistics. Results of both passes are checked to be identical. The cache is a
+temporary file; no OpenAI key is needed.
+
+Run from the project root:
+    python benchmarks/llm_cache_benchmark.py
+    python benchmarks/llm_cache_benchmark.py --documents 50 --latency 1.0
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+CLASSIFICATION = {"transaction_type": "purchase"}
+EXTRACTION = {
+    "invoice_no": "INV-001", "client_no": "", "date": "2024-03-15", "invoice_to": "Example B.V.",
+    "country": "NL", "vat_no": "NL123456789B01",
+    "transactions": [{"description": "Consulting", "amount_pre_vat": "100.00", "vat_percentage": "21",
+                      "vat_category": "5b"}],
+    "subtotal": "100.00", "vat_amount": "21.00", "total_amount": "121.00", "source_file": "invoice.pdf"
+}
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """
+    Chat completions endpoint answering classification, extraction and combined
+    prompts after a delay; counts calls, request bytes and client connections.
+    Answers fail_rate of the calls with fail_status (and Retry-After: retry_after).
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    latency = 0.5
+    fail_rate = 0.0
+    fail_status = 503
+    retry_after = None
+    faults = random.Random(1)
+    calls = 0
+    failures = 0
+    bytes_received = 0
+    connections = set()
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = json.loads(self.rfile.read(length))
+        FakeOpenAI.calls += 1
+        FakeOpenAI.bytes_received += length
+        FakeOpenAI.connections.add(self.client_address)
+        time.sleep(self.latency)
+        if self.fail_rate and self.faults.random() < self.fail_rate:
+            FakeOpenAI.failures += 1
+            error = {"error": {"message": "Injected fault", "type": "server_error", "code": None}}
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+            self.send_json(self.fail_status, error, headers)
+            return
+        prompt = body["messages"][0]["content"][0]["text"]
+        if '"invoice_no"' not in prompt:
+            answer = CLASSIFICATION
+        elif '"transaction_type"' in prompt:
+            answer = dict(CLASSIFICATION, **EXTRACTION)
+        else:
+            answer = EXTRACTION
+        payload = {
+            "id": f"chatcmpl-{FakeOpenAI.calls}", "object": "chat.completion", "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "```json\n" + json.dumps(answer) + "\n```"}}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": 100, "total_tokens": 1100}
+        }
+        self.send_json(200, payload)
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake API call")
+    args = parser.parse_args()
+
+    FakeOpenAI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["VAT_LLM_CACHE_PATH"] = os.path.join(tmp, "llm_cache.db")
+        import processor
+
+        rng = random.Random(42)
+        documents = [(f"invoice_{i}.pdf", b"%PDF-1.4\n" + rng.randbytes(50000)) for i in range(args.documents)]
+
+        def run():
+            results = []
+            with contextlib.redirect_stdout(io.StringIO()):  # progress prints
+                for filename, pdf_bytes in documents:
+                    transaction_type = processor.classify_invoice_with_openai(pdf_bytes, filename)
+                    results.append(processor.extract_with_openai(pdf_bytes, transaction_type, filename))
+            return results
+
+        print(f"{args.documents} documents, {args.latency}s per API call")
+        timings = {}
+        for name in ("cold", "warm"):
+            calls = FakeOpenAI.calls
+            start = time.perf_counter()
+            results = run()
+            timings[name] = time.perf_counter() - start, FakeOpenAI.calls - calls, results
+        if timings["cold"][2] != timings["warm"][2] or {} in timings["cold"][2]:
+            raise RuntimeError("Cached results differ")
+        stats = processor.llm_cache.stats()
+        server.shutdown()
+
+    for name, (elapsed, calls, _) in timings.items():
+        print(f"{name:<5} {elapsed * 1000 / args.documents:>9.2f} ms per document   {calls:>4} API calls")
+    print(f"cache: {stats['entries']} entries, {stats['size_bytes']} bytes, "
+          f"{stats['hits']} hits, {stats['misses']} misses")
+
+
+if __name__ == "__main__":
+    main()
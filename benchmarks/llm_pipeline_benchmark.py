@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+LLM pipeline benchmark: combined vs two-step
+
+Runs analyze_invoice_with_openai() on N generated "PDF" documents against the
+local fake OpenAI server of llm_cache_benchmark.py (--latency seconds per
+call), with the response cache disabled, in both modes:
+- two-step: classify_invoice_with_openai(), then extract_with_openai()
+- combined: classify_and_extract_with_openai(), one call
+
+and reports the time, API calls and request bytes per document. Both modes are
+checked to return the same invoice data (the fake server answers alike).
+
+Run from the project root:
+    python benchmarks/llm_pipeline_benchmark.py
+    python benchmarks/llm_pipeline_benchmark.py --documents 20 --pdf-kb 500
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from llm_cache_benchmark import FakeOpenAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake API call")
+    parser.add_argument("--pdf-kb", type=int, default=200, help="size of each document")
+    args = parser.parse_args()
+
+    FakeOpenAI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["VAT_LLM_CACHE_MB"] = "0"
+    import processor
+
+    rng = random.Random(42)
+    documents = [(f"invoice_{i}.pdf", b"%PDF-1.4\n" + rng.randbytes(args.pdf_kb * 1024))
+                 for i in range(args.documents)]
+
+    print(f"{args.documents} documents of {args.pdf_kb} KB, {args.latency}s per API call, per document:")
+    results = {}
+    for mode in ("two-step", "combined"):
+        calls, sent = FakeOpenAI.calls, FakeOpenAI.bytes_received
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # progress prints
+            results[mode] = [processor.analyze_invoice_with_openai(pdf_bytes, filename, mode=mode)
+                             for filename, pdf_bytes in documents]
+        elapsed = time.perf_counter() - start
+        calls, sent = FakeOpenAI.calls - calls, FakeOpenAI.bytes_received - sent
+        print(f"{mode:<9} {elapsed * 1000 / args.documents:>9.1f} ms   {calls / args.documents:>4.1f} API calls   "
+              f"{sent / 1024 / args.documents:>8.1f} KB sent")
+    server.shutdown()
+    if results["two-step"] != results["combined"] or {} in results["combined"]:
+        raise RuntimeError("Modes returned different invoice data")
+
+
+if __name__ == "__main__":
+    main()
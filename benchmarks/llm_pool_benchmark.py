@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Concurrent PDF extraction benchmark
+
+Extracts N generated "PDF" documents against the local fake OpenAI server of
+llm_cache_benchmark.py (--latency seconds per call, response cache disabled):
+- sequential: analyze_invoice_with_openai() one document after another
+- pool: analyze_invoices_async() on an LLMPool (--concurrency, --rpm); a second
+  user submits a small batch shortly after the first user's large one
+
+and reports the time per document, the API calls, the TCP connections opened
+and, for the pool, when the second user's batch finished (per-user turns let it
+through before the large batch is done). Results are checked to be identical.
+
+Run from the project root:
+    python benchmarks/llm_pool_benchmark.py
+    python benchmarks/llm_pool_benchmark.py --documents 500 --latency 2 --concurrency 16 --rpm 500
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from llm_cache_benchmark import FakeOpenAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake API call")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute (0: no limit)")
+    parser.add_argument("--mode", default="combined", choices=("combined", "two-step"))
+    args = parser.parse_args()
+
+    FakeOpenAI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["VAT_LLM_CACHE_MB"] = "0"
+    import processor
+    from llm_pool import LLMPool
+
+    rng = random.Random(42)
+    documents = [(f"invoice_{i}.pdf", b"%PDF-1.4\n" + rng.randbytes(20000)) for i in range(args.documents)]
+    small_batch = documents[:3]
+
+    def measure(run):
+        calls = FakeOpenAI.calls
+        FakeOpenAI.connections.clear()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # progress prints
+            result = run()
+        return time.perf_counter() - start, FakeOpenAI.calls - calls, len(FakeOpenAI.connections), result
+
+    def sequential():
+        return [processor.analyze_invoice_with_openai(pdf_bytes, filename, mode=args.mode)
+                for filename, pdf_bytes in documents]
+
+    async def concurrent():
+        processor.llm_pool = LLMPool(concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                     max_queue=args.documents + len(small_batch))
+        start = time.perf_counter()
+        large = asyncio.create_task(processor.analyze_invoices_async("user_a", documents, mode=args.mode))
+        await asyncio.sleep(args.latency / 2)
+        await processor.analyze_invoices_async("user_b", small_batch, mode=args.mode)
+        small_done = time.perf_counter() - start
+        return await large, small_done
+
+    print(f"{args.documents} documents ({args.mode}), {args.latency}s per API call, "
+          f"concurrency {args.concurrency}, rpm {args.rpm or 'unlimited'}")
+    seq_time, seq_calls, seq_conns, seq_results = measure(sequential)
+    pool_time, pool_calls, pool_conns, (pool_results, small_done) = measure(lambda: asyncio.run(concurrent()))
+    server.shutdown()
+    if seq_results != pool_results or {} in pool_results:
+        raise RuntimeError("Pool results differ")
+
+    # The pool's API calls include the second user's documents
+    for name, elapsed, calls, conns in (("sequential", seq_time, seq_calls, seq_conns),
+                                        (f"pool (+{len(small_batch)})", pool_time, pool_calls, pool_conns)):
+        print(f"{name:<10} {elapsed * 1000 / args.documents:>8.1f} ms per document  {elapsed:>7.2f} s total  "
+              f"{calls:>5} API calls  {conns:>3} connections")
+    print(f"second user's {len(small_batch)} documents done after {small_done:.2f} s "
+          f"(first user's {args.documents} after {pool_time:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
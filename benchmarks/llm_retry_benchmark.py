@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+OpenAI retry / circuit breaker benchmark
+
+Extracts N generated "PDF" documents with analyze_invoice_with_openai()
+(combined mode, response cache disabled) against the local fake OpenAI server
+of llm_cache_benchmark.py, injecting faults:
+- flaky: --fail-rate of the calls answer 429 (Retry-After: --retry-after) or 503
+- outage: every call answers 503
+
+each without retries (and no breaker) and with the retry layer
+(--retries, --backoff; breaker opening after --breaker-failures), and reports
+the documents extracted, the API calls, the time per document and the retry /
+breaker counters. Failed documents raise LLMUnavailable instead of coming back
+as a "sale".
+
+Run from the project root:
+    python benchmarks/llm_retry_benchmark.py
+    python benchmarks/llm_retry_benchmark.py --documents 100 --fail-rate 0.5
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from llm_cache_benchmark import FakeOpenAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake API call")
+    parser.add_argument("--fail-rate", type=float, default=0.3)
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After of the 429 answers")
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--backoff", type=float, default=0.05, help="first retry delay in seconds")
+    parser.add_argument("--breaker-failures", type=int, default=5)
+    args = parser.parse_args()
+
+    FakeOpenAI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["VAT_LLM_CACHE_MB"] = "0"
+    import processor
+    from llm_retry import CircuitBreaker, LLMRetry, LLMUnavailable
+
+    rng = random.Random(42)
+    documents = [(f"invoice_{i}.pdf", b"%PDF-1.4\n" + rng.randbytes(20000)) for i in range(args.documents)]
+
+    def run(fail_rate, fail_status, retry_after, layer):
+        FakeOpenAI.fail_rate, FakeOpenAI.fail_status, FakeOpenAI.retry_after = fail_rate, fail_status, retry_after
+        FakeOpenAI.faults = random.Random(1)
+        processor.llm_retry = layer
+        calls = FakeOpenAI.calls
+        extracted = unavailable = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # progress prints
+            for filename, pdf_bytes in documents:
+                try:
+                    extracted += bool(processor.analyze_invoice_with_openai(pdf_bytes, filename, mode="combined"))
+                except LLMUnavailable:
+                    unavailable += 1
+        return time.perf_counter() - start, FakeOpenAI.calls - calls, extracted, unavailable, layer.stats()
+
+    print(f"{args.documents} documents, {args.latency}s per API call")
+    print(f"{'scenario':<22} {'extracted':>9} {'unavail.':>8} {'calls':>6} {'ms/doc':>8} "
+          f"{'retried':>7} {'trips':>5} {'fast-fail':>9}")
+    flaky_429 = (args.fail_rate, 429, args.retry_after)
+    scenarios = [
+        ("flaky, no retries", flaky_429, LLMRetry(retries=0, breaker=CircuitBreaker(failure_threshold=0))),
+        ("flaky, retries", flaky_429, LLMRetry(retries=args.retries, base_delay=args.backoff,
+                                              breaker=CircuitBreaker(args.breaker_failures, reset_timeout=60))),
+        ("flaky 503, retries", (args.fail_rate, 503, None),
+         LLMRetry(retries=args.retries, base_delay=args.backoff,
+                  breaker=CircuitBreaker(args.breaker_failures, reset_timeout=60))),
+        ("outage, retries", (1.0, 503, None), LLMRetry(retries=args.retries, base_delay=args.backoff,
+                                                       breaker=CircuitBreaker(failure_threshold=0))),
+        ("outage, retries+breaker", (1.0, 503, None),
+         LLMRetry(retries=args.retries, base_delay=args.backoff,
+                  breaker=CircuitBreaker(args.breaker_failures, reset_timeout=60)))
+    ]
+    for name, faults, layer in scenarios:
+        elapsed, calls, extracted, unavailable, stats = run(*faults, layer)
+        print(f"{name:<22} {extracted:>9} {unavailable:>8} {calls:>6} {elapsed * 1000 / args.documents:>8.1f} "
+              f"{stats['retried']:>7} {stats['circuit']['trips']:>5} {stats['circuit']['short_circuits']:>9}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
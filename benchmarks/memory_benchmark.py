@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for stored invoices
+
+Ingests N generated invoices through process_invoices_simple, then measures
+(with tracemalloc) the bytes per invoice of keeping them as plain nested dicts
+(how MemoryStore used to hold them) versus InvoiceRecord / TransactionRecord
+(__slots__, amounts in cents, interned categories/countries), and checks that
+every record converts back to the exact same dict.
+
+Run from the project root:
+    python benchmarks/memory_benchmark.py
+    python benchmarks/memory_benchmark.py --sizes 10000 100000
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")  # don't create vat_data.db on import
+
+import app
+from records import InvoiceRecord
+from storage import get_store
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from ingest_benchmark import generate_invoices
+
+
+def stored_invoices(size, batch_size=1000):
+    """Ingest `size` invoices and return them in the stored JSON shape (each decoded separately, like an upload)"""
+    app.store = get_store("memory")
+    for start in range(0, size, batch_size):
+        batch = generate_invoices(start, min(batch_size, size - start))
+        asyncio.run(app.process_invoices_simple(user_id="bench_user", invoices=batch))
+    return [json.dumps(invoice) for invoice in app.store.get_invoices("bench_user", "2025")]
+
+
+def measure(build):
+    """Bytes allocated (and still alive) by build()"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'invoices':>10} {'dict B/inv':>11} {'record B/inv':>13} {'saved':>7}")
+    for size in args.sizes:
+        texts = stored_invoices(size)
+        app.store = get_store("memory")  # release the ingested store before measuring
+
+        dict_bytes, dicts = measure(lambda: [json.loads(text) for text in texts])
+        del dicts
+        record_bytes, records = measure(lambda: [InvoiceRecord.from_dict(json.loads(text)) for text in texts])
+
+        for text, record in zip(texts, records):
+            if record.to_dict() != json.loads(text) or json.dumps(record.to_dict()) != text:
+                raise RuntimeError(f"Record does not round-trip: {text}")
+        del records
+
+        print(f"{size:>10} {dict_bytes / size:>11.0f} {record_bytes / size:>13.0f} "
+              f"{1 - record_bytes / dict_bytes:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+PDF preprocessing benchmark (needs PyMuPDF)
+
+Generates sample invoices with PyMuPDF:
+- text: a one-page invoice with a text layer and a logo image
+- text-long: three pages of line items, three pages of terms and a blank page
+- scan: two scanned pages (images only, no text layer) and a blank page
+
+prepares each with PdfPreprocessor (VAT_PDF_* defaults) and reports the pages
+sent, the size of the base64 PDF and of the payload sent instead, and the
+preprocessing time. Then it extracts all of them with
+analyze_invoice_with_openai() against the local fake OpenAI server of
+llm_cache_benchmark.py, with preprocessing off and on, and reports the request
+bytes per document.
+
+Run from the project root:
+    python benchmarks/pdf_preprocess_benchmark.py
+    python benchmarks/pdf_preprocess_benchmark.py --dpi 100 --max-pages 2
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from llm_cache_benchmark import FakeOpenAI
+from pdf_preprocess import PdfPreprocessor, pymupdf
+
+TERMS = " ".join(["Payment is due within 30 days of the invoice date. Late payments bear interest."] * 12)
+
+
+def invoice_page(doc, rng, page_no, items, logo=None):
+    page = doc.new_page()
+    if logo is not None:
+        page.insert_image(pymupdf.Rect(430, 30, 560, 110), pixmap=logo)
+    lines = [f"INVOICE INV-2024-{rng.randint(1000, 9999)}   page {page_no}", "Example Supplier B.V., Amsterdam",
+             "VAT NL123456789B01", "Bill to: Customer GmbH, Berlin, DE (VAT DE123456789)", "Date: 15-03-2024", ""]
+    for i in range(items):
+        net = rng.randint(100, 100000) / 100
+        lines.append(f"{i + 1:>3}  Consulting services item {i + 1:<24} 1 x {net:>10.2f}  21%  {net * 1.21:>10.2f}")
+    page.insert_text((50, 140), "\n".join(lines), fontsize=9)
+    page.draw_line((50, 130), (560, 130))
+    return page
+
+
+def sample_pdfs(seed=42):
+    """{name: pdf_bytes} of the sample invoices"""
+    rng = random.Random(seed)
+    logo = pymupdf.Pixmap(pymupdf.csRGB, 160, 100, rng.randbytes(160 * 100 * 3), False)
+    samples = {}
+
+    doc = pymupdf.open()
+    invoice_page(doc, rng, 1, 8, logo)
+    samples["text"] = doc.tobytes(deflate=True)
+
+    doc = pymupdf.open()
+    for page_no in range(1, 4):
+        invoice_page(doc, rng, page_no, 40, logo)
+    for _ in range(3):
+        doc.new_page().insert_textbox(pymupdf.Rect(50, 50, 560, 800), TERMS, fontsize=8)
+    doc.new_page()
+    samples["text-long"] = doc.tobytes(deflate=True)
+
+    # Scans: pages rendered to images, without a text layer
+    source = pymupdf.open()
+    for page_no in range(1, 3):
+        invoice_page(source, rng, page_no, 20, logo)
+    doc = pymupdf.open()
+    for page in source:
+        scan = page.get_pixmap(dpi=200, colorspace=pymupdf.csGRAY)
+        doc.new_page().insert_image(pymupdf.Rect(0, 0, 595, 842), pixmap=scan)
+    doc.new_page()
+    samples["scan"] = doc.tobytes(deflate=True)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-pages", type=int, default=4)
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake API call")
+    args = parser.parse_args()
+    if pymupdf is None:
+        sys.exit("PyMuPDF is not installed (pip install pymupdf)")
+
+    samples = sample_pdfs()
+    preprocessor = PdfPreprocessor(max_pages=args.max_pages, dpi=args.dpi, cache_size=0)
+    print(f"max_pages {args.max_pages}, dpi {args.dpi}")
+    print(f"{'sample':<10} {'pages':>9} {'mode':<7} {'PDF KB':>8} {'sent KB':>8} {'reduction':>9} {'ms':>7}")
+    for name, pdf_bytes in samples.items():
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            payload = preprocessor.prepare(pdf_bytes, name)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<10} {payload.pages_sent:>4} of {payload.pages_total:<2} {payload.mode:<7} "
+              f"{payload.original_bytes / 1024:>8.1f} {payload.payload_bytes / 1024:>8.1f} "
+              f"{1 - payload.payload_bytes / payload.original_bytes:>8.0%} {elapsed * 1000:>7.1f}")
+
+    FakeOpenAI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["VAT_LLM_CACHE_MB"] = "0"
+    import processor
+
+    print(f"\nanalyze_invoice_with_openai() on the {len(samples)} samples, combined mode")
+    results = {}
+    for name, enabled in (("off", False), ("on", True)):
+        processor.pdf_preprocessor = PdfPreprocessor(enabled=enabled, max_pages=args.max_pages, dpi=args.dpi)
+        sent = FakeOpenAI.bytes_received
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # progress prints
+            results[name] = [processor.analyze_invoice_with_openai(pdf_bytes, f"{sample}.pdf", mode="combined")
+                             for sample, pdf_bytes in samples.items()]
+        elapsed = time.perf_counter() - start
+        sent = FakeOpenAI.bytes_received - sent
+        print(f"preprocessing {name:<3} {sent / 1024 / len(samples):>8.1f} KB sent per document   "
+              f"{elapsed * 1000 / len(samples):>7.1f} ms per document")
+    server.shutdown()
+    if results["off"] != results["on"] or {} in results["on"]:
+        raise RuntimeError("Extraction results differ")
+
+
+if __name__ == "__main__":
+    main()
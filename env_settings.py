@@ -0,0 +1,17 @@
+"""
+Numeric settings read from environment variables.
+
+The pools, caches and retry layers are configured by VAT_* variables; a value
+that isn't a number falls back to the default, and one below the minimum is
+raised to it, so a typo never stops the service from starting.
+"""
+
+import os
+
+
+def env_setting(name, default, minimum, kind=int):
+    """kind(os.getenv(name)), at least minimum; default if unset or not a valid number"""
+    try:
+        return max(minimum, kind(os.getenv(name, str(default))))
+    except ValueError:
+        return default
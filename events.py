@@ -0,0 +1,140 @@
+"""
+Per-user server-sent events.
+
+Clients subscribe with GET /events and receive:
+- progress: counts of a running upload (every PROGRESS_EVERY invoices, after each
+  commit, and once more with "done": true at the end)
+- invalidate: the years and months whose data changed (after each commit of an
+  upload, or with "cleared": true after /clear-user-data), so a client refetches
+  only the reports that changed instead of polling them
+
+Uploads publish from worker threads; publish() hands each event to the
+subscriber's event loop with call_soon_threadsafe. Every subscriber has a
+bounded queue: a client that falls that far behind gets a single "reset" event
+(refetch everything) instead of the events it missed. Subscriptions are per
+process, like the worker pools.
+
+Configure the queue length with VAT_EVENT_QUEUE (default: 256).
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+
+from env_settings import env_setting
+
+# Uploads publish their progress every PROGRESS_EVERY invoices
+PROGRESS_EVERY = 1000
+
+
+def format_event(event_id, event, data):
+    """One SSE message"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def changed_periods(new_invoices):
+    """Years and months touched by (year, invoice) pairs: (["2025"], {"2025": [1, 3]})"""
+    months = {}
+    for year, invoice in new_invoices:
+        year_months = months.setdefault(year, set())
+        if invoice.get("period_month"):
+            year_months.add(invoice["period_month"])
+    return sorted(months), {year: sorted(year_months) for year, year_months in sorted(months.items())}
+
+
+class EventSubscription:
+    """One connected client: an asyncio queue of formatted messages on the subscriber's loop"""
+
+    def __init__(self, events, user_id, max_queue):
+        self.events = events
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def deliver(self, event_id, message):
+        # Runs on the subscriber's loop
+        if self.queue.full():
+            # Too far behind: replace the backlog (and this event) with a single reset
+            self.dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            message = format_event(event_id, "reset", {"reason": "too many events missed"})
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        """Next message, or None after timeout seconds without one"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.events.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UserEvents:
+    """Fan-out of events to each user's subscribers (publish() is thread-safe)"""
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self.ids = itertools.count(1)
+        self._subscribers = {}  # user_id -> set of EventSubscription
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, user_id):
+        """New subscription for a user (call from the event loop; close it when done)"""
+        subscription = EventSubscription(self, user_id, self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def publish(self, user_id, event, data):
+        """Send an event to all subscribers of a user (from any thread)"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        if not subscribers:
+            return
+        event_id = next(self.ids)
+        message = format_event(event_id, event, data)
+        self.published += 1
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event_id, message)
+            except RuntimeError:
+                # The subscriber's loop is closed: it's gone
+                self.unsubscribe(subscription)
+
+    def stats(self):
+        """Subscribed users/connections and counters"""
+        with self._lock:
+            return {
+                "users": len(self._subscribers),
+                "connections": sum(len(subscribers) for subscribers in self._subscribers.values()),
+                "published": self.published,
+                "max_queue": self.max_queue
+            }
+
+
+def get_user_events():
+    """Create the event hub with the queue length from VAT_EVENT_QUEUE"""
+    return UserEvents(max_queue=env_setting("VAT_EVENT_QUEUE", 256, 1))
@@ -0,0 +1,108 @@
+"""
+Field alias resolution for uploaded invoices.
+
+Uploads name the same field in several ways ("VAT Category (NL) Code",
+"vat_category_nl_code", ...). A field's value is the first alias with a value
+(not None or ""); a NaN value (from Excel/CSV exports) counts as missing.
+
+Probing every alias of every field costs a dict lookup per alias per invoice,
+while the invoices of one upload almost always share their key layout. A
+FieldResolver (one per batch) compiles each key layout it sees into the alias
+that is actually present per field, so an invoice costs one lookup per field;
+fields with several aliases present are still probed in order. Invoices with
+yet another layout, beyond MAX_COMPILED_LAYOUTS, are probed completely.
+
+See benchmarks/field_alias_benchmark.py.
+"""
+
+# Field -> aliases, in order of precedence
+INVOICE_FIELD_ALIASES = {
+    "date": ("date", "Date"),
+    "type": ("type", "Type"),
+    "file_name": ("file_name", "File Name"),
+    "invoice_number": ("invoice_number", "invoice_no", "Invoice Number", "Invoice No"),
+    "vat_category_code": ("VAT Category (NL) Code", "vat_category_nl_code", "vat_category_code", "VAT Category Code"),
+    "vat_category_description": (
+        "VAT Category (NL) Description", "vat_category_nl_description", "vat_category_description",
+        "VAT Category Description"
+    ),
+    "vat_category": ("vat_category", "VAT Category"),
+    "vat_percentage": ("vat_percentage", "VAT %", "VAT Percentage"),
+    "country": ("country", "Country"),
+    "net_amount": ("net_amount", "Net Amount"),
+    "vat_amount": ("vat_amount", "VAT Amount"),
+    "gross_amount": ("gross_amount", "Gross Amount"),
+    "vendor_name": ("vendor_name", "Vendor Name", "vendor"),
+    "customer_name": ("customer_name", "Customer Name", "customer"),
+    "vendor_vat_id": ("vendor_vat_id", "Vendor VAT ID"),
+    "customer_vat_id": ("customer_vat_id", "Customer VAT ID"),
+    "description": ("description", "Description")
+}
+
+# Key layouts compiled per resolver (uploads with more distinct layouts are probed)
+MAX_COMPILED_LAYOUTS = 16
+
+
+class FieldResolver:
+    """Resolves the aliased fields of invoice items, compiled per key layout"""
+
+    def __init__(self, aliases=INVOICE_FIELD_ALIASES):
+        self.aliases = aliases
+        self._layouts = {}  # tuple of keys -> compiled function
+        self.compiled_hits = 0
+        self.probed_items = 0
+
+    def compile(self, keys):
+        """
+        Function returning the {field: value} of items with these keys: it looks
+        up only the aliases present in the layout (in order of precedence where
+        several are). The generated code holds only this resolver's own alias
+        and field names, never values from an item.
+        """
+        present = set(keys)
+        lines = ["def resolve(item):", "    values = {}"]
+        for field, aliases in self.aliases.items():
+            found = [alias for alias in aliases if alias in present]
+            if not found:
+                continue
+            # First alias with a value (not None or ""), then the NaN check
+            indent = "    "
+            lines.append(f"{indent}value = item[{found[0]!r}]")
+            for alias in found[1:]:
+                lines.append(f"{indent}if value is None or value == \"\":")
+                indent += "    "
+                lines.append(f"{indent}value = item[{alias!r}]")
+            lines.append("    if value is not None and value != \"\" and not (isinstance(value, float) and value != value):")
+            lines.append(f"        values[{field!r}] = value")
+        lines.append("    return values")
+        namespace = {}
+        exec("\n".join(lines), namespace)
+        return namespace["resolve"]
+
+    def resolve(self, item):
+        """
+        {field: value} of the fields that have a value in item; look fields up
+        with .get(field, default)
+        """
+        if type(item) is dict:
+            keys = tuple(item)
+            compiled = self._layouts.get(keys)
+            if compiled is None and len(self._layouts) < MAX_COMPILED_LAYOUTS:
+                compiled = self._layouts[keys] = self.compile(keys)
+            if compiled is not None:
+                self.compiled_hits += 1
+                return compiled(item)
+        self.probed_items += 1
+        return self.probe(item)
+
+    def probe(self, item):
+        """resolve() without a compiled layout: every alias of every field is looked up"""
+        values = {}
+        for field, aliases in self.aliases.items():
+            for alias in aliases:
+                value = item.get(alias)
+                if value is not None and value != "":
+                    if not (isinstance(value, float) and value != value):
+                        values[field] = value
+                    break
+        return values
@@ -0,0 +1,134 @@
+"""
+Background ingest jobs.
+
+POST /process-invoices?background=true stores the upload as a job and answers
+right away with its id; the job runs on its own worker pool (separate from the
+one building reports), and GET /ingest-jobs/{job_id} reports its status and
+counts while it runs and after it's done.
+
+Jobs live in this process: their status is lost on restart (invoices committed
+before that stay stored). Configure with VAT_INGEST_WORKERS (threads running
+jobs, default: 1), VAT_INGEST_QUEUE (jobs that may wait for a thread, default:
+32; further uploads get 503 with Retry-After) and VAT_INGEST_JOBS_KEPT
+(finished jobs whose status is kept, default: 1000).
+"""
+
+import asyncio
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from env_settings import env_setting
+from worker_pool import WorkerPool, WorkerPoolFull
+
+
+class IngestJob:
+    """
+    One background upload. batch is the job's InvoiceBatch once it runs, so the
+    counts are live while it's running.
+    """
+
+    def __init__(self, user_id, received):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.received = received
+        self.status = "queued"
+        self.error = None
+        self.batch = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self, batch):
+        """Mark the job running, counting into batch"""
+        self.batch = batch
+        self.status = "running"
+        self.started_at = datetime.now().isoformat()
+
+    def to_dict(self):
+        """Status and counts (as returned by GET /ingest-jobs/{job_id})"""
+        batch = self.batch
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total_invoices_received": self.received,
+            "details": {
+                "processed": batch.processed_count if batch else 0,
+                "stored": batch.processed_count - len(batch.new_invoices) if batch else 0,
+                "skipped": batch.skipped_count if batch else 0,
+                "errors": batch.error_count if batch else 0,
+                "updated_years": sorted(batch.updated_years) if batch else []
+            },
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class IngestJobs:
+    """Registry of ingest jobs running on a dedicated worker pool"""
+
+    def __init__(self, workers=1, max_queue=32, max_finished=1000):
+        self.pool = WorkerPool(workers=workers, max_queue=max_queue)
+        self.max_pending = max(workers, 1) + max_queue
+        self.max_finished = max_finished
+        self._jobs = OrderedDict()
+        self._tasks = set()  # Keeps the running tasks referenced
+
+    def pending(self):
+        """Number of queued or running jobs"""
+        return sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+
+    def submit(self, user_id, received, run):
+        """
+        Create a job and start `await run(job)` in the background (call from the
+        event loop). Raises WorkerPoolFull if too many jobs are pending.
+        """
+        if self.pending() >= self.max_pending:
+            raise WorkerPoolFull(f"{self.max_pending} ingest jobs queued or running")
+        job = IngestJob(user_id, received)
+        self._jobs[job.id] = job
+        self._prune()
+        task = asyncio.get_running_loop().create_task(self._run(job, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job, run):
+        try:
+            await run(job)
+            job.status = "completed"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"❌ Ingest job {job.id} for user {job.user_id} failed: {e}")
+        finally:
+            job.finished_at = datetime.now().isoformat()
+
+    def get(self, user_id, job_id):
+        """The user's job with this id, or None"""
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    def _prune(self):
+        # Forget the oldest finished jobs beyond max_finished
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        """Job counts per status and the pool's counters"""
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"jobs": counts, "max_pending": self.max_pending, "pool": self.pool.stats()}
+
+
+def get_ingest_jobs():
+    """Create the job registry sized by VAT_INGEST_WORKERS / VAT_INGEST_QUEUE / VAT_INGEST_JOBS_KEPT"""
+    return IngestJobs(
+        workers=env_setting("VAT_INGEST_WORKERS", 1, 0),
+        max_queue=env_setting("VAT_INGEST_QUEUE", 32, 0),
+        max_finished=env_setting("VAT_INGEST_JOBS_KEPT", 1000, 0)
+    )
@@ -0,0 +1,209 @@
+"""
+Incremental parser for streams of JSON objects.
+
+Accepts newline-delimited JSON (NDJSON), concatenated objects ({...}{...}{...})
+and JSON arrays of objects, fed in arbitrary chunks (e.g. from a request body
+stream). Only the unparsed tail of the input is buffered, so memory stays flat
+however large the stream is.
+
+If orjson is installed, objects that fill a whole line (NDJSON) are decoded
+with it, all complete lines of a chunk in one call; everything else goes
+through json.JSONDecoder.raw_decode.
+"""
+
+import codecs
+import json
+import re
+
+try:
+    import orjson  # Optional: much faster decoding of line-delimited objects
+except ImportError:
+    orjson = None
+
+# An incomplete object larger than this is treated as malformed (and skipped up to the next line)
+MAX_OBJECT_CHARS = 16 * 1024 * 1024
+
+# Malformed objects reported with their offset (further ones are only counted)
+MAX_REPORTED_ERRORS = 100
+
+# Longest line tried with the fast (orjson) path
+MAX_FAST_LINE_CHARS = 1024 * 1024
+
+# Slice size when parsing a complete text
+FEED_CHUNK_CHARS = 1024 * 1024
+
+
+def utf8_length(text):
+    """Length of text in UTF-8 bytes"""
+    return len(text) if text.isascii() else len(text.encode("utf-8", errors="replace"))
+
+
+# Tokens that matter for finding the end of an object: strings (a lone quote starts an
+# unterminated one), escaped characters and braces
+OBJECT_TOKENS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|\\.|[{}]', re.DOTALL)
+
+
+def find_object_end(text, start):
+    """
+    Index just past the object starting at text[start] ("{"), skipping braces in
+    strings, or -1 if the object is not complete in text. Only used for malformed
+    or incomplete objects; the regular expression steps from token to token.
+    """
+    depth = 0
+    for match in OBJECT_TOKENS.finditer(text, start):
+        token = match.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth == 0:
+                return match.end()
+        elif token == '"':
+            # Unterminated string: the object continues in data not received yet
+            return -1
+    return -1
+
+
+class JsonObjectStream:
+    """
+    Feed chunks (bytes or str) with feed(); each call returns the objects completed
+    by that chunk. Call close() at the end of the stream for the remaining objects.
+
+    Objects are decoded in place with json.JSONDecoder.raw_decode. Anything outside
+    top-level objects (whitespace, newlines, commas, array brackets) is skipped;
+    malformed objects are skipped, counted in `errors` and reported in `malformed`
+    as {"offset", "error"} with the byte offset of the object in the input.
+    """
+
+    def __init__(self, max_object_chars=MAX_OBJECT_CHARS, use_orjson=True):
+        self.max_object_chars = max_object_chars
+        self._fast_loads = orjson.loads if (use_orjson and orjson is not None) else None
+        self._bulk_lines = False
+        self.errors = 0
+        self.malformed = []
+        self._buffer = ""
+        # Input bytes consumed before the start of the buffer
+        self._offset = 0
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, chunk):
+        if isinstance(chunk, (bytes, bytearray)):
+            chunk = self._utf8.decode(chunk)
+        self._buffer += chunk
+        return self._drain(final=False)
+
+    def close(self):
+        self._buffer += self._utf8.decode(b"", final=True)
+        objects = self._drain(final=True)
+        self._buffer = ""
+        return objects
+
+    def _decode_lines(self, buffer, pos, objects):
+        """
+        Fast path: decode complete lines from pos on that hold one object each.
+        Returns (pos, fast_from): where the general parser continues, and where
+        the fast path may be tried again (past a line it couldn't decode)
+        """
+        end = buffer.rfind("\n", pos)
+        if end < 0:
+            return pos, len(buffer)
+        fast_loads = self._fast_loads
+        block = buffer[pos:end]
+        if self._bulk_lines:
+            # Usually every line holds one object: decode them all as one array
+            try:
+                decoded = fast_loads(("[" + block.replace("\n", ",") + "]").encode("utf-8"))
+            except ValueError:
+                decoded = None
+            if decoded is not None and all(type(obj) is dict for obj in decoded):
+                objects.extend(decoded)
+                return end + 1, len(buffer)
+            # Not plain NDJSON: line by line for the rest of this buffer
+            self._bulk_lines = False
+        for line in block.split("\n"):
+            next_pos = pos + len(line) + 1
+            if line and not line.isspace():
+                if len(line) > MAX_FAST_LINE_CHARS:
+                    return pos, next_pos
+                try:
+                    obj = fast_loads(line)
+                except ValueError:
+                    # A trailing comma is allowed (arrays written one object per line)
+                    line = line.rstrip()
+                    try:
+                        obj = fast_loads(line[:-1]) if line.endswith(",") else None
+                    except ValueError:
+                        obj = None
+                if not isinstance(obj, dict):
+                    return pos, next_pos
+                objects.append(obj)
+            pos = next_pos
+        # Only the incomplete last line is left
+        return pos, len(buffer)
+
+    def _drain(self, final):
+        objects = []
+        buffer = self._buffer
+        raw_decode = self._decoder.raw_decode
+        fast_lines = self._fast_loads is not None
+        fast_from = 0
+        self._bulk_lines = fast_lines
+        pos = 0
+        while True:
+            if fast_lines and pos >= fast_from:
+                pos, fast_from = self._decode_lines(buffer, pos, objects)
+            pos = buffer.find("{", pos)
+            if pos < 0:
+                # Nothing but separators left
+                pos = len(buffer)
+                break
+            try:
+                obj, pos = raw_decode(buffer, pos)
+                objects.append(obj)
+                continue
+            except json.JSONDecodeError as e:
+                error = e
+
+            end = find_object_end(buffer, pos)
+            if end >= 0:
+                # Complete but malformed object: skip it
+                self._report(buffer, pos, error)
+                pos = end
+            elif final:
+                self._report(buffer, pos, "Incomplete object at end of input")
+                pos = len(buffer)
+                break
+            elif len(buffer) - pos > self.max_object_chars:
+                # Runaway object (e.g. unbalanced quote): resume at the next line
+                self._report(buffer, pos, f"Object larger than {self.max_object_chars} characters")
+                newline = buffer.find("\n", pos)
+                pos = newline + 1 if newline >= 0 else len(buffer)
+            else:
+                # Incomplete object: wait for more data
+                break
+        self._offset += utf8_length(buffer[:pos])
+        self._buffer = buffer[pos:]
+        return objects
+
+    def _report(self, buffer, pos, error):
+        self.errors += 1
+        if len(self.malformed) < MAX_REPORTED_ERRORS:
+            offset = self._offset + utf8_length(buffer[:pos])
+            if isinstance(error, json.JSONDecodeError):
+                error = f"{error.msg} (at byte {offset + utf8_length(buffer[pos:error.pos])})"
+            self.malformed.append({"offset": offset, "error": str(error)})
+
+
+def parse_json_objects(text):
+    """
+    Parse all JSON objects in a text (NDJSON, {...}{...}{...} or a JSON array of objects).
+    Returns (objects, malformed) where malformed lists {"offset", "error"} of skipped objects.
+    """
+    parser = JsonObjectStream()
+    objects = []
+    # Fed in slices: keeps the working buffer (and its copies) small for very large texts
+    for start in range(0, len(text), FEED_CHUNK_CHARS):
+        objects.extend(parser.feed(text[start:start + FEED_CHUNK_CHARS]))
+    objects.extend(parser.close())
+    return objects, parser.malformed
@@ -0,0 +1,166 @@
+"""
+Persistent cache for OpenAI invoice classification / extraction responses.
+
+A response is stored under a SHA-256 over everything that determines it: the
+task, the model and request parameters, the SHA-256 of the prompt template,
+the company context, the prompt's other inputs (e.g. the filename) and the
+SHA-256 of the PDF. Uploading the same invoice again (same company, same
+prompts) returns the stored response instead of calling the API; changing a
+prompt template or the model makes the old entries unreachable.
+
+Entries live in a SQLite file, so they survive restarts and are shared by all
+worker processes. Only responses that parsed are stored. When the entries
+exceed the size budget, the least recently used ones are evicted.
+
+Configure with VAT_LLM_CACHE_PATH (default: llm_cache.db) and VAT_LLM_CACHE_MB
+(default: 64, 0 disables caching).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from env_settings import env_setting
+
+LLM_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_responses (
+    key TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_responses_last_used ON llm_responses (last_used);
+"""
+
+# Rough per-entry overhead (key, row, index entries) on top of the response size
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def llm_cache_key(task, pdf_bytes, prompt_template, company_context, model, **params):
+    """
+    Cache key of one response: task ("classify"/"extract"), PDF, prompt template,
+    company context, model and any other request inputs (filename, max_tokens, ...)
+    """
+    parts = {
+        "task": task,
+        "pdf_sha256": sha256_hex(pdf_bytes),
+        "prompt_sha256": sha256_hex(prompt_template),
+        "company": company_context,
+        "model": model,
+        "params": params
+    }
+    return sha256_hex(json.dumps(parts, sort_keys=True, default=str))
+
+
+class LLMCache:
+    """SQLite-backed response cache bounded by total size (LRU eviction), with hit/miss counters"""
+
+    def __init__(self, path="llm_cache.db", max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._conn is None:
+            # isolation_level=None: autocommit, transactions are opened explicitly
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(LLM_CACHE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        """Return the cached response text for a key (and mark it recently used), or None"""
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT response FROM llm_responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE llm_responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            except sqlite3.Error as e:
+                # A broken cache only costs an API call
+                print(f"⚠️ LLM cache read failed: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, task, response):
+        """Store a response text, then evict least recently used entries beyond the size budget"""
+        size = len(response.encode("utf-8")) + ENTRY_OVERHEAD_BYTES
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                self._store(key, task, response, size, now)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache write failed: {e}")
+
+    def _store(self, key, task, response, size, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, task, response, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, task, response, size, now, now)
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = conn.execute("SELECT key, size FROM llm_responses ORDER BY last_used LIMIT 1").fetchone()
+                conn.execute("DELETE FROM llm_responses WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+                self.evictions += 1
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM llm_responses")
+
+    def stats(self):
+        """Entry count, size and counters"""
+        if self.max_bytes <= 0:
+            entries, size = 0, 0
+        else:
+            with self._lock:
+                entries, size = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses"
+                ).fetchone()
+        return {
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def get_llm_cache():
+    """Create the LLM response cache configured by VAT_LLM_CACHE_PATH / VAT_LLM_CACHE_MB"""
+    max_mb = env_setting("VAT_LLM_CACHE_MB", 64.0, 0.0, kind=float)
+    return LLMCache(path=os.getenv("VAT_LLM_CACHE_PATH", "llm_cache.db"), max_bytes=int(max_mb * 1024 * 1024))
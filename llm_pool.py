@@ -0,0 +1,204 @@
+"""
+Concurrent OpenAI calls for PDF invoice extraction.
+
+Extracting a batch of PDFs one call after another takes seconds per document.
+LLMPool runs the documents' pipelines concurrently on the event loop:
+- one shared AsyncOpenAI client, so HTTP connections are kept alive and reused
+- at most `concurrency` documents in progress at a time
+- a queue per user, served round-robin, so one user's 500 PDFs don't hold up
+  another user's single invoice
+- a token bucket allowing `requests_per_minute` API calls (bursts up to
+  `concurrency`), to stay below the account's rate limit instead of running
+  into 429s
+
+At most max_queue documents wait; larger batches are rejected right away with
+WorkerPoolFull. The client uses OPENAI_API_KEY / OPENAI_BASE_URL, so it can be
+pointed at a local server (see benchmarks/llm_pool_benchmark.py). Configure with
+VAT_LLM_CONCURRENCY (default: 8), VAT_LLM_RPM (default: 500, 0 for no limit)
+and VAT_LLM_QUEUE (default: 1000).
+"""
+
+import asyncio
+import time
+from collections import deque
+
+import openai
+
+from env_settings import env_setting
+from worker_pool import WorkerPoolFull
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average and bursts of up to `capacity`; waiters are served in order"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0  # Seconds spent waiting for tokens, in total
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+
+class LLMPool:
+    """Bounded, per-user fair pool of async OpenAI pipelines sharing one client and a rate limit"""
+
+    def __init__(self, concurrency=8, requests_per_minute=500, max_queue=1000):
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.max_queue = max_queue
+        self.bucket = TokenBucket(requests_per_minute / 60, concurrency) if requests_per_minute else None
+        # Event loop state (client, workers, queues), created on first use
+        self._loop = None
+        self._client = None
+        self._workers = []
+        self._queues = {}  # user_id -> deque of (future, func, args)
+        self._turns = deque()  # users with queued calls, in round-robin order
+        self._ready = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.requests = 0
+
+    def _bind(self):
+        """Create the loop-bound state for the running loop (again, if the loop changed)"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._client = None
+        self._queues.clear()
+        self._turns.clear()
+        self.queued = self.running = 0
+        self._ready = asyncio.Semaphore(0)
+        if self.bucket is not None:
+            self.bucket = TokenBucket(self.bucket.rate, self.bucket.capacity)
+        self._workers = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+
+    def client(self):
+        """The shared AsyncOpenAI client (call from the event loop)"""
+        self._bind()
+        if self._client is None:
+            # Retries are done by the caller (llm_retry.py), within the rate limit
+            self._client = openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0)
+        return self._client
+
+    async def chat(self, **request):
+        """client.chat.completions.create(**request), once the rate limit allows"""
+        client = self.client()
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        self.requests += 1
+        return await client.chat.completions.create(**request)
+
+    async def run(self, user_id, func, *args):
+        """await func(*args) in the user's turn; raises WorkerPoolFull if the queue is full"""
+        return (await self.run_many(user_id, func, [args]))[0]
+
+    async def run_many(self, user_id, func, arg_tuples):
+        """
+        [await func(*args) for each args], run concurrently in the user's turns.
+        The whole batch is queued or (WorkerPoolFull) rejected.
+        """
+        self._bind()
+        arg_tuples = list(arg_tuples)
+        if not arg_tuples:
+            return []  # No turn for a user without calls (the worker would find the queue empty)
+        if self.queued + len(arg_tuples) > self.max_queue:
+            self.rejected += len(arg_tuples)
+            raise WorkerPoolFull(f"{self.queued} documents queued")
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._turns.append(user_id)
+        futures = []
+        for args in arg_tuples:
+            future = self._loop.create_future()
+            queue.append((future, func, args))
+            futures.append(future)
+            self.queued += 1
+            self._ready.release()
+        try:
+            return await asyncio.gather(*futures)
+        except asyncio.CancelledError:
+            # Caller gone (e.g. client disconnected): drop the calls that haven't started
+            for future in futures:
+                future.cancel()
+            raise
+
+    def _next(self):
+        """Next call, taking turns between users"""
+        user_id = self._turns.popleft()
+        queue = self._queues[user_id]
+        call = queue.popleft()
+        if queue:
+            self._turns.append(user_id)
+        else:
+            del self._queues[user_id]
+        self.queued -= 1
+        return call
+
+    async def _work(self):
+        while True:
+            await self._ready.acquire()
+            future, func, args = self._next()
+            if future.done():  # cancelled
+                continue
+            self.running += 1
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+
+    def stats(self):
+        """Pool size, rate limit, running/queued documents and counters"""
+        return {
+            "concurrency": self.concurrency,
+            "requests_per_minute": self.requests_per_minute,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queued": self.queued,
+            "queued_users": len(self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "requests": self.requests,
+            "rate_limit_wait_seconds": round(self.bucket.waited, 3) if self.bucket is not None else 0.0
+        }
+
+
+def get_llm_pool():
+    """Create the extraction pool configured by VAT_LLM_CONCURRENCY / VAT_LLM_RPM / VAT_LLM_QUEUE"""
+    return LLMPool(
+        concurrency=env_setting("VAT_LLM_CONCURRENCY", 8, 1),
+        requests_per_minute=env_setting("VAT_LLM_RPM", 500, 0),
+        max_queue=env_setting("VAT_LLM_QUEUE", 1000, 1)
+    )
@@ -0,0 +1,254 @@
+"""
+Retries and a circuit breaker around OpenAI calls.
+
+A 429 or 5xx from OpenAI used to end the call: classification fell back to
+"sale" and extraction to {}, so a short upstream hiccup misclassified
+invoices. LLMRetry.call() / acall() retry transient failures (connection
+errors, timeouts, 408/409/429/5xx) with exponential backoff and full jitter,
+waiting as long as the response's Retry-After asks (up to max_delay). Other
+errors (400, 401, ...) are raised right away: retrying them doesn't help.
+
+While the upstream is down, retrying every call only adds load and latency.
+The circuit breaker opens after `failure_threshold` transient failures in a
+row; calls then fail fast with CircuitOpen until `reset_timeout` seconds have
+passed, when one trial call is let through (half-open): success closes the
+circuit, failure opens it again; calls arriving meanwhile wait for it (within
+their retries). Both CircuitOpen and exhausted retries raise LLMUnavailable,
+which callers must not mistake for an answer.
+
+The OpenAI clients are created with max_retries=0, so retries happen here only.
+Configure with VAT_LLM_RETRIES (default: 3), VAT_LLM_BACKOFF (first delay in
+seconds, default: 1), VAT_LLM_BACKOFF_MAX (default: 30),
+VAT_LLM_BREAKER_FAILURES (default: 5) and VAT_LLM_BREAKER_RESET (seconds,
+default: 30).
+"""
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+import openai
+
+from env_settings import env_setting
+
+# Status codes worth retrying: timeout, conflict, rate limit, server errors (>= 500)
+RETRY_STATUS_CODES = frozenset({408, 409, 429})
+
+
+class LLMUnavailable(Exception):
+    """OpenAI could not be reached or kept failing (retries exhausted, or the circuit is open)"""
+
+
+class CircuitOpen(LLMUnavailable):
+    """Raised without calling OpenAI while the circuit breaker is open (or half-open, trial running)"""
+
+    def __init__(self, message, half_open=False):
+        super().__init__(message)
+        self.half_open = half_open
+
+
+def is_transient(error):
+    """Whether a failed OpenAI call may succeed when retried"""
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and (status_code in RETRY_STATUS_CODES or status_code >= 500)
+
+
+def retry_after(error):
+    """Seconds the error response asks to wait (retry-after-ms / Retry-After), or None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # HTTP date
+            return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker counting consecutive transient failures (thread-safe)"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.trips = 0
+        self.short_circuits = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go through now"""
+        with self._lock:
+            if self.state == "closed" or not self.failure_threshold:
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                self.trial_running = False
+            if self.state == "half-open":
+                if not self.trial_running:
+                    self.trial_running = True
+                    return
+                raise CircuitOpen("OpenAI circuit half-open, trial call running", half_open=True)
+            self.short_circuits += 1
+            retry_in = max(self.reset_timeout - (time.monotonic() - self.opened_at), 0)
+            raise CircuitOpen(f"OpenAI circuit open after {self.failures} failures, retry in {retry_in:.0f}s")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failure_threshold and (self.state == "half-open" or self.failures >= self.failure_threshold):
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End a call that neither succeeded nor failed transiently"""
+        with self._lock:
+            self.trial_running = False
+
+
+class LLMRetry:
+    """Retries transient OpenAI failures with backoff, behind a circuit breaker; counts what happened"""
+
+    def __init__(self, retries=3, base_delay=1.0, max_delay=30.0, breaker=None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.calls = 0
+        self.attempts = 0
+        self.retried = 0
+        self.gave_up = 0
+        self.retry_wait = 0.0
+
+    def _delay(self, attempt, error):
+        """Wait before retry number `attempt` (1, 2, ...)"""
+        requested = retry_after(error)
+        if requested is not None:
+            return min(max(requested, 0.0), self.max_delay)
+        # Full jitter: spreads the retries of concurrent calls
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _failed(self, attempt, error):
+        """Record a failed attempt; the delay before the next one, or raises"""
+        if not is_transient(error):
+            self.breaker.release()
+            raise error
+        self.breaker.record_failure()
+        if attempt > self.retries:
+            self.gave_up += 1
+            raise LLMUnavailable(f"OpenAI call failed after {attempt} attempts: {error}") from error
+        delay = self._delay(attempt, error)
+        self.retried += 1
+        self.retry_wait += delay
+        print(f"🟡 OpenAI call failed ({error.__class__.__name__}), retry {attempt}/{self.retries} in {delay:.1f}s")
+        return delay
+
+    def _admit(self, attempt):
+        """None if the call may go ahead, else the delay before checking the breaker again"""
+        try:
+            self.breaker.before_call()
+            return None
+        except CircuitOpen as e:
+            # Half-open: the trial call decides shortly, wait for it
+            if not e.half_open or attempt > self.retries:
+                raise
+            return self._delay(attempt, None)
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs) with retries (blocking sleeps)"""
+        self.calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = self._admit(attempt)
+            if wait is not None:
+                time.sleep(wait)
+                continue
+            self.attempts += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self._failed(attempt, e))
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, func, *args, **kwargs):
+        """await func(*args, **kwargs) with retries"""
+        self.calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = self._admit(attempt)
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            self.attempts += 1
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._failed(attempt, e))
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        """Retry counters and the circuit breaker's state"""
+        breaker = self.breaker
+        return {
+            "retries": self.retries,
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retried": self.retried,
+            "gave_up": self.gave_up,
+            "retry_wait_seconds": round(self.retry_wait, 3),
+            "circuit": {
+                "state": breaker.state,
+                "consecutive_failures": breaker.failures,
+                "failure_threshold": breaker.failure_threshold,
+                "reset_timeout": breaker.reset_timeout,
+                "trips": breaker.trips,
+                "short_circuits": breaker.short_circuits
+            }
+        }
+
+
+def get_llm_retry():
+    """Create the retry layer configured by VAT_LLM_RETRIES / VAT_LLM_BACKOFF(_MAX) / VAT_LLM_BREAKER_*"""
+    return LLMRetry(
+        retries=env_setting("VAT_LLM_RETRIES", 3, 0),
+        base_delay=env_setting("VAT_LLM_BACKOFF", 1.0, 0.0, kind=float),
+        max_delay=env_setting("VAT_LLM_BACKOFF_MAX", 30.0, 0.0, kind=float),
+        breaker=CircuitBreaker(
+            failure_threshold=env_setting("VAT_LLM_BREAKER_FAILURES", 5, 0),
+            reset_timeout=env_setting("VAT_LLM_BREAKER_RESET", 30.0, 0.0, kind=float)
+        )
+    )
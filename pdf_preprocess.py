@@ -0,0 +1,184 @@
+"""
+PDF preprocessing before OpenAI calls.
+
+The OpenAI helpers used to send every PDF whole, as a base64 data URL: a third
+larger than the file, and including pages with nothing to extract (terms and
+conditions, blank backs of scans). PdfPreprocessor.prepare() shrinks what is
+sent, looking at the first `max_pages` pages that aren't blank:
+- "text": the PDF has a text layer (at least `min_text_chars` characters on
+  those pages), so their text is sent instead of the document (a fraction of
+  the bytes and tokens)
+- "images": a scan without text, so those pages are rendered to grayscale JPEGs
+  at `dpi` and sent as images
+- "pdf": the PDF is sent as before (preprocessing off, PyMuPDF not installed,
+  a PDF it can't open, or rendered pages that wouldn't be smaller)
+
+Each document's size before (base64 PDF) and after (text or base64 images) is
+logged and summed in stats(). Results are memoized per PDF for the calls of one
+document (classification, then extraction). Install PyMuPDF (optional) to
+enable it; configure with VAT_PDF_PREPROCESS (default: 1, 0 sends PDFs as
+before), VAT_PDF_MAX_PAGES (default: 4), VAT_PDF_DPI (default: 150) and
+VAT_PDF_MIN_TEXT_CHARS (default: 100). See benchmarks/pdf_preprocess_benchmark.py.
+"""
+
+import base64
+import functools
+import os
+import time
+
+from env_settings import env_setting
+
+try:
+    import pymupdf  # Optional: text layer extraction and page rendering of PDFs
+except ImportError:
+    try:
+        import fitz as pymupdf  # PyMuPDF before 1.24
+    except ImportError:
+        pymupdf = None
+
+# Text sent per document at most (the first pages of very long text layers)
+MAX_TEXT_CHARS = 50000
+
+# Rendered pages: JPEG quality (text stays legible)
+JPEG_QUALITY = 75
+
+
+class PdfPayload:
+    """What is sent to OpenAI for one PDF: its text, page images or the PDF itself"""
+
+    def __init__(self, mode, original_bytes, text=None, images=(), pages_total=0, pages_sent=0):
+        self.mode = mode
+        self.text = text
+        self.images = list(images)
+        self.pages_total = pages_total
+        self.pages_sent = pages_sent
+        self.original_bytes = original_bytes  # Size of the base64 PDF
+        self.pdf_base64 = None
+
+    @property
+    def payload_bytes(self):
+        """Size of the text or base64 data sent"""
+        if self.mode == "text":
+            return len(self.text.encode("utf-8"))
+        if self.mode == "images":
+            return sum(len(image) for image in self.images)
+        return self.original_bytes
+
+    def content_parts(self):
+        """Message content parts following the prompt"""
+        if self.mode == "text":
+            header = f"## Invoice Text ({self.pages_sent} of {self.pages_total} pages):"
+            return [{"type": "text", "text": f"{header}\n{self.text}"}]
+        if self.mode == "images":
+            return [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image}"}}
+                    for image in self.images]
+        return [{"type": "image_url", "image_url": {"url": f"data:application/pdf;base64,{self.pdf_base64}"}}]
+
+
+def is_blank(page, text):
+    """No text, images or drawings on the page"""
+    return not text.strip() and not page.get_images() and not page.get_drawings()
+
+
+class PdfPreprocessor:
+    """Turns a PDF into the smallest payload that still shows the invoice; counts sizes per mode"""
+
+    def __init__(self, enabled=True, max_pages=4, dpi=150, min_text_chars=100, cache_size=8):
+        self.enabled = enabled and pymupdf is not None
+        self.max_pages = max_pages
+        self.dpi = dpi
+        self.min_text_chars = min_text_chars
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._prepare)
+        self.documents = {}  # mode -> count
+        self.original_bytes = 0
+        self.payload_bytes = 0
+        self.seconds = 0.0
+
+    def settings(self):
+        """Settings that change the payload (part of the LLM cache key)"""
+        if not self.enabled:
+            return "pdf"
+        return f"pages={self.max_pages},dpi={self.dpi},min_text={self.min_text_chars}"
+
+    def prepare(self, pdf_bytes, filename=""):
+        """PdfPayload for a PDF (memoized for the last few PDFs)"""
+        return self._cached(pdf_bytes, filename)
+
+    def _prepare(self, pdf_bytes, filename):
+        start = time.perf_counter()
+        original_bytes = (len(pdf_bytes) + 2) // 3 * 4
+        payload = None
+        if self.enabled:
+            try:
+                payload = self._preprocess(pdf_bytes, original_bytes)
+            except Exception as e:
+                print(f"⚠️ PDF preprocessing failed for {filename or 'PDF'}, sending the PDF: {e}")
+        if payload is None:
+            payload = PdfPayload("pdf", original_bytes)
+        if payload.mode == "pdf":
+            payload.pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
+        elapsed = time.perf_counter() - start
+
+        self.documents[payload.mode] = self.documents.get(payload.mode, 0) + 1
+        self.original_bytes += payload.original_bytes
+        self.payload_bytes += payload.payload_bytes
+        self.seconds += elapsed
+        if payload.mode != "pdf":
+            print(f"📄 {filename or 'PDF'}: {payload.original_bytes / 1024:.1f} KB → {payload.mode} "
+                  f"{payload.payload_bytes / 1024:.1f} KB ({payload.pages_sent} of {payload.pages_total} pages, "
+                  f"{elapsed * 1000:.0f} ms)")
+        return payload
+
+    def _preprocess(self, pdf_bytes, original_bytes):
+        """Text or images payload, or None if the PDF should be sent as is"""
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            if doc.needs_pass:
+                return None
+            # The first max_pages pages that aren't blank
+            pages = []
+            for page in doc:
+                text = page.get_text("text")
+                if not is_blank(page, text):
+                    pages.append((page, text))
+                    if len(pages) >= self.max_pages:
+                        break
+            if not pages:
+                return None
+
+            text_chars = sum(len("".join(text.split())) for _, text in pages)
+            if text_chars >= self.min_text_chars:
+                text = "\n\n".join(f"--- Page {page.number + 1} ---\n{text.strip()}" for page, text in pages)
+                return PdfPayload("text", original_bytes, text=text[:MAX_TEXT_CHARS],
+                                  pages_total=doc.page_count, pages_sent=len(pages))
+
+            images = []
+            for page, _ in pages:
+                jpeg = page.get_pixmap(dpi=self.dpi, colorspace=pymupdf.csGRAY).tobytes("jpg", jpg_quality=JPEG_QUALITY)
+                images.append(base64.b64encode(jpeg).decode('utf-8'))
+            payload = PdfPayload("images", original_bytes, images=images,
+                                 pages_total=doc.page_count, pages_sent=len(pages))
+            return payload if payload.payload_bytes < original_bytes else None
+
+    def stats(self):
+        """Documents per payload mode and total sizes before / after"""
+        return {
+            "enabled": self.enabled,
+            "pymupdf_installed": pymupdf is not None,
+            "max_pages": self.max_pages,
+            "dpi": self.dpi,
+            "documents": dict(self.documents),
+            "original_bytes": self.original_bytes,
+            "payload_bytes": self.payload_bytes,
+            "reduction": round(1 - self.payload_bytes / self.original_bytes, 3) if self.original_bytes else 0.0,
+            "seconds": round(self.seconds, 3)
+        }
+
+
+def get_pdf_preprocessor():
+    """Create the preprocessor configured by VAT_PDF_PREPROCESS / VAT_PDF_MAX_PAGES / VAT_PDF_DPI / VAT_PDF_MIN_TEXT_CHARS"""
+    return PdfPreprocessor(
+        enabled=os.getenv("VAT_PDF_PREPROCESS", "1") != "0",
+        max_pages=env_setting("VAT_PDF_MAX_PAGES", 4, 1),
+        dpi=env_setting("VAT_PDF_DPI", 150, 36),
+        min_text_chars=env_setting("VAT_PDF_MIN_TEXT_CHARS", 100, 1)
+    )
@@ -1,12 +1,20 @@
 
 # import boto3  # COMMENTED OUT - S3 integration disabled for now
 import json
+import re
 from fastapi import UploadFile
 from io import BytesIO
 import openai
 from datetime import datetime
 import time
 import base64
+import asyncio
+from events import changed_periods
+from llm_cache import get_llm_cache, llm_cache_key
+from llm_pool import get_llm_pool
+from llm_retry import get_llm_retry, LLMUnavailable
+from pdf_preprocess import get_pdf_preprocessor
+from vat_classifier import register_classifier
 import os  # Still needed for environment variables
 from dotenv import load_dotenv  # Still needed for environment variables
 
@@ -15,6 +23,19 @@ load_dotenv()
 
 # OpenAI Configuration
 openai.api_key = os.getenv('OPENAI_API_KEY', 'your-openai-api-key-here')
+OPENAI_MODEL = "gpt-4o"
+
+# Parsed OpenAI responses per (PDF, prompt, company, model), see llm_cache.py
+llm_cache = get_llm_cache()
+
+# Concurrent async OpenAI calls for batches of PDFs, see llm_pool.py
+llm_pool = get_llm_pool()
+
+# Retries with backoff and a circuit breaker for all OpenAI calls, see llm_retry.py
+llm_retry = get_llm_retry()
+
+# PDFs are sent as their text layer or a few rendered pages where possible, see pdf_preprocess.py
+pdf_preprocessor = get_pdf_preprocessor()
 
 # ==================== COMMENTED OUT - S3 Integration (for future use) ====================
 # # Configuration
@@ -39,11 +60,9 @@ openai.api_key = os.getenv('OPENAI_API_KEY', 'your-openai-api-key-here')
 #     aws_secret_access_key=aws_secret_access_key
 # )
 
-# ==================== IN-MEMORY STORAGE (Replaces S3) ====================
-# These will be set by app.py when it imports this module
-# Simple in-memory storage dictionaries
-user_vat_data_storage = None  # Will be set to app.user_vat_data
-user_company_details_storage = None  # Will be set to app.user_company_details
+# ==================== STORAGE ====================
+# Invoice data and company details live in a storage backend (see storage.py).
+# app.py creates the store and passes it to the functions below.
 
 # Step 1: Invoice Classification Prompt
 LLM_CLASSIFICATION_PROMPT = """
@@ -73,9 +92,9 @@ Carefully analyze the invoice text and classify the transaction type based on th
 
 ### Output Format:
 Return ONLY the following JSON format:
-{
+{{
   "transaction_type": "sale" // or "purchase"
-}
+}}
 
 Do not include any other explanations or text outside this JSON output.
 """
@@ -88,7 +107,7 @@ You are a VAT data extraction specialist. Your task is to extract specific invoi
 Given an invoice document, extract the required fields and return the data in the exact JSON format below.
 
 ### Required Fields:
-{
+{{
   "invoice_no": "",          # The invoice number
   "client_no": "",           # Client number
   "date": "",                # Invoice date
@@ -96,20 +115,103 @@ Given an invoice document, extract the required fields and return the data in th
   "country": "",             # Country of the client
   "vat_no": "",              # VAT number of the client
   "transactions": [          # List of transactions on the invoice
-    {
+    {{
       "description": "",     # Description of the transaction
       "amount_pre_vat": "",  # Amount before VAT
       "vat_percentage": "",  # VAT rate applied to the transaction
       "vat_category": ""     # One of the predefined VAT categories (see below)
-    }
+    }}
   ],
   "subtotal": "",            # Subtotal (excluding VAT)
   "vat_amount": "",          # VAT amount
   "total_amount": "",        # Total amount (including VAT)
   "source_file": ""          # Filename of the invoice PDF
-}
+}}
+
+## VAT Categories:
+
+**SALE Categories:**
+- 1a → Domestic sales taxed at 21% (standard rate, NL)  
+- 1b → Domestic sales taxed at 9% (reduced rate: food, books, etc.)  
+- 1c → Sales with 0% VAT to EU countries or exports  
+- 3a → Goods supplied to EU countries  
+- 3b → Services supplied to EU countries  
+- 1d → Exempt sales (e.g., healthcare, financial services, education)  
+- 1e → Zero-rated sales (exports, intra-community supplies)
+
+**PURCHASE Categories:**
+- 2a → Reverse-charge: services received from foreign vendors  
+- 4a → Goods purchased from EU countries  
+- 4b → Services purchased from EU countries  
+- 5b → Input VAT on domestic purchases  
+- 2b → Imports from non-EU countries (import VAT)  
+- 5c → Adjustments for Bad Debts (VAT corrections for unpaid invoices)  
+- 6a → Exempt purchases related to exempt sales (e.g., healthcare, education)
+
+
+### Extraction Guidelines:
+- Extract the **country** of the **client (invoice recipient)**, not the company issuing the invoice.
+- Use the provided filename for the **source_file** (do not include sensitive info or API keys).
+- For each transaction, assign the appropriate **vat_category** based on the transaction's description and VAT rate.
+
+### Output Format:
+Return ONLY valid JSON. Do not include any explanations, markdown, or additional text. The **source_file** should contain only the filename, no API keys or sensitive info.
+"""
+
+# Steps 1 + 2 in one call: Classification and Extraction Prompt
+LLM_COMBINED_PROMPT = """
+You are a VAT data extraction specialist. Your task is to classify an invoice as either a **SALE** or **PURCHASE** transaction and to extract specific invoice data for Dutch VAT reporting.
+
+## Company Context:
+- Company Name: {company_name_placeholder}
+- VAT Number: {company_vat_placeholder}
+
+## Step 1: Transaction Type
+Classify the invoice from the perspective of the company above.
+
+### PURCHASE Indicators:
+- Mentions "Purchase Order", "PO", "P.O.", "PO Number"
+- Invoice is FROM a supplier TO your company
+- Contains supplier/vendor information
+- Your company is listed as the buyer/recipient
+- Mentions procurement-related terms (e.g., "procurement", "purchasing", "order")
+- References terms like "supplier", "vendor", or "purchase"
+
+### SALE Indicators:
+- Invoice is FROM your company TO a customer
+- Contains customer/client information
+- Your company is listed as the seller/supplier
+- Mentions sales-related terms (e.g., "sale", "sold", "transaction")
+- References terms like "customer", "client", or "sale"
+
+## Step 2: Data Extraction
+Extract the required fields and return them, with the transaction type, in the exact JSON format below.
+
+### Required Fields:
+{{
+  "transaction_type": "",    # "sale" or "purchase" (Step 1)
+  "invoice_no": "",          # The invoice number
+  "client_no": "",           # Client number
+  "date": "",                # Invoice date
+  "invoice_to": "",          # Name of the customer/client (invoice recipient)
+  "country": "",             # Country of the client
+  "vat_no": "",              # VAT number of the client
+  "transactions": [          # List of transactions on the invoice
+    {{
+      "description": "",     # Description of the transaction
+      "amount_pre_vat": "",  # Amount before VAT
+      "vat_percentage": "",  # VAT rate applied to the transaction
+      "vat_category": ""     # One of the predefined VAT categories (see below)
+    }}
+  ],
+  "subtotal": "",            # Subtotal (excluding VAT)
+  "vat_amount": "",          # VAT amount
+  "total_amount": "",        # Total amount (including VAT)
+  "source_file": ""          # Filename of the invoice PDF
+}}
 
 ## VAT Categories:
+Use the SALE categories for sales and the PURCHASE categories for purchases (Step 1).
 
 **SALE Categories:**
 - 1a → Domestic sales taxed at 21% (standard rate, NL)  
@@ -139,6 +241,11 @@ Given an invoice document, extract the required fields and return the data in th
 Return ONLY valid JSON. Do not include any explanations, markdown, or additional text. The **source_file** should contain only the filename, no API keys or sensitive info.
 """
 
+# "combined": one OpenAI call per invoice (LLM_COMBINED_PROMPT);
+# "two-step": classification, then extraction (to compare accuracy)
+LLM_PIPELINE_MODES = ("combined", "two-step")
+LLM_PIPELINE_MODE = os.getenv("VAT_LLM_PIPELINE", "combined")
+
 import platform
 
 def get_company_context(company_name=None, company_vat=None):
@@ -164,6 +271,42 @@ def format_date_human_readable(date_str):
     except:
         return date_str
 
+ISO_DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+def try_parse_date(date_str):
+    if not isinstance(date_str, str):
+        return None
+    date_str = date_str.strip()
+    # Fast path for ISO dates (the common input format). None of the other
+    # formats can match a YYYY-MM-DD string, so the result is the same.
+    if ISO_DATE_PATTERN.fullmatch(date_str):
+        try:
+            return datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            return None
+    for fmt in ("%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y", "%d-%m-%y", "%d/%m/%y", "%d.%m.%y", "%d %B %Y", "%d %b %Y", "%b %d, %Y", "%B %d, %Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+def get_period_keys(date_str):
+    """
+    Parse an invoice date once (at ingest) and return the keys reports filter on:
+    {"date_iso": "2025-07-28", "period_year": 2025, "period_month": 7, "period_quarter": 3}
+    All values are None if the date can't be parsed.
+    """
+    dt = try_parse_date(date_str)
+    if not dt:
+        return {"date_iso": None, "period_year": None, "period_month": None, "period_quarter": None}
+    return {
+        "date_iso": dt.date().isoformat(),
+        "period_year": dt.year,
+        "period_month": dt.month,
+        "period_quarter": (dt.month - 1) // 3 + 1
+    }
+
 
 def normalize_amount(euro_str):
     try:
@@ -194,6 +337,21 @@ def normalize_amount(euro_str):
     except (ValueError, TypeError, AttributeError):
         return 0.0
 
+def round_to_cents(amount):
+    """Integer cents of an amount, rounded once like round(amount, 2)"""
+    rounded = round(amount, 2)
+    if rounded != rounded or rounded in (float("inf"), float("-inf")):
+        return 0
+    return int(round(rounded * 100))
+
+def amount_to_cents(euro_str):
+    """Integer cents of a raw amount (same parsing and rounding as normalize_amount)"""
+    return round_to_cents(normalize_amount(euro_str))
+
+def cents_to_amount(cents):
+    """Amount in euros (float, as returned by the API) of integer cents"""
+    return cents / 100
+
 def calculate_vat_amount(pre_vat_amount, vat_percentage):
     """Calculate VAT amount from pre-VAT amount and percentage"""
     try:
@@ -248,91 +406,10 @@ def map_vat_category_to_code(vat_category_str, transaction_type, vat_percentage=
     
     Returns:
         Standard VAT category code (1a, 1b, 1c, 2a, 3a, 3b, 4a, 4b, 5b, etc.)
-    """
-    vat_category_str = str(vat_category_str).strip().lower()
-    transaction_type = str(transaction_type).strip().lower()
     
-    # Reverse Charge - always 2a
-    if "reverse charge" in vat_category_str or "reverse-charge" in vat_category_str:
-        return "2a"
-    
-    # Zero Rated
-    if "zero rated" in vat_category_str or "zero-rated" in vat_category_str or "zero rated" in vat_category_str.lower():
-        if transaction_type in ["sales", "sale"]:
-            # Check if it's EU supply or export
-            if "eu" in vat_category_str.lower() or "intra" in vat_category_str.lower():
-                return "3a"  # Goods to EU countries
-            else:
-                return "1c"  # Sales with 0% VAT (exports or zero-rated)
-        elif transaction_type in ["purchase", "purchases"]:
-            # Check if it's from EU
-            if "eu" in vat_category_str.lower() or "intra" in vat_category_str.lower():
-                return "4a"  # Goods from EU countries
-            else:
-                return "4a"  # Default to goods from EU for zero-rated purchases
-        else:
-            return "1c"  # Default to sales category
-    
-    # Standard Rate
-    if "standard rate" in vat_category_str:
-        if transaction_type in ["sales", "sale"]:
-            if vat_percentage == 21:
-                return "1a"  # Standard 21%
-            elif vat_percentage == 9:
-                return "1b"  # Reduced 9%
-            else:
-                return "1a"  # Default to 1a
-        elif transaction_type in ["purchase", "purchases"]:
-            return "5b"  # Input VAT on domestic purchases
-        else:
-            return "1a"  # Default
-    
-    # EU Supplies
-    if "eu" in vat_category_str or "intra-community" in vat_category_str:
-        if transaction_type in ["sales", "sale"]:
-            if "goods" in vat_category_str:
-                return "3a"  # Goods to EU
-            elif "services" in vat_category_str:
-                return "3b"  # Services to EU
-            else:
-                return "3a"  # Default to goods
-        elif transaction_type in ["purchase", "purchases"]:
-            if "goods" in vat_category_str:
-                return "4a"  # Goods from EU
-            elif "services" in vat_category_str:
-                return "4b"  # Services from EU
-            else:
-                return "4a"  # Default to goods
-    
-    # Import/Export
-    if "import" in vat_category_str:
-        return "4c"  # Imports from non-EU
-    if "export" in vat_category_str:
-        return "1c"  # Exports (zero-rated)
-    
-    # Default mapping based on transaction type and VAT percentage
-    if transaction_type in ["sales", "sale"]:
-        if vat_percentage == 21:
-            return "1a"
-        elif vat_percentage == 9:
-            return "1b"
-        elif vat_percentage == 0:
-            return "1c"
-        else:
-            return "1a"  # Default
-    elif transaction_type in ["purchase", "purchases"]:
-        if vat_percentage == 0:
-            return "2a"  # Likely reverse charge
-        else:
-            return "5b"  # Input VAT
-    else:
-        # Unclassified - try to infer from VAT percentage
-        if vat_percentage == 0:
-            return "1c"
-        elif vat_percentage == 9:
-            return "1b"
-        else:
-            return "1a"
+    The rules are the REGISTER_RULES decision table in vat_classifier.py.
+    """
+    return register_classifier.classify(vat_category_str, transaction_type, vat_percentage)
 
 def transform_register_entry_to_invoice(register_entry, file_name=""):
     """
@@ -462,30 +539,36 @@ def transform_register_entry_to_invoice(register_entry, file_name=""):
             "source_file": file_name
         }
         
+        # Parse the date once: reports filter on these integer keys
+        invoice.update(get_period_keys(date_str))
+        
         return invoice
     except Exception as e:
         print(f"Error transforming register_entry: {e}")
         return None
 
-def process_json_invoices(user_id, json_data, storage_dict=None):
+def process_json_invoices(user_id, json_data, store=None, events=None):
     """
-    Process invoices from new JSON format and store in memory (or S3 if enabled)
+    Process invoices from new JSON format and store them (in the storage backend, or S3 if enabled)
     
     Args:
         user_id: User identifier
         json_data: Dictionary with 'results' array containing register_entry objects
-        storage_dict: Optional dictionary to store data (for in-memory storage)
+        store: Optional storage backend (see storage.py) to save the invoices in
+        events: Optional event hub (see events.py) to publish the changed years/months to
     
     Returns:
         Dictionary with processing results
     """
-    # Use in-memory storage if provided, otherwise use S3 (if enabled)
-    if storage_dict is not None:
-        # In-memory storage - load existing data for this user
-        all_year_data = storage_dict.get(user_id, {}).copy()  # Make a copy to avoid modifying original during processing
-        if not all_year_data:
-            all_year_data = {}
-    else:
+    from storage import DuplicateIndex  # imported here: storage.py imports this module
+    
+    # New invoices per year, and an index to catch duplicates within this batch
+    # (stored invoices are checked with the storage backend's duplicate index)
+    all_year_data = {}
+    batch_index = DuplicateIndex()
+    
+    # Use the storage backend if provided, otherwise use S3 (if enabled)
+    if store is None:
         # ==================== COMMENTED OUT - S3 Integration ====================
         # results_folder = f"users/{user_id}/results"
         # 
@@ -498,12 +581,13 @@ def process_json_invoices(user_id, json_data, storage_dict=None):
         #         content = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode('utf-8')
         #         year = key.split("VATanalysis_")[-1].split(".json")[0]
         #         all_year_data[year] = json.loads(content)
-        all_year_data = {}
+        pass
     
     updated_years = set()
     processed_count = 0
     skipped_count = 0
     error_count = 0
+    new_invoices = []  # (year, invoice) pairs written in one batch at the end
     
     # Process each result
     results = json_data.get("results", [])
@@ -550,24 +634,14 @@ def process_json_invoices(user_id, json_data, storage_dict=None):
         is_duplicate = False
         duplicate_reason = ""
         if invoice_no:
-            for year_data in all_year_data.values():
-                for inv in year_data.get("invoices", []):
-                    if inv.get("invoice_no") == invoice_no:
-                        is_duplicate = True
-                        duplicate_reason = f"Invoice number '{invoice_no}' already exists"
-                        break
-                if is_duplicate:
-                    break
+            if batch_index.has_invoice(invoice_no=invoice_no) or (store is not None and store.has_invoice(user_id, invoice_no=invoice_no)):
+                is_duplicate = True
+                duplicate_reason = f"Invoice number '{invoice_no}' already exists"
         elif source_file:
             # If no invoice number, check by source file
-            for year_data in all_year_data.values():
-                for inv in year_data.get("invoices", []):
-                    if inv.get("source_file") == source_file:
-                        is_duplicate = True
-                        duplicate_reason = f"Source file '{source_file}' already exists"
-                        break
-                if is_duplicate:
-                    break
+            if batch_index.has_invoice(source_file=source_file) or (store is not None and store.has_invoice(user_id, source_file=source_file)):
+                is_duplicate = True
+                duplicate_reason = f"Source file '{source_file}' already exists"
         
         if is_duplicate:
             skipped_count += 1
@@ -579,27 +653,18 @@ def process_json_invoices(user_id, json_data, storage_dict=None):
             all_year_data[year] = {"invoices": []}
         
         all_year_data[year]["invoices"].append(invoice)
+        new_invoices.append((year, invoice))
+        batch_index.add(year, invoice)
         updated_years.add(year)
         processed_count += 1
     
     # Save updated files
-    if storage_dict is not None:
-        # In-memory storage
-        if user_id not in storage_dict:
-            storage_dict[user_id] = {}
-        # Merge with existing data (don't overwrite, merge years)
-        for year, year_data in all_year_data.items():
-            if year in storage_dict[user_id]:
-                # Merge invoices - avoid duplicates
-                existing_invoices = {inv.get("invoice_no"): inv for inv in storage_dict[user_id][year].get("invoices", [])}
-                new_invoices = year_data.get("invoices", [])
-                for new_inv in new_invoices:
-                    inv_no = new_inv.get("invoice_no")
-                    if inv_no and inv_no not in existing_invoices:
-                        existing_invoices[inv_no] = new_inv
-                storage_dict[user_id][year]["invoices"] = list(existing_invoices.values())
-            else:
-                storage_dict[user_id][year] = year_data
+    if store is not None:
+        # Only the new invoices are written, in a single transaction
+        store.add_invoices(user_id, new_invoices)
+        if events is not None and new_invoices:
+            years, months = changed_periods(new_invoices)
+            events.publish(user_id, "invalidate", {"source": "process-json-invoices", "years": years, "months": months})
     else:
         # ==================== COMMENTED OUT - S3 Integration ====================
         # # Save updated files
@@ -670,11 +735,10 @@ def is_gemini_data_valid(data):
     return False
 
 
-def get_user_company_details(user_id, storage_dict=None):
-    """Get company details for a user from memory (or S3 if enabled)"""
-    if storage_dict is not None:
-        # In-memory storage
-        company_data = storage_dict.get(user_id)
+def get_user_company_details(user_id, store=None):
+    """Get company details for a user from the storage backend (or S3 if enabled)"""
+    if store is not None:
+        company_data = store.get_company_details(user_id)
         if company_data:
             return {
                 'company_name': company_data.get('company_name'),
@@ -741,13 +805,10 @@ def process_data(user_id, company_name=None, company_vat=None):
     #     # 
     #     #     textract_data = extract_with_textract(pdf_file_bytes)
     #     # 
-    #     #     # Step 1: Classify the invoice
-    #     #     transaction_type = classify_invoice_with_openai(pdf_file_bytes, pdf_file_simple_name, company_name, company_vat)
-    #     #     
-    #     #     # Step 2: Extract data with classification context
+    #     #     # Classify the invoice and extract its data (one call, or two with VAT_LLM_PIPELINE=two-step)
     #     #     openai_data = None
     #     #     for attempt in range(3):
-    #     #         openai_data = extract_with_openai(pdf_file_bytes, transaction_type, pdf_file_simple_name, company_name, company_vat)
+    #     #         openai_data = analyze_invoice_with_openai(pdf_file_bytes, pdf_file_simple_name, company_name, company_vat)
     #     #         if is_gemini_data_valid(openai_data):  # Reusing the same validation function
     #     #             break
     #     #         print(f"🟡 OpenAI call returned incomplete data (attempt {attempt + 1}/3). Retrying after 60s...")
@@ -878,58 +939,120 @@ def extract_with_textract(pdf_bytes):
         print(f"Textract error: {e}")
         return extracted
 
+# Task -> (prompt template, max_tokens) of the OpenAI calls
+LLM_TASKS = {
+    "classify": (LLM_CLASSIFICATION_PROMPT, 100),
+    "extract": (LLM_EXTRACTION_PROMPT, 4000),
+    "classify-extract": (LLM_COMBINED_PROMPT, 4000)
+}
+
+openai_client = None
+
+def get_openai_client():
+    """Shared OpenAI client (keeps its HTTP connections alive between calls)"""
+    global openai_client
+    if openai_client is None:
+        # Retries are done by llm_retry
+        openai_client = openai.OpenAI(api_key=openai.api_key, max_retries=0)
+    return openai_client
+
+def prepare_llm_call(task, pdf_bytes, company_context, filename="", transaction_type=None):
+    """Prompt, max_tokens and cache key of one OpenAI call (a task of LLM_TASKS)"""
+    template, max_tokens = LLM_TASKS[task]
+    prompt = template.format(
+        company_name_placeholder=company_context['company_name'],
+        company_vat_placeholder=company_context['company_vat']
+    )
+    
+    # Add transaction type and filename context to the prompt
+    context_info = []
+    if transaction_type:
+        context_info.append(f"- Transaction Type: {transaction_type.upper()}")
+    if filename:
+        context_info.append(f"- Filename: {filename}")
+    if context_info:
+        prompt += f"\n\n## Context:\n" + "\n".join(context_info)
+    
+    params = {"filename": filename, "max_tokens": max_tokens, "temperature": 0.1,
+              "preprocess": pdf_preprocessor.settings()}
+    if task == "extract":
+        params["transaction_type"] = transaction_type
+    cache_key = llm_cache_key(task, pdf_bytes, template, company_context, OPENAI_MODEL, **params)
+    return prompt, max_tokens, cache_key
+
+def openai_pdf_request(prompt, pdf_bytes, max_tokens, filename=""):
+    """Arguments of chat.completions.create(): the prompt with the invoice (text layer, page images or PDF)"""
+    payload = pdf_preprocessor.prepare(pdf_bytes, filename)
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}] + payload.content_parts()
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.1
+    }
+
+def completion_text(response):
+    """Response text without a markdown wrapper"""
+    raw = response.choices[0].message.content.strip()
+
+    # Clean any markdown wrapper if present
+    if raw.startswith("```"):
+        raw = raw.split("```json")[-1].strip("` \n")
+    return raw
+
+def openai_pdf_completion(prompt, pdf_bytes, max_tokens, filename=""):
+    """Send a prompt with the PDF to OpenAI; returns the response text without a markdown wrapper"""
+    request = openai_pdf_request(prompt, pdf_bytes, max_tokens, filename)
+    response = llm_retry.call(get_openai_client().chat.completions.create, **request)
+    return completion_text(response)
+
+def parse_llm_json(raw):
+    result = json.loads(raw)
+    if not isinstance(result, dict):
+        raise ValueError(f"Expected a JSON object, got {type(result).__name__}")
+    return result
+
+def openai_json(task, pdf_bytes, company_context, filename="", transaction_type=None):
+    """JSON object answered to one OpenAI call (from llm_cache if known) and whether it was cached"""
+    prompt, max_tokens, cache_key = prepare_llm_call(task, pdf_bytes, company_context, filename, transaction_type)
+    raw = llm_cache.get(cache_key)
+    if raw is not None:
+        return parse_llm_json(raw), True
+    raw = openai_pdf_completion(prompt, pdf_bytes, max_tokens, filename)
+    result = parse_llm_json(raw)
+    llm_cache.put(cache_key, task, raw)
+    return result, False
+
+def classification_type(classification):
+    return classification.get("transaction_type", "sale").lower()
+
+def combined_invoice(structured):
+    """Invoice data of the combined prompt, its transaction type normalized"""
+    transaction_type = str(structured.get("transaction_type") or "sale").strip().lower()
+    # Default to sale like the classification step
+    structured["transaction_type"] = transaction_type if transaction_type in ("sale", "purchase") else "sale"
+    return structured
+
 def classify_invoice_with_openai(pdf_bytes, filename="", company_name=None, company_vat=None):
     """Step 1: Classify invoice as SALE or PURCHASE"""
     try:
         print("🔍 Classifying invoice type...")
         
-        # Convert PDF bytes to base64
-        pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
-        
-        # Get company context and format the prompt
         company_context = get_company_context(company_name, company_vat)
-        classification_prompt = LLM_CLASSIFICATION_PROMPT.format(
-            company_name_placeholder=company_context['company_name'],
-            company_vat_placeholder=company_context['company_vat']
-        )
+        classification, cached = openai_json("classify", pdf_bytes, company_context, filename)
+        transaction_type = classification_type(classification)
         
-        # Add filename context to the prompt
-        if filename:
-            classification_prompt += f"\n\n## Context:\n- Filename: {filename}"
-        
-        client = openai.OpenAI(api_key=openai.api_key)
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": classification_prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:application/pdf;base64,{pdf_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=100,
-            temperature=0.1
-        )
-
-        raw = response.choices[0].message.content.strip()
-
-        # Clean any markdown wrapper if present
-        if raw.startswith("```"):
-            raw = raw.split("```json")[-1].strip("` \n")
-
-        classification = json.loads(raw)
-        transaction_type = classification.get("transaction_type", "sale").lower()
-        
-        print(f"✅ Invoice classified as: {transaction_type.upper()}")
+        print(f"✅ Invoice classified as: {transaction_type.upper()}{' (cached)' if cached else ''}")
         return transaction_type
 
+    except LLMUnavailable as e:
+        # Not a classification: guessing "sale" would misclassify purchases
+        print(f"❌ Classification failed, OpenAI unavailable: {e}")
+        raise
     except Exception as e:
         print(f"Classification error: {e}")
         return "sale"  # Default to sale if classification fails
@@ -939,65 +1062,133 @@ def extract_with_openai(pdf_bytes, transaction_type="sale", filename="", company
     try:
         print("🧠 Extracting invoice data...")
         
-        # Convert PDF bytes to base64
-        pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
-        
-        # Get company context and format the prompt
         company_context = get_company_context(company_name, company_vat)
-        extraction_prompt = LLM_EXTRACTION_PROMPT.format(
-            company_name_placeholder=company_context['company_name'],
-            company_vat_placeholder=company_context['company_vat']
-        )
-        
-        # Add transaction type and filename context to the prompt
-        if transaction_type or filename:
-            context_info = []
-            if transaction_type:
-                context_info.append(f"- Transaction Type: {transaction_type.upper()}")
-            if filename:
-                context_info.append(f"- Filename: {filename}")
-            
-            extraction_prompt += f"\n\n## Context:\n" + "\n".join(context_info)
-        
-        client = openai.OpenAI(api_key=openai.api_key)
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": extraction_prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:application/pdf;base64,{pdf_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=4000,
-            temperature=0.1
-        )
-
-        raw = response.choices[0].message.content.strip()
-
-        # Clean any markdown wrapper if present
-        if raw.startswith("```"):
-            raw = raw.split("```json")[-1].strip("` \n")
-
-        structured = json.loads(raw)
+        structured, cached = openai_json("extract", pdf_bytes, company_context, filename, transaction_type)
         
         # Add transaction type to the extracted data
         structured["transaction_type"] = transaction_type
 
-        print("✅ OpenAI structured JSON extracted.")
+        print(f"✅ OpenAI structured JSON extracted{' (cached)' if cached else ''}.")
+        return structured
+
+    except LLMUnavailable as e:
+        print(f"❌ Extraction failed, OpenAI unavailable: {e}")
+        raise
+    except Exception as e:
+        print(f"OpenAI error: {e}")
+        return {}
+
+def classify_and_extract_with_openai(pdf_bytes, filename="", company_name=None, company_vat=None):
+    """Steps 1 + 2 in one OpenAI call: invoice data with its transaction type"""
+    try:
+        print("🧠 Classifying and extracting invoice data...")
+        
+        company_context = get_company_context(company_name, company_vat)
+        structured, cached = openai_json("classify-extract", pdf_bytes, company_context, filename)
+        combined_invoice(structured)
+
+        print(f"✅ Invoice classified as: {structured['transaction_type'].upper()}, "
+              f"structured JSON extracted{' (cached)' if cached else ''}.")
         return structured
 
+    except LLMUnavailable as e:
+        print(f"❌ Extraction failed, OpenAI unavailable: {e}")
+        raise
     except Exception as e:
         print(f"OpenAI error: {e}")
         return {}
 
+def llm_pipeline_mode(mode=None):
+    """The given pipeline mode, or VAT_LLM_PIPELINE"""
+    mode = mode or LLM_PIPELINE_MODE
+    if mode not in LLM_PIPELINE_MODES:
+        raise ValueError(f"Unknown LLM pipeline mode {mode!r}, expected one of {LLM_PIPELINE_MODES}")
+    return mode
+
+def analyze_invoice_with_openai(pdf_bytes, filename="", company_name=None, company_vat=None, mode=None):
+    """
+    Transaction type and invoice data of a PDF invoice, in one OpenAI call ("combined")
+    or two ("two-step"); mode defaults to VAT_LLM_PIPELINE
+    """
+    if llm_pipeline_mode(mode) == "combined":
+        return classify_and_extract_with_openai(pdf_bytes, filename, company_name, company_vat)
+    transaction_type = classify_invoice_with_openai(pdf_bytes, filename, company_name, company_vat)
+    return extract_with_openai(pdf_bytes, transaction_type, filename, company_name, company_vat)
+
+# ==================== CONCURRENT PDF EXTRACTION ====================
+# Batches of PDFs run on llm_pool (see llm_pool.py): one shared AsyncOpenAI client,
+# bounded concurrency, per-user turns and a requests-per-minute limit.
+
+async def openai_json_async(task, pdf_bytes, company_context, filename="", transaction_type=None):
+    """openai_json() on llm_pool's AsyncOpenAI client (cache lookups on a thread)"""
+    prompt, max_tokens, cache_key = prepare_llm_call(task, pdf_bytes, company_context, filename, transaction_type)
+    raw = await asyncio.to_thread(llm_cache.get, cache_key)
+    if raw is not None:
+        return parse_llm_json(raw), True
+    # Preprocessing may render pages: off the event loop
+    request = await asyncio.to_thread(openai_pdf_request, prompt, pdf_bytes, max_tokens, filename)
+    raw = completion_text(await llm_retry.acall(llm_pool.chat, **request))
+    result = parse_llm_json(raw)
+    await asyncio.to_thread(llm_cache.put, cache_key, task, raw)
+    return result, False
+
+async def analyze_invoice_async(pdf_bytes, filename="", company_name=None, company_vat=None, mode=None):
+    """
+    analyze_invoice_with_openai() with async OpenAI calls (same fallbacks: "sale", {};
+    raises LLMUnavailable likewise)
+    """
+    mode = llm_pipeline_mode(mode)
+    company_context = get_company_context(company_name, company_vat)
+    if mode == "combined":
+        try:
+            structured, _ = await openai_json_async("classify-extract", pdf_bytes, company_context, filename)
+            return combined_invoice(structured)
+        except LLMUnavailable:
+            raise
+        except Exception as e:
+            print(f"OpenAI error ({filename}): {e}")
+            return {}
+    
+    try:
+        classification, _ = await openai_json_async("classify", pdf_bytes, company_context, filename)
+        transaction_type = classification_type(classification)
+    except LLMUnavailable:
+        raise
+    except Exception as e:
+        print(f"Classification error ({filename}): {e}")
+        transaction_type = "sale"
+    try:
+        structured, _ = await openai_json_async("extract", pdf_bytes, company_context, filename, transaction_type)
+        structured["transaction_type"] = transaction_type
+        return structured
+    except LLMUnavailable:
+        raise
+    except Exception as e:
+        print(f"OpenAI error ({filename}): {e}")
+        return {}
+
+async def analyze_invoices_async(user_id, documents, company_name=None, company_vat=None, mode=None):
+    """
+    analyze_invoice_async() for each (filename, pdf_bytes) of documents, run concurrently
+    on llm_pool in the user's turns; results in document order ({} where extraction
+    failed, also when OpenAI was unavailable). Raises WorkerPoolFull if the pool's
+    queue can't take the batch.
+    """
+    mode = llm_pipeline_mode(mode)
+
+    async def analyze(pdf_bytes, filename, *args):
+        try:
+            return await analyze_invoice_async(pdf_bytes, filename, *args)
+        except LLMUnavailable as e:
+            print(f"❌ {filename}: OpenAI unavailable: {e}")
+            return {}
+
+    results = await llm_pool.run_many(user_id, analyze, [
+        (pdf_bytes, filename, company_name, company_vat, mode) for filename, pdf_bytes in documents
+    ])
+    print(f"✅ Extracted {sum(1 for result in results if result)}/{len(results)} PDF invoices for user {user_id}")
+    return results
+
 
 def resolve_invoice(textract_data, llm_data):
     resolved = textract_data.copy()  # Start with Textract values
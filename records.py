@@ -0,0 +1,143 @@
+"""
+Compact in-memory records for stored invoices.
+
+InvoiceRecord and TransactionRecord keep the fields of the invoice JSON shape
+in __slots__ instead of a dict per invoice and per transaction:
+- amounts as integer cents (float values with at most 2 decimals)
+- VAT category, country, transaction type and VAT percentage as interned strings
+- the key order as one shared tuple per distinct key layout
+
+to_dict() returns exactly the dict that from_dict() was given. Values that can't
+be stored compactly (e.g. amounts given as strings) and unknown keys are kept
+as they are in a small `extra` dict.
+"""
+
+import math
+import sys
+
+# Distinct key layouts are shared between records (bounded, in case of arbitrary keys)
+MAX_SHARED_LAYOUTS = 10000
+_layouts = {}
+
+# Returned by _encode(): keep the original value in extra
+_RAW = object()
+
+
+def shared_layout(keys):
+    """Return one shared tuple per distinct key order"""
+    layout = _layouts.get(keys)
+    if layout is None:
+        if len(_layouts) >= MAX_SHARED_LAYOUTS:
+            return keys
+        layout = _layouts.setdefault(keys, keys)
+    return layout
+
+
+def to_cents(value):
+    """Integer cents of a float amount with at most 2 decimals, or None if it can't be stored exactly"""
+    if type(value) is not float or not math.isfinite(value):
+        return None
+    cents = round(value * 100)
+    if cents / 100 != value or (cents == 0 and math.copysign(1.0, value) < 0):
+        return None
+    return cents
+
+
+class Record:
+    """
+    Base class: subclasses list their fields in __slots__ and classify them in
+    AMOUNT_FIELDS (stored as cents) and INTERNED_FIELDS (interned strings)
+    """
+
+    __slots__ = ("_layout", "_extra")
+
+    FIELDS = frozenset()
+    AMOUNT_FIELDS = frozenset()
+    INTERNED_FIELDS = frozenset()
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        extra = None
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                if key in cls.AMOUNT_FIELDS:
+                    cents = to_cents(value)
+                    if cents is not None:
+                        setattr(record, key, cents)
+                        continue
+                else:
+                    value = record._encode(key, value)
+                    if value is not _RAW:
+                        setattr(record, key, value)
+                        continue
+                    value = data[key]
+            if extra is None:
+                extra = {}
+            extra[key] = value
+        record._layout = shared_layout(tuple(data))
+        record._extra = extra
+        return record
+
+    def _encode(self, key, value):
+        if key in self.INTERNED_FIELDS and type(value) is str:
+            return sys.intern(value)
+        return value
+
+    def _decode(self, key, value):
+        return value
+
+    def to_dict(self):
+        extra = self._extra
+        amount_fields = self.AMOUNT_FIELDS
+        result = {}
+        for key in self._layout:
+            if extra is not None and key in extra:
+                result[key] = extra[key]
+            elif key in amount_fields:
+                result[key] = getattr(self, key) / 100
+            else:
+                result[key] = self._decode(key, getattr(self, key))
+        return result
+
+
+class TransactionRecord(Record):
+    """One transaction (VAT line) of an invoice"""
+
+    __slots__ = ("description", "amount_pre_vat", "vat_percentage", "vat_category", "vat_category_description")
+
+    FIELDS = frozenset(__slots__)
+    AMOUNT_FIELDS = frozenset({"amount_pre_vat"})
+    INTERNED_FIELDS = frozenset({"vat_percentage", "vat_category", "vat_category_description"})
+
+
+class InvoiceRecord(Record):
+    """A stored invoice; transactions are kept as a tuple of TransactionRecord"""
+
+    __slots__ = ("invoice_no", "date", "invoice_to", "country", "vat_no", "transactions",
+                 "subtotal", "vat_amount", "total_amount", "transaction_type", "source_file",
+                 "date_iso", "period_year", "period_month", "period_quarter")
+
+    FIELDS = frozenset(__slots__)
+    AMOUNT_FIELDS = frozenset({"subtotal", "vat_amount", "total_amount"})
+    INTERNED_FIELDS = frozenset({"country", "transaction_type"})
+
+    def _encode(self, key, value):
+        if key == "transactions":
+            if type(value) is list and all(type(tx) is dict for tx in value):
+                return tuple(TransactionRecord.from_dict(tx) for tx in value)
+            return _RAW
+        return Record._encode(self, key, value)
+
+    def _decode(self, key, value):
+        if key == "transactions":
+            return [tx.to_dict() for tx in value]
+        return value
+
+    def may_have_vat_category(self, vat_category):
+        """False only if no transaction of the invoice has this VAT category (cheap pre-filter)"""
+        if "transactions" not in self._layout:
+            return not vat_category
+        if self._extra is not None and "transactions" in self._extra:
+            return True
+        return any(getattr(tx, "vat_category", "") == vat_category for tx in self.transactions)
@@ -0,0 +1,114 @@
+"""
+In-process cache for report responses.
+
+Reports are cached as serialized JSON under (endpoint, user_id, year, period, data_version).
+The store increments a user's data version on every write, so a new upload or
+/clear-user-data makes the old entries unreachable; they age out of the LRU.
+Cached bodies are replayed as built, so generated_at is the time a report was
+built for its data version, not the time of the request.
+
+Configure the memory budget with VAT_REPORT_CACHE_MB (default: 64, 0 disables caching).
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from env_settings import env_setting
+
+# Rough per-entry overhead (key tuple, OrderedDict node) on top of the body size
+ENTRY_OVERHEAD_BYTES = 256
+
+# Part of every ETag: bump it when the report JSON changes (fields, rounding, order),
+# so clients holding an ETag from before a deploy get the new body instead of a 304
+REPORT_FORMAT_VERSION = 1
+
+
+class ReportCache:
+    """LRU cache of report bodies (bytes) bounded by total memory, with hit/miss counters"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached body for a key (and mark it recently used), or None"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        """Cache a body; least recently used entries are evicted to stay within the memory budget"""
+        size = len(body) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old) + ENTRY_OVERHEAD_BYTES
+            self._entries[key] = body
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted) + ENTRY_OVERHEAD_BYTES
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Hit/miss counters and memory usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+
+def report_etag(key, instance_id=""):
+    """
+    Strong ETag for a cache key. It only depends on the key (which includes the data
+    version), the store instance and REPORT_FORMAT_VERSION, so unchanged data keeps
+    its ETag even after the entry was evicted or the server restarted.
+    """
+    digest = hashlib.sha256(repr((REPORT_FORMAT_VERSION, instance_id, *key)).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches the ETag (weak comparison, like HTTP caches)"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def get_report_cache():
+    """Create the report cache with the memory budget from VAT_REPORT_CACHE_MB"""
+    max_mb = env_setting("VAT_REPORT_CACHE_MB", 64.0, 0.0, kind=float)
+    return ReportCache(max_bytes=int(max_mb * 1024 * 1024))
@@ -0,0 +1,904 @@
+"""
+Storage backends for invoice data, company details and PDF counts.
+
+Two backends implement the same InvoiceStore interface:
+- SQLiteStore (default): durable storage in a single SQLite file (WAL mode),
+  shared by every uvicorn worker process and kept across restarts
+- MemoryStore: in-process dictionaries of compact invoice records (records.py), lost on restart
+
+Readers that need several reads to agree (reports, totals checks) take a
+snapshot() of a user's data: writes go on, but the snapshot keeps seeing one
+data version (copy-on-write state in memory, a read transaction in SQLite).
+
+Select the backend with environment variables:
+- VAT_STORAGE_BACKEND: "sqlite" (default) or "memory"
+- VAT_SQLITE_PATH: database file for the SQLite backend (default: vat_data.db)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from processor import get_period_keys
+from aggregation import merge_invoice_totals
+from records import InvoiceRecord
+
+
+def ensure_period_keys(invoice):
+    """
+    Lazy migration: add date_iso / period_year / period_month / period_quarter to
+    invoices stored before dates were parsed at ingest. Returns True if the invoice changed.
+    """
+    if "date_iso" in invoice:
+        return False
+    invoice.update(get_period_keys(invoice.get("date", "")))
+    return True
+
+
+def invoice_month(invoice):
+    """Return the month number (1-12) of an invoice date, or None if the date can't be parsed"""
+    ensure_period_keys(invoice)
+    return invoice.get("period_month")
+
+
+def group_by_year(entries):
+    """Group (year, invoice) entries: {year: [invoices]} (in entry order), adding missing period keys"""
+    grouped = {}
+    for year, invoice in entries:
+        ensure_period_keys(invoice)
+        grouped.setdefault(year, []).append(invoice)
+    return grouped
+
+
+# ==================== DUPLICATE DETECTION INDEX ====================
+
+# Invoice fields used to detect duplicate uploads
+DUPLICATE_KEY_FIELDS = ("invoice_no", "source_file", "file_name")
+
+
+def duplicate_key(value):
+    """Return a field value usable as index key, or None if it can't be indexed"""
+    if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class DuplicateIndex:
+    """
+    Hash index of invoice_no / source_file / file_name values for one user.
+
+    Maps (field, value) -> {year: number of invoices}, so "does this invoice
+    number exist (in this year)?" is a constant-time lookup instead of a scan
+    over every stored invoice.
+    """
+
+    def __init__(self):
+        self._keys = {}
+
+    def add(self, year, invoice):
+        for field in DUPLICATE_KEY_FIELDS:
+            value = duplicate_key(invoice.get(field))
+            if value is None:
+                continue
+            years = self._keys.setdefault((field, value), {})
+            years[year] = years.get(year, 0) + 1
+
+    def remove(self, year, invoice):
+        for field in DUPLICATE_KEY_FIELDS:
+            value = duplicate_key(invoice.get(field))
+            years = self._keys.get((field, value))
+            if not years or year not in years:
+                continue
+            years[year] -= 1
+            if years[year] <= 0:
+                del years[year]
+            if not years:
+                del self._keys[(field, value)]
+
+    def has_invoice(self, year=None, invoice_no=None, source_file=None, file_name=None):
+        """True if any given value is already used (in the given year, or in any year if year is None)"""
+        for field, value in (("invoice_no", invoice_no), ("source_file", source_file), ("file_name", file_name)):
+            value = duplicate_key(value)
+            if value is None:
+                continue
+            years = self._keys.get((field, value))
+            if years and (year is None or year in years):
+                return True
+        return False
+
+
+# ==================== STORAGE INTERFACE ====================
+
+class InvoiceStore:
+    """
+    Interface shared by all storage backends.
+
+    Invoices are grouped per user and year (the year key is a string, e.g. "2025"
+    or "unknown") and indexed by month so reports only read the period they need.
+
+    Every backend also keeps materialized totals per (user, year, month), updated
+    in the same write as the invoices, so report totals don't need an invoice scan
+    (see aggregation.invoice_totals for the row layout).
+
+    Each write increments the user's data version, which report caches use as part
+    of their keys. instance_id identifies the store (versions restart with a new store).
+    """
+
+    instance_id = ""
+
+    def snapshot(self, user_id):
+        """Consistent read-only view of a user's data (StoreSnapshot) that writes don't change"""
+        raise NotImplementedError
+
+    def add_invoices(self, user_id, entries):
+        """Store a batch of (year, invoice) pairs in a single transaction"""
+        raise NotImplementedError
+
+    def get_invoices(self, user_id, year, months=None):
+        """Get invoices of a year in insertion order, optionally only for the given month numbers"""
+        raise NotImplementedError
+
+    def iter_invoices(self, user_id, year, months=None, vat_category=None, batch_size=500):
+        """
+        Iterate over the same invoices as get_invoices (in the same order) without
+        loading them all at once; backends read them in batches of batch_size.
+        With vat_category, invoices none of whose transactions have that category
+        may be left out (a pre-filter: callers still check the lines).
+        """
+        raise NotImplementedError
+
+    def count_invoices(self, user_id, year):
+        """Count all invoices stored for a year (including invoices with unparseable dates)"""
+        raise NotImplementedError
+
+    def has_invoice(self, user_id, year=None, invoice_no=None, source_file=None, file_name=None):
+        """
+        Duplicate check: True if a stored invoice has the given invoice_no, source_file
+        or file_name (any of the values that are not None). Limited to one year unless
+        year is None.
+        """
+        raise NotImplementedError
+
+    def get_category_totals(self, user_id, year, months=None):
+        """
+        Materialized VAT line totals (integer cents) of a year, optionally only for the given
+        month numbers: [(month, vat_category, dreport_code, is_sale, net_cents, vat_cents, line_count), ...]
+        """
+        raise NotImplementedError
+
+    def get_invoice_totals(self, user_id, year):
+        """
+        Materialized invoice-level totals of a year (month 0 = unparseable date):
+        [(month, is_sale, vat_cents, invoice_count), ...]
+        """
+        raise NotImplementedError
+
+    def get_user_invoices(self, user_id):
+        """Get all invoices of a user grouped by year: {year: [invoices]}"""
+        raise NotImplementedError
+
+    def clear_user(self, user_id):
+        """Delete invoices, totals and company details and reset the PDF count of a user"""
+        raise NotImplementedError
+
+    def get_data_version(self, user_id):
+        """Current data version of a user (0 if nothing was written yet)"""
+        raise NotImplementedError
+
+    def get_company_details(self, user_id):
+        """Get company details dict ({company_name, company_vat, updated_at}) or None"""
+        raise NotImplementedError
+
+    def set_company_details(self, user_id, company_name, company_vat):
+        """Create or replace company details for a user"""
+        raise NotImplementedError
+
+    def get_pdf_count(self, user_id):
+        """Get the number of PDFs uploaded by a user"""
+        raise NotImplementedError
+
+    def increment_pdf_count(self, user_id, amount=1):
+        """Increase the PDF count of a user"""
+        raise NotImplementedError
+
+
+class StoreSnapshot:
+    """
+    Read-only view of one user's data at one data version (see InvoiceStore.snapshot).
+
+    It has the read methods of InvoiceStore with the same signatures, so it can be
+    passed wherever a store is only read (e.g. aggregation.check_totals), and all of
+    them see the same data even while other requests write. Close it when done
+    (or use it as a context manager).
+    """
+
+    data_version = 0
+
+    def get_invoices(self, user_id, year, months=None):
+        raise NotImplementedError
+
+    def iter_invoices(self, user_id, year, months=None, vat_category=None, batch_size=500):
+        raise NotImplementedError
+
+    def count_invoices(self, user_id, year):
+        raise NotImplementedError
+
+    def get_category_totals(self, user_id, year, months=None):
+        raise NotImplementedError
+
+    def get_invoice_totals(self, user_id, year):
+        raise NotImplementedError
+
+    def get_data_version(self, user_id):
+        raise NotImplementedError
+
+    def get_company_details(self, user_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ==================== IN-MEMORY BACKEND ====================
+
+class YearData:
+    """Invoices and materialized totals of one user and year (never changed once published)"""
+
+    __slots__ = ("rows", "count", "category_totals", "invoice_totals")
+
+    def __init__(self, rows, count, category_totals, invoice_totals):
+        # rows is only appended to and shared by the versions of a year: a version reads rows[:count]
+        self.rows = rows
+        self.count = count
+        # {(month, vat_category, dreport_code, is_sale): (net_cents, vat_cents, line_count)}
+        self.category_totals = category_totals
+        # {(month, is_sale): (vat_cents, invoice_count)}
+        self.invoice_totals = invoice_totals
+
+
+class UserData:
+    """One version of a user's data in MemoryStore; writes publish a new UserData"""
+
+    __slots__ = ("version", "years", "company_details")
+
+    def __init__(self, version=0, years=None, company_details=None):
+        self.version = version
+        # {year: YearData}
+        self.years = years if years is not None else {}
+        # {company_name, company_vat, updated_at} or None
+        self.company_details = company_details
+
+
+EMPTY_YEAR = YearData((), 0, {}, {})
+
+
+def add_totals(stored, added):
+    """New totals dict: stored plus added ({key: values}, values summed element-wise)"""
+    totals = dict(stored)
+    for key, values in added.items():
+        previous = totals.get(key)
+        totals[key] = tuple(values) if previous is None else tuple(a + b for a, b in zip(previous, values))
+    return totals
+
+
+class MemorySnapshot(StoreSnapshot):
+    """A published UserData: nothing in it changes, so reads need no lock"""
+
+    def __init__(self, user_id, user_data):
+        self.user_id = user_id
+        self.user_data = user_data
+        self.data_version = user_data.version
+
+    def _check_user(self, user_id):
+        if user_id != self.user_id:
+            raise ValueError(f"Snapshot of user {self.user_id!r} read for user {user_id!r}")
+
+    def _year(self, user_id, year):
+        self._check_user(user_id)
+        return self.user_data.years.get(year, EMPTY_YEAR)
+
+    def get_invoices(self, user_id, year, months=None):
+        data = self._year(user_id, year)
+        rows = data.rows[:data.count]
+        if months is None:
+            return [record.to_dict() for _, record in rows]
+        months = set(months)
+        return [record.to_dict() for month, record in rows if month in months]
+
+    def iter_invoices(self, user_id, year, months=None, vat_category=None, batch_size=500):
+        data = self._year(user_id, year)
+        if months is not None:
+            months = set(months)
+        for i in range(data.count):
+            month, record = data.rows[i]
+            if months is not None and month not in months:
+                continue
+            if vat_category is None or record.may_have_vat_category(vat_category):
+                yield record.to_dict()
+
+    def count_invoices(self, user_id, year):
+        return self._year(user_id, year).count
+
+    def get_category_totals(self, user_id, year, months=None):
+        totals = self._year(user_id, year).category_totals
+        if months is not None:
+            months = set(months)
+        return [(*key, *values) for key, values in totals.items() if months is None or key[0] in months]
+
+    def get_invoice_totals(self, user_id, year):
+        return [(*key, *values) for key, values in self._year(user_id, year).invoice_totals.items()]
+
+    def get_data_version(self, user_id):
+        self._check_user(user_id)
+        return self.data_version
+
+    def get_company_details(self, user_id):
+        self._check_user(user_id)
+        return self.user_data.company_details
+
+
+class MemoryStore(InvoiceStore):
+    """
+    In-process dictionaries (original behaviour). Data is lost on restart and not shared between workers.
+
+    Each user's data is one UserData that writes replace instead of changing
+    (copy-on-write; invoice rows are appended to a shared list, and a version only
+    reads the rows it counted), so a snapshot is just the current UserData.
+    """
+
+    def __init__(self):
+        # {user_id: UserData}
+        self.users = {}
+        # {user_id: count}
+        self.user_pdf_count = defaultdict(int)
+        # {user_id: DuplicateIndex}
+        self.duplicate_index = defaultdict(DuplicateIndex)
+        self.instance_id = uuid.uuid4().hex
+        # Serializes writers; readers don't take it
+        self._lock = threading.Lock()
+
+    def snapshot(self, user_id):
+        return MemorySnapshot(user_id, self.users.get(user_id) or UserData())
+
+    def _publish(self, user_id, user_data, **changes):
+        """Replace a user's data by a copy of user_data with the given changes and the next version"""
+        self.users[user_id] = UserData(
+            version=user_data.version + 1,
+            years=changes.get("years", user_data.years),
+            company_details=changes.get("company_details", user_data.company_details)
+        )
+
+    def add_invoices(self, user_id, entries):
+        if not entries:
+            return
+        batch_totals = {year: merge_invoice_totals(invoices) for year, invoices in group_by_year(entries).items()}
+        rows_by_year = {}
+        for year, invoice in entries:
+            rows_by_year.setdefault(year, []).append((invoice_month(invoice), InvoiceRecord.from_dict(invoice)))
+        with self._lock:
+            user_data = self.users.get(user_id) or UserData()
+            years = dict(user_data.years)
+            for year, rows in rows_by_year.items():
+                previous = years.get(year, EMPTY_YEAR)
+                stored_rows = previous.rows if previous.count else []
+                stored_rows.extend(rows)
+                line_totals, invoice_totals = batch_totals[year]
+                years[year] = YearData(
+                    stored_rows, len(stored_rows),
+                    add_totals(previous.category_totals, line_totals),
+                    add_totals(previous.invoice_totals, invoice_totals)
+                )
+            index = self.duplicate_index[user_id]
+            for year, invoice in entries:
+                index.add(year, invoice)
+            self._publish(user_id, user_data, years=years)
+
+    def get_invoices(self, user_id, year, months=None):
+        return self.snapshot(user_id).get_invoices(user_id, year, months)
+
+    def iter_invoices(self, user_id, year, months=None, vat_category=None, batch_size=500):
+        return self.snapshot(user_id).iter_invoices(user_id, year, months, vat_category, batch_size)
+
+    def count_invoices(self, user_id, year):
+        return self.snapshot(user_id).count_invoices(user_id, year)
+
+    def has_invoice(self, user_id, year=None, invoice_no=None, source_file=None, file_name=None):
+        index = self.duplicate_index.get(user_id)
+        if index is None:
+            return False
+        return index.has_invoice(year, invoice_no=invoice_no, source_file=source_file, file_name=file_name)
+
+    def get_category_totals(self, user_id, year, months=None):
+        return self.snapshot(user_id).get_category_totals(user_id, year, months)
+
+    def get_invoice_totals(self, user_id, year):
+        return self.snapshot(user_id).get_invoice_totals(user_id, year)
+
+    def get_user_invoices(self, user_id):
+        snapshot = self.snapshot(user_id)
+        return {year: snapshot.get_invoices(user_id, year) for year in snapshot.user_data.years}
+
+    def clear_user(self, user_id):
+        with self._lock:
+            user_data = self.users.get(user_id) or UserData()
+            self.duplicate_index.pop(user_id, None)
+            if user_id in self.user_pdf_count:
+                self.user_pdf_count[user_id] = 0
+            # New years dict: later uploads start new row lists, older snapshots keep theirs
+            self._publish(user_id, user_data, years={}, company_details=None)
+
+    def get_data_version(self, user_id):
+        user_data = self.users.get(user_id)
+        return user_data.version if user_data else 0
+
+    def get_company_details(self, user_id):
+        user_data = self.users.get(user_id)
+        return user_data.company_details if user_data else None
+
+    def set_company_details(self, user_id, company_name, company_vat):
+        with self._lock:
+            self._publish(user_id, self.users.get(user_id) or UserData(), company_details={
+                "company_name": company_name,
+                "company_vat": company_vat,
+                "updated_at": datetime.utcnow().isoformat() + "Z"
+            })
+
+    def get_pdf_count(self, user_id):
+        return self.user_pdf_count.get(user_id, 0)
+
+    def increment_pdf_count(self, user_id, amount=1):
+        with self._lock:
+            self.user_pdf_count[user_id] += amount
+            self._publish(user_id, self.users.get(user_id) or UserData())
+
+
+# ==================== SQLITE BACKEND ====================
+
+# Idle connections kept for snapshots (each open snapshot uses one)
+MAX_IDLE_SNAPSHOT_CONNECTIONS = 8
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month INTEGER,
+    data TEXT NOT NULL,
+    invoice_no,
+    source_file,
+    file_name
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_period ON invoices (user_id, year, month);
+
+CREATE TABLE IF NOT EXISTS category_totals (
+    user_id TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    vat_category TEXT NOT NULL,
+    dreport_code TEXT NOT NULL,
+    is_sale INTEGER NOT NULL,
+    net_cents INTEGER NOT NULL DEFAULT 0,
+    vat_cents INTEGER NOT NULL DEFAULT 0,
+    line_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, year, month, vat_category, dreport_code, is_sale)
+);
+
+CREATE TABLE IF NOT EXISTS invoice_totals (
+    user_id TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    is_sale INTEGER NOT NULL,
+    vat_cents INTEGER NOT NULL DEFAULT 0,
+    invoice_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, year, month, is_sale)
+);
+
+CREATE TABLE IF NOT EXISTS company_details (
+    user_id TEXT PRIMARY KEY,
+    company_name TEXT,
+    company_vat TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS pdf_counts (
+    user_id TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS data_versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SQLiteReads:
+    """
+    Read queries shared by SQLiteStore (thread-local connection) and SQLiteSnapshot
+    (one read transaction); subclasses provide _connect() and _write()
+    """
+
+    def _load_invoices(self, rows):
+        """Decode (id, data) rows; invoices stored without period keys are migrated and written back"""
+        invoices = []
+        migrated = []
+        for row_id, data in rows:
+            invoice = json.loads(data)
+            if ensure_period_keys(invoice):
+                migrated.append((json.dumps(invoice), row_id))
+            invoices.append(invoice)
+        if migrated:
+            try:
+                self._write([("UPDATE invoices SET data = ? WHERE id = ?", migrated)])
+            except sqlite3.Error as e:
+                # Not fatal: the keys are recomputed on the next read
+                print(f"Period key migration failed: {e}")
+        return invoices
+
+    def get_invoices(self, user_id, year, months=None):
+        conn = self._connect()
+        if months is None:
+            cursor = conn.execute(
+                "SELECT id, data FROM invoices WHERE user_id = ? AND year = ? ORDER BY id",
+                (user_id, year)
+            )
+        else:
+            months = list(months)
+            if not months:
+                return []
+            placeholders = ", ".join("?" for _ in months)
+            cursor = conn.execute(
+                f"SELECT id, data FROM invoices WHERE user_id = ? AND year = ? AND month IN ({placeholders}) ORDER BY id",
+                (user_id, year, *months)
+            )
+        return self._load_invoices(cursor)
+
+    def iter_invoices(self, user_id, year, months=None, vat_category=None, batch_size=500):
+        sql = "SELECT id, data FROM invoices WHERE user_id = ? AND year = ? AND id > ?"
+        params = []
+        if months is not None:
+            months = list(months)
+            if not months:
+                return
+            sql += f" AND month IN ({', '.join('?' for _ in months)})"
+            params.extend(months)
+        if vat_category is not None:
+            # Decode only invoices with a transaction in the category (or odd transactions data)
+            sql += (" AND (json_type(data, '$.transactions') IS NOT 'array' OR EXISTS ("
+                    "SELECT 1 FROM json_each(data, '$.transactions') "
+                    "WHERE json_extract(value, '$.vat_category') = ?))")
+            params.append(vat_category)
+        sql += " ORDER BY id LIMIT ?"
+        # Keyset batches: no cursor stays open between batches, so the iterator can
+        # be advanced from any thread (e.g. by a StreamingResponse)
+        last_id = 0
+        while True:
+            rows = self._connect().execute(sql, (user_id, year, last_id, *params, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield from self._load_invoices(rows)
+            if len(rows) < batch_size:
+                return
+
+    def count_invoices(self, user_id, year):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT COUNT(*) FROM invoices WHERE user_id = ? AND year = ?", (user_id, year)
+        ).fetchone()
+        return row[0]
+
+    def get_category_totals(self, user_id, year, months=None):
+        conn = self._connect()
+        sql = ("SELECT month, vat_category, dreport_code, is_sale, net_cents, vat_cents, line_count "
+               "FROM category_totals WHERE user_id = ? AND year = ?")
+        params = [user_id, year]
+        if months is not None:
+            months = list(months)
+            if not months:
+                return []
+            sql += f" AND month IN ({', '.join('?' for _ in months)})"
+            params.extend(months)
+        rows = conn.execute(sql + " ORDER BY rowid", params).fetchall()
+        return [(month, category, code, bool(is_sale), net, vat, count)
+                for month, category, code, is_sale, net, vat, count in rows]
+
+    def get_invoice_totals(self, user_id, year):
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT month, is_sale, vat_cents, invoice_count FROM invoice_totals "
+            "WHERE user_id = ? AND year = ? ORDER BY rowid", (user_id, year)
+        ).fetchall()
+        return [(month, bool(is_sale), vat, count) for month, is_sale, vat, count in rows]
+
+    def get_data_version(self, user_id):
+        conn = self._connect()
+        row = conn.execute("SELECT version FROM data_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get_company_details(self, user_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT company_name, company_vat, updated_at FROM company_details WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {"company_name": row[0], "company_vat": row[1], "updated_at": row[2]}
+
+
+class SQLiteStore(SQLiteReads, InvoiceStore):
+    """
+    SQLite database in WAL mode.
+
+    Every thread gets its own connection. Writes run inside BEGIN IMMEDIATE
+    transactions so concurrent workers serialize on the database lock instead
+    of failing half-way; readers are never blocked by writers in WAL mode.
+    Snapshots are read transactions on connections of their own (kept for reuse).
+    """
+
+    def __init__(self, path="vat_data.db", timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._idle_connections = []
+        self._idle_lock = threading.Lock()
+        conn = self._connect()
+        conn.executescript(SQLITE_SCHEMA)
+        self._migrate(conn)
+        conn.execute("INSERT OR IGNORE INTO store_meta (key, value) VALUES ('instance_id', ?)", (uuid.uuid4().hex,))
+        self.instance_id = conn.execute("SELECT value FROM store_meta WHERE key = 'instance_id'").fetchone()[0]
+
+    def _migrate(self, conn):
+        """
+        Add duplicate-detection columns (and their indexes) to databases created without them,
+        and build the materialized totals of invoices stored before totals were kept (or
+        were kept as floating-point euros)
+        """
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(invoices)")}
+        for field in DUPLICATE_KEY_FIELDS:
+            if field not in columns:
+                conn.execute(f"ALTER TABLE invoices ADD COLUMN {field}")
+                conn.execute(f"UPDATE invoices SET {field} = json_extract(data, '$.{field}')")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_invoices_{field} ON invoices (user_id, {field}, year)")
+
+        totals_columns = {row[1] for row in conn.execute("PRAGMA table_info(category_totals)")}
+        if "net_cents" not in totals_columns:
+            conn.execute("DROP TABLE category_totals")
+            conn.execute("DROP TABLE invoice_totals")
+            conn.executescript(SQLITE_SCHEMA)
+
+        has_invoices = conn.execute("SELECT 1 FROM invoices LIMIT 1").fetchone()
+        has_totals = conn.execute("SELECT 1 FROM invoice_totals LIMIT 1").fetchone()
+        if has_invoices and not has_totals:
+            self.rebuild_totals()
+
+    def _totals_statements(self, user_id, entries):
+        """Upserts adding the materialized totals of (year, invoice) entries"""
+        line_rows = []
+        invoice_rows = []
+        for year, invoices in group_by_year(entries).items():
+            line_totals, invoice_totals = merge_invoice_totals(invoices)
+            for (month, category, dreport_code, is_sale), (net, vat, count) in line_totals.items():
+                line_rows.append((user_id, year, month, category, dreport_code, int(is_sale), net, vat, count))
+            for (month, is_sale), (vat, count) in invoice_totals.items():
+                invoice_rows.append((user_id, year, month, int(is_sale), vat, count))
+        return [
+            ("INSERT INTO category_totals (user_id, year, month, vat_category, dreport_code, is_sale, "
+             "net_cents, vat_cents, line_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+             "ON CONFLICT(user_id, year, month, vat_category, dreport_code, is_sale) DO UPDATE SET "
+             "net_cents = net_cents + excluded.net_cents, vat_cents = vat_cents + excluded.vat_cents, "
+             "line_count = line_count + excluded.line_count",
+             line_rows),
+            ("INSERT INTO invoice_totals (user_id, year, month, is_sale, vat_cents, invoice_count) "
+             "VALUES (?, ?, ?, ?, ?, ?) "
+             "ON CONFLICT(user_id, year, month, is_sale) DO UPDATE SET "
+             "vat_cents = vat_cents + excluded.vat_cents, invoice_count = invoice_count + excluded.invoice_count",
+             invoice_rows),
+        ]
+
+    def rebuild_totals(self, user_id=None):
+        """Recompute the materialized totals from the stored invoices (all users if user_id is None)"""
+        conn = self._connect()
+        if user_id is None:
+            rows = conn.execute("SELECT id, user_id, year, data FROM invoices ORDER BY id").fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, user_id, year, data FROM invoices WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+        invoices = self._load_invoices((row_id, data) for row_id, _, _, data in rows)
+        entries_by_user = {}
+        for (_, row_user, year, _), invoice in zip(rows, invoices):
+            entries_by_user.setdefault(row_user, []).append((year, invoice))
+
+        if user_id is None:
+            statements = [("DELETE FROM category_totals", ()), ("DELETE FROM invoice_totals", ())]
+        else:
+            statements = [("DELETE FROM category_totals WHERE user_id = ?", (user_id,)),
+                          ("DELETE FROM invoice_totals WHERE user_id = ?", (user_id,))]
+        for row_user, entries in entries_by_user.items():
+            statements.extend(self._totals_statements(row_user, entries))
+        self._write(statements)
+
+    def _open_connection(self):
+        # isolation_level=None: autocommit, transactions are opened explicitly
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        return conn
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open_connection()
+        return conn
+
+    def snapshot(self, user_id):
+        with self._idle_lock:
+            conn = self._idle_connections.pop() if self._idle_connections else None
+        return SQLiteSnapshot(self, conn or self._open_connection(), user_id)
+
+    def _release_connection(self, conn):
+        """Keep a snapshot connection for the next snapshot (up to MAX_IDLE_SNAPSHOT_CONNECTIONS)"""
+        with self._idle_lock:
+            if len(self._idle_connections) < MAX_IDLE_SNAPSHOT_CONNECTIONS:
+                self._idle_connections.append(conn)
+                return
+        conn.close()
+
+    def _write(self, statements, user_id=None):
+        """Run (sql, params) statements in one write transaction (and bump the data version of user_id)"""
+        if user_id is not None:
+            statements = [*statements, (
+                "INSERT INTO data_versions (user_id, version) VALUES (?, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET version = version + 1", (user_id,))]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                if isinstance(params, list):
+                    conn.executemany(sql, params)
+                else:
+                    conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add_invoices(self, user_id, entries):
+        if not entries:
+            return
+        rows = [
+            (user_id, year, invoice_month(invoice), json.dumps(invoice),
+             *(duplicate_key(invoice.get(field)) for field in DUPLICATE_KEY_FIELDS))
+            for year, invoice in entries
+        ]
+        self._write([
+            ("INSERT INTO invoices (user_id, year, month, data, invoice_no, source_file, file_name) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows),
+            *self._totals_statements(user_id, entries)
+        ], user_id=user_id)
+
+    def has_invoice(self, user_id, year=None, invoice_no=None, source_file=None, file_name=None):
+        conn = self._connect()
+        for field, value in (("invoice_no", invoice_no), ("source_file", source_file), ("file_name", file_name)):
+            value = duplicate_key(value)
+            if value is None:
+                continue
+            if year is None:
+                row = conn.execute(
+                    f"SELECT 1 FROM invoices WHERE user_id = ? AND {field} = ? LIMIT 1", (user_id, value)
+                ).fetchone()
+            else:
+                row = conn.execute(
+                    f"SELECT 1 FROM invoices WHERE user_id = ? AND {field} = ? AND year = ? LIMIT 1",
+                    (user_id, value, year)
+                ).fetchone()
+            if row:
+                return True
+        return False
+
+    def get_user_invoices(self, user_id):
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT id, year, data FROM invoices WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        invoices = self._load_invoices((row_id, data) for row_id, _, data in rows)
+        result = {}
+        for (_, year, _), invoice in zip(rows, invoices):
+            result.setdefault(year, []).append(invoice)
+        return result
+
+    def clear_user(self, user_id):
+        self._write([
+            ("DELETE FROM invoices WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM category_totals WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM invoice_totals WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM company_details WHERE user_id = ?", (user_id,)),
+            ("UPDATE pdf_counts SET count = 0 WHERE user_id = ?", (user_id,)),
+        ], user_id=user_id)
+
+    def set_company_details(self, user_id, company_name, company_vat):
+        updated_at = datetime.utcnow().isoformat() + "Z"
+        self._write([
+            ("INSERT OR REPLACE INTO company_details (user_id, company_name, company_vat, updated_at) VALUES (?, ?, ?, ?)",
+             (user_id, company_name, company_vat, updated_at))
+        ], user_id=user_id)
+
+    def get_pdf_count(self, user_id):
+        conn = self._connect()
+        row = conn.execute("SELECT count FROM pdf_counts WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def increment_pdf_count(self, user_id, amount=1):
+        self._write([
+            ("INSERT INTO pdf_counts (user_id, count) VALUES (?, ?) "
+             "ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count", (user_id, amount))
+        ], user_id=user_id)
+
+
+class SQLiteSnapshot(SQLiteReads, StoreSnapshot):
+    """
+    A read transaction on a connection of its own: in WAL mode every query sees
+    the database as of the first read until close(). Used from one thread at a time.
+    """
+
+    def __init__(self, store, conn, user_id):
+        self.store = store
+        self.conn = conn
+        conn.execute("BEGIN")
+        try:
+            # The first read fixes the snapshot
+            self.data_version = self.get_data_version(user_id)
+        except Exception:
+            conn.execute("ROLLBACK")
+            conn.close()
+            raise
+
+    def _connect(self):
+        if self.conn is None:
+            raise sqlite3.ProgrammingError("Snapshot is closed")
+        return self.conn
+
+    def _write(self, statements, user_id=None):
+        # Lazy migrations write through the store (another connection)
+        self.store._write(statements, user_id=user_id)
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.close()
+            return
+        self.store._release_connection(conn)
+
+
+# ==================== BACKEND SELECTION ====================
+
+def get_store(backend=None, path=None):
+    """Create the storage backend configured by VAT_STORAGE_BACKEND / VAT_SQLITE_PATH"""
+    backend = (backend or os.getenv("VAT_STORAGE_BACKEND", "sqlite")).strip().lower()
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(path or os.getenv("VAT_SQLITE_PATH", "vat_data.db"))
+    raise ValueError(f"Unknown storage backend: {backend} (expected 'sqlite' or 'memory')")
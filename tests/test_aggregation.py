@@ -0,0 +1,44 @@
+"""
+VAT lines of stored invoices: an amount split over transactions is counted in
+whole cents adding up to the invoice, and shown per line as the API always did.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")
+
+from aggregation import aggregate_invoices, invoice_lines
+
+
+def split_invoice(subtotal, transactions):
+    """Invoice whose subtotal is split over transactions without amounts"""
+    return {
+        "invoice_no": "INV-SPLIT", "date": "2024-02-10", "period_month": 2, "period_quarter": "Q1",
+        "transaction_type": "purchase", "invoice_to": "Supplier B.V.", "country": "NL",
+        "subtotal": subtotal, "vat_amount": "0",
+        "transactions": [{"description": f"Item {i}", "amount_pre_vat": "0", "vat_percentage": "0%",
+                          "vat_category": "5b"} for i in range(transactions)]
+    }
+
+
+def test_split_line_cents_add_up_to_the_invoice():
+    for subtotal, transactions in (("100.00", 3), ("-100.00", 3), ("0.05", 2), ("10.00", 4)):
+        lines = invoice_lines(split_invoice(subtotal, transactions))
+        assert sum(line["net"] for line in lines) == round(float(subtotal) * 100)
+
+    lines = invoice_lines(split_invoice("100.00", 3))
+    assert [line["net"] for line in lines] == [3334, 3333, 3333]
+    # Displayed amounts are unchanged: round(amount, 2) per line
+    assert [line["transaction"]["net_amount"] for line in lines] == [33.33, 33.33, 33.33]
+
+
+def test_report_totals_are_the_invoice_amount():
+    report = aggregate_invoices([split_invoice("100.00", 3)]).category_report()
+    assert report["5b"]["totals"]["net"] == 100.0
+    assert len(report["5b"]["transactions"]) == 3
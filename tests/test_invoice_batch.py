@@ -0,0 +1,63 @@
+"""
+InvoiceBatch: items without a Dutch VAT code are classified in bulk when the
+batch is flushed, with the same codes as map_vat_category_simple.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import itertools
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")
+
+import app as vat_app
+
+USER = "test_invoice_batch"
+
+CATEGORIES = ["Standard VAT", "Reduced Rate", "Zero Rated", "EU Goods", "EU Services", "Reverse Charge", "Import", ""]
+COMBINATIONS = list(itertools.product(CATEGORIES, ["Sales", "Purchase"], ["21%", "9", 0], ["NL", "DE", "US", ""]))
+
+
+def items():
+    """Upload items in the old format (vat_category string), plus some with a code"""
+    result = []
+    for i, (category, invoice_type, rate, country) in enumerate(COMBINATIONS * 3):
+        item = {"date": "2024-03-01", "type": invoice_type, "net_amount": 100, "vat_amount": 21,
+                "vat_percentage": rate, "country": country, "file_name": f"batch_{i}.pdf"}
+        if i % 10 == 0:
+            item["VAT Category (NL) Code"] = "1d"
+        else:
+            item["vat_category"] = category
+        result.append(item)
+    return result
+
+
+def expected_code(item):
+    if "VAT Category (NL) Code" in item:
+        return item["VAT Category (NL) Code"]
+    transaction_type = "sale" if item["type"].lower() in ("sales", "sale") else "purchase"
+    rate = item["vat_percentage"]
+    rate = rate.replace("%", "").strip() if isinstance(rate, str) else str(rate)
+    return vat_app.map_vat_category_simple(item["vat_category"], transaction_type, rate, item["country"])
+
+
+def test_codes_are_classified_at_flush(monkeypatch):
+    calls = []
+    classify_many = vat_app.simple_classifier.classify_many
+    monkeypatch.setattr(vat_app.simple_classifier, "classify_many", lambda inputs: calls.append(len(inputs)) or classify_many(inputs))
+    vat_app.store.clear_user(USER)
+
+    batch = vat_app.InvoiceBatch(USER)
+    added, flushes = batch.add_many(items(), chunk_size=100)
+    batch.flush()
+    assert added == len(COMBINATIONS) * 3 and batch.processed_count == added
+    assert flushes + 1 == len(calls) and sum(calls) == added - (added + 9) // 10
+    assert batch.unclassified == []
+
+    stored = vat_app.store.get_invoices(USER, "2024")
+    assert [invoice["transactions"][0]["vat_category"] for invoice in stored] == [expected_code(item) for item in items()]
+    vat_app.store.clear_user(USER)
@@ -0,0 +1,105 @@
+"""
+JsonObjectStream: NDJSON, concatenated and array input, fed in any chunks, with
+malformed and truncated objects skipped and reported at their byte offset.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from json_stream import JsonObjectStream, find_object_end, parse_json_objects
+
+OBJECTS = [
+    {"invoice_no": "INV-1", "description": "Braces {in} a string }{", "amount": 100.5},
+    {"invoice_no": "INV-2", "description": "Café \"De Hoek\" \\ 日本", "lines": [{"vat": "21%"}]},
+    {"invoice_no": "INV-3", "description": "", "amount": -12}
+]
+
+
+def parse(data, chunk_size=None, use_orjson=True, **options):
+    """(objects, errors, malformed) of data fed in chunks of chunk_size bytes"""
+    parser = JsonObjectStream(use_orjson=use_orjson, **options)
+    data = data.encode("utf-8")
+    chunk_size = chunk_size or len(data) or 1
+    objects = []
+    for start in range(0, len(data), chunk_size):
+        objects.extend(parser.feed(data[start:start + chunk_size]))
+    objects.extend(parser.close())
+    return objects, parser.errors, parser.malformed
+
+
+def formats():
+    lines = [json.dumps(obj, ensure_ascii=False) for obj in OBJECTS]
+    return {
+        "ndjson": "\n".join(lines) + "\n",
+        "concatenated": "".join(lines),
+        "array": "[\n" + ",\n".join(lines) + "\n]",
+        "pretty": "\n".join(json.dumps(obj, indent=2) for obj in OBJECTS)
+    }
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, None])
+@pytest.mark.parametrize("name", ["ndjson", "concatenated", "array", "pretty"])
+def test_formats_and_chunks(name, chunk_size, use_orjson):
+    assert parse(formats()[name], chunk_size, use_orjson) == (OBJECTS, 0, [])
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 5, None])
+def test_malformed_object_is_skipped_with_its_byte_offset(chunk_size, use_orjson):
+    first = json.dumps(OBJECTS[1], ensure_ascii=False) + "\n"
+    data = first + '{"invoice_no": "BAD" "amount": 1}\n' + json.dumps(OBJECTS[2]) + "\n"
+    objects, errors, malformed = parse(data, chunk_size, use_orjson)
+    assert objects == [OBJECTS[1], OBJECTS[2]]
+    assert errors == 1
+    assert malformed[0]["offset"] == len(first.encode("utf-8"))
+    assert "delimiter" in malformed[0]["error"]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 3, None])
+def test_truncated_object_at_end(chunk_size, use_orjson):
+    complete = json.dumps(OBJECTS[0]) + "\n"
+    data = complete + '{"invoice_no": "INV-4", "description": "cut {off'
+    objects, errors, malformed = parse(data, chunk_size, use_orjson)
+    assert objects == [OBJECTS[0]]
+    assert errors == 1
+    assert malformed == [{"offset": len(complete), "error": "Incomplete object at end of input"}]
+
+
+def test_incomplete_object_waits_for_more_data():
+    parser = JsonObjectStream()
+    assert parser.feed(b'{"description": "a } and a \\" quote ') == []
+    assert parser.feed(b'continue"}\n{"n": 1}') == [{"description": 'a } and a " quote continue'}, {"n": 1}]
+    assert parser.close() == []
+    assert parser.errors == 0
+
+
+def test_runaway_object_resumes_at_next_line():
+    data = '{"description": "unbalanced\n' + "x" * 100 + "\n" + json.dumps(OBJECTS[2]) + "\n"
+    objects, errors, malformed = parse(data, chunk_size=16, max_object_chars=64)
+    assert objects == [OBJECTS[2]]
+    assert errors == 1
+    assert malformed[0]["offset"] == 0
+
+
+def test_find_object_end():
+    text = '{"a": "}{", "b": {"c": "\\"}"}} tail'
+    assert find_object_end(text, 0) == text.index(" tail")
+    assert find_object_end('{"a": {"b": 1}', 0) == -1
+    assert find_object_end('{"a": "open string }}}', 0) == -1
+
+
+def test_parse_json_objects():
+    data = formats()["concatenated"] + '{"broken": }'
+    objects, malformed = parse_json_objects(data)
+    assert objects == OBJECTS
+    assert [entry["offset"] for entry in malformed] == [len(formats()["concatenated"].encode("utf-8"))]
@@ -0,0 +1,95 @@
+"""
+LLM response cache: what the key depends on, and least recently used eviction
+under the size budget.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import llm_cache
+from llm_cache import ENTRY_OVERHEAD_BYTES, LLMCache, llm_cache_key
+
+KEY_INPUTS = dict(task="extract", pdf_bytes=b"%PDF-1.4 invoice", prompt_template="Extract {fields}",
+                  company_context="Example B.V.", model="gpt-4o", filename="invoice.pdf")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time in llm_cache advancing one second per call, so last_used orders the entries"""
+    now = [1000.0]
+
+    def tick():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(llm_cache.time, "time", tick)
+
+
+def make_cache(tmp_path, entries):
+    """Cache with room for `entries` responses of 100 bytes"""
+    return LLMCache(path=str(tmp_path / "llm_cache.db"), max_bytes=entries * (100 + ENTRY_OVERHEAD_BYTES))
+
+
+def test_key_depends_on_every_input():
+    key = llm_cache_key(**KEY_INPUTS)
+    assert llm_cache_key(**KEY_INPUTS) == key
+    assert llm_cache_key(**dict(reversed(list(KEY_INPUTS.items())))) == key
+    for name, value in (("task", "classify"), ("pdf_bytes", b"%PDF-1.4 other"), ("prompt_template", "Extract v2"),
+                        ("company_context", "Other B.V."), ("model", "gpt-4o-mini"), ("filename", "other.pdf")):
+        assert llm_cache_key(**dict(KEY_INPUTS, **{name: value})) != key, name
+    assert llm_cache_key(**KEY_INPUTS, max_tokens=500) != key
+
+
+def test_get_and_put(tmp_path):
+    cache = make_cache(tmp_path, 3)
+    assert cache.get("a") is None
+    cache.put("a", "extract", '{"invoice_no": "1"}')
+    assert cache.get("a") == '{"invoice_no": "1"}'
+    cache.put("a", "extract", '{"invoice_no": "2"}')
+    assert cache.get("a") == '{"invoice_no": "2"}'
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 2, 1)
+    # Persistent: a new cache on the same file (another worker process) sees the entry
+    assert make_cache(tmp_path, 3).get("a") == '{"invoice_no": "2"}'
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = make_cache(tmp_path, 3)
+    for key in ("a", "b", "c"):
+        cache.put(key, "extract", key * 100)
+    assert cache.get("a") == "a" * 100  # a is now the most recently used
+    cache.put("d", "extract", "d" * 100)
+    assert cache.get("b") is None
+    assert [cache.get(key) is not None for key in ("a", "c", "d")] == [True, True, True]
+
+    cache.put("e", "extract", "e" * 250)  # takes the room of two entries: a and c go
+    assert [key for key in "acde" if cache.get(key) is not None] == ["d", "e"]
+    stats = cache.stats()
+    assert stats["evictions"] == 3
+    assert stats["size_bytes"] <= stats["max_bytes"]
+
+
+def test_oversized_and_disabled(tmp_path):
+    cache = make_cache(tmp_path, 1)
+    cache.put("big", "extract", "x" * 200)
+    assert cache.get("big") is None and cache.stats()["entries"] == 0
+
+    disabled = LLMCache(path=str(tmp_path / "disabled.db"), max_bytes=0)
+    disabled.put("a", "extract", "{}")
+    assert disabled.get("a") is None
+    assert disabled.stats()["entries"] == 0 and not (tmp_path / "disabled.db").exists()
+
+
+def test_budget_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv("VAT_LLM_CACHE_PATH", str(tmp_path / "env.db"))
+    monkeypatch.setenv("VAT_LLM_CACHE_MB", "0.5")
+    assert llm_cache.get_llm_cache().max_bytes == 512 * 1024
+    monkeypatch.setenv("VAT_LLM_CACHE_MB", "lots")
+    assert llm_cache.get_llm_cache().max_bytes == 64 * 1024 * 1024
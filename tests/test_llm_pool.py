@@ -0,0 +1,135 @@
+"""
+LLMPool scheduling: users take turns, batches beyond the queue limit are
+rejected whole, cancelled callers drop their queued calls, and the token bucket
+limits the request rate.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from llm_pool import LLMPool, TokenBucket
+from worker_pool import WorkerPoolFull
+
+
+async def started(calls):
+    """Wait until the pool's first call is running"""
+    while not calls:
+        await asyncio.sleep(0)
+
+
+def test_users_take_turns():
+    async def scenario():
+        pool = LLMPool(concurrency=1, requests_per_minute=0)
+        order = []
+
+        async def extract(user, document):
+            order.append(f"{user}{document}")
+            await asyncio.sleep(0)
+            return document
+
+        bulk = asyncio.ensure_future(pool.run_many("a", extract, [("a", n) for n in range(1, 5)]))
+        single = asyncio.ensure_future(pool.run("b", extract, "b", 1))
+        other = asyncio.ensure_future(pool.run_many("c", extract, [("c", 1), ("c", 2)]))
+        assert await bulk == [1, 2, 3, 4]
+        assert await single == 1 and await other == [1, 2]
+        # One user's batch doesn't hold up the others: round-robin in order of arrival
+        assert order == ["a1", "b1", "c1", "a2", "c2", "a3", "a4"]
+        assert pool.stats()["completed"] == 7 and pool.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_batch_beyond_the_queue_is_rejected_whole():
+    async def scenario():
+        pool = LLMPool(concurrency=1, requests_per_minute=0, max_queue=3)
+        gate = asyncio.Event()
+        calls = []
+
+        async def extract(document):
+            calls.append(document)
+            await gate.wait()
+            return document
+
+        first = asyncio.ensure_future(pool.run_many("a", extract, [(n,) for n in range(3)]))
+        await started(calls)
+        assert pool.running == 1 and pool.queued == 2
+        with pytest.raises(WorkerPoolFull):
+            await pool.run_many("b", extract, [("b1",), ("b2",)])
+        assert pool.rejected == 2 and pool.queued == 2 and pool.stats()["queued_users"] == 1
+        assert await pool.run_many("b", extract, []) == []
+
+        gate.set()
+        assert await first == [0, 1, 2]
+        assert calls == [0, 1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_drops_its_queued_calls():
+    async def scenario():
+        pool = LLMPool(concurrency=1, requests_per_minute=0)
+        gate = asyncio.Event()
+        calls = []
+
+        async def extract(document):
+            calls.append(document)
+            await gate.wait()
+            return document
+
+        abandoned = asyncio.ensure_future(pool.run_many("a", extract, [(n,) for n in range(5)]))
+        kept = asyncio.ensure_future(pool.run("b", extract, "b"))
+        await started(calls)
+        assert calls == [0]
+        abandoned.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await abandoned
+        gate.set()
+        assert await kept == "b"
+        # Only the call already running finished; the queued ones never started
+        assert calls == [0, "b"]
+        assert pool.queued == 0 and pool.running == 0
+
+    asyncio.run(scenario())
+
+
+def test_failures_reach_the_caller():
+    async def scenario():
+        pool = LLMPool(concurrency=2, requests_per_minute=0)
+
+        async def extract(document):
+            if document == "bad":
+                raise ValueError("unreadable PDF")
+            return document
+
+        assert await pool.run("a", extract, "good") == "good"
+        with pytest.raises(ValueError):
+            await pool.run("a", extract, "bad")
+        stats = pool.stats()
+        assert (stats["completed"], stats["failed"]) == (1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_limits_the_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=100, capacity=2)
+        start = time.monotonic()
+        for _ in range(2):
+            await bucket.acquire()
+        # The burst is free
+        assert time.monotonic() - start < 0.01 and bucket.waited == 0
+        for _ in range(3):
+            await bucket.acquire()
+        elapsed = time.monotonic() - start
+        assert elapsed >= 0.025 and bucket.waited >= 0.025
+
+    asyncio.run(scenario())
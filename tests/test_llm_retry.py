@@ -0,0 +1,234 @@
+"""
+Retries and the circuit breaker around OpenAI calls: which errors are retried,
+how long to wait, when the circuit opens and who may call while it is half-open.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import asyncio
+import email.utils
+import sys
+import time
+from pathlib import Path
+
+import openai
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import llm_retry
+from llm_retry import CircuitBreaker, CircuitOpen, LLMRetry, LLMUnavailable, is_transient, retry_after
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class StatusError(Exception):
+    """An OpenAI error response (status code and headers only)"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = FakeResponse(headers or {})
+
+
+class FakeCall:
+    """Raises the given errors one per call, then returns "ok"; counts calls"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Seconds slept by LLMRetry.call (not actually slept)"""
+    slept = []
+    monkeypatch.setattr(llm_retry.time, "sleep", slept.append)
+    return slept
+
+
+def test_transient_errors():
+    for status_code in (408, 409, 429, 500, 502, 503):
+        assert is_transient(StatusError(status_code))
+    for status_code in (400, 401, 403, 404, 422):
+        assert not is_transient(StatusError(status_code))
+    assert is_transient(openai.APIConnectionError(request=None))
+    assert is_transient(openai.APITimeoutError(request=None))
+    assert not is_transient(ValueError("not an API error"))
+
+
+def test_transient_error_is_retried(sleeps):
+    retry = LLMRetry(retries=3, base_delay=1.0, max_delay=30.0)
+    call = FakeCall(StatusError(503), openai.APIConnectionError(request=None))
+    assert retry.call(call) == "ok"
+    assert call.calls == 3
+    assert (retry.attempts, retry.retried, retry.gave_up) == (3, 2, 0)
+    # Full jitter: at most base_delay * 2 ** (attempt - 1)
+    assert 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+    assert retry.breaker.state == "closed" and retry.breaker.failures == 0
+
+
+def test_non_transient_error_is_raised_right_away(sleeps):
+    retry = LLMRetry(retries=3)
+    error = StatusError(400)
+    call = FakeCall(error)
+    with pytest.raises(StatusError) as raised:
+        retry.call(call)
+    assert raised.value is error
+    assert call.calls == 1 and sleeps == []
+    assert retry.breaker.failures == 0 and not retry.breaker.trial_running
+
+
+def test_retries_exhausted(sleeps):
+    retry = LLMRetry(retries=2, breaker=CircuitBreaker(failure_threshold=0))
+    call = FakeCall(*[StatusError(500)] * 5)
+    with pytest.raises(LLMUnavailable):
+        retry.call(call)
+    assert call.calls == 3 and len(sleeps) == 2
+    assert retry.gave_up == 1
+
+
+def test_retry_after(sleeps):
+    assert retry_after(StatusError(429, {"retry-after": "2"})) == 2.0
+    assert retry_after(StatusError(429, {"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert retry_after(StatusError(429, {"retry-after": "soon"})) is None
+    assert retry_after(StatusError(429)) is None
+    http_date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < retry_after(StatusError(503, {"retry-after": http_date})) <= 60
+
+    retry = LLMRetry(retries=3, base_delay=1.0, max_delay=10.0)
+    call = FakeCall(StatusError(429, {"retry-after": "4"}), StatusError(429, {"retry-after": "120"}),
+                    StatusError(429, {"retry-after": "-5"}))
+    assert retry.call(call) == "ok"
+    # As asked, capped at max_delay, never negative
+    assert sleeps == [4.0, 10.0, 0.0]
+    assert retry.retry_wait == 14.0
+
+
+def test_circuit_opens_after_failure_threshold(sleeps):
+    retry = LLMRetry(retries=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=30.0))
+    for _ in range(3):
+        assert retry.breaker.state == "closed"
+        with pytest.raises(LLMUnavailable):
+            retry.call(FakeCall(StatusError(503)))
+    assert retry.breaker.state == "open" and retry.breaker.trips == 1
+
+    call = FakeCall()
+    with pytest.raises(CircuitOpen) as raised:
+        retry.call(call)
+    assert not raised.value.half_open
+    assert call.calls == 0 and retry.breaker.short_circuits == 1
+
+
+def test_success_resets_consecutive_failures(sleeps):
+    breaker = CircuitBreaker(failure_threshold=3)
+    retry = LLMRetry(retries=1, breaker=breaker)
+    for _ in range(4):
+        assert retry.call(FakeCall(StatusError(503))) == "ok"
+    assert breaker.state == "closed" and breaker.failures == 0 and breaker.trips == 0
+
+
+def test_half_open_lets_one_trial_call_through(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_retry.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    now[0] += 30.0
+    breaker.before_call()  # the trial call
+    assert breaker.state == "half-open" and breaker.trial_running
+    with pytest.raises(CircuitOpen) as raised:
+        breaker.before_call()
+    assert raised.value.half_open
+
+    # A failed trial opens the circuit again, for another reset_timeout
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.trips == 2
+    now[0] += 29.0
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    now[0] += 1.0
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_calls_wait_for_the_half_open_trial():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+        retry = LLMRetry(retries=100, base_delay=0.001, max_delay=0.001, breaker=breaker)
+        breaker.record_failure()
+        order = []
+        trial_started = asyncio.Event()
+        finish_trial = asyncio.Event()
+
+        async def trial():
+            trial_started.set()
+            await finish_trial.wait()
+            order.append("trial")
+            return "trial"
+
+        async def waiter():
+            order.append("waiter")
+            return "waiter"
+
+        trial_task = asyncio.ensure_future(retry.acall(trial))
+        await trial_started.wait()
+        waiter_task = asyncio.ensure_future(retry.acall(waiter))
+        await asyncio.sleep(0.02)
+        # Held back (not failed) while the trial runs
+        assert order == [] and not waiter_task.done()
+
+        # Without retries left, a call doesn't wait for the trial
+        with pytest.raises(CircuitOpen):
+            await LLMRetry(retries=0, breaker=breaker).acall(waiter)
+
+        finish_trial.set()
+        assert await asyncio.gather(trial_task, waiter_task) == ["trial", "waiter"]
+        assert order == ["trial", "waiter"]
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_call_releases_the_trial():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+        retry = LLMRetry(retries=0, breaker=breaker)
+        breaker.record_failure()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        async def answer():
+            return "ok"
+
+        task = asyncio.ensure_future(retry.acall(hang))
+        await started.wait()
+        assert breaker.trial_running
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Neither a success nor a failure: the next call may be the trial
+        assert breaker.state == "half-open" and not breaker.trial_running and breaker.failures == 1
+        assert await retry.acall(answer) == "ok"
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+"""
+Report periods: quarters that are neither Q1-Q4 nor a month get an empty report
+(as before the shared aggregation), not a 500, and an empty transaction page.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")
+
+from fastapi.testclient import TestClient
+
+import app as vat_app
+
+client = TestClient(vat_app.app)
+HEADERS = {"X-User-ID": "test_report_periods"}
+
+INVOICE = {
+    "date": "2024-02-10",
+    "type": "Sales",
+    "net_amount": 100,
+    "vat_amount": 21,
+    "vat_percentage": "21",
+    "description": "Consulting",
+    "file_name": "test_report_periods.pdf",
+    "VAT Category (NL) Code": "1a"
+}
+
+
+def setup_module():
+    response = client.post("/process-invoices", json=[INVOICE], headers=HEADERS)
+    assert response.json()["details"]["processed"] == 1
+
+
+def teardown_module():
+    client.delete("/clear-user-data", headers=HEADERS)
+
+
+def test_report_period_months():
+    assert vat_app.report_period_months("") == ("year", list(range(1, 13)))
+    assert vat_app.report_period_months("Q2") == ("Q2", [4, 5, 6])
+    assert vat_app.report_period_months("Feb") == (2, [2])
+    assert vat_app.report_period_months("1") == ("1", [])
+    assert vat_app.report_period_months("X") == ("X", [])
+    assert vat_app.report_period_months("JAN") == ("JAN", [])
+
+
+def test_quarterly_report_has_the_invoice():
+    report = client.get("/vat-report-quarterly?year=2024&quarter=Q1", headers=HEADERS).json()
+    assert report["categories"]["1a"]["totals"] == {"net": 100.0, "vat": 21.0}
+
+
+def test_unknown_quarter_is_an_empty_report():
+    for quarter in ("1", "X", "jan", "Q5"):
+        for options in ("", "&include_transactions=false", "&stream=true"):
+            response = client.get(f"/vat-report-quarterly?year=2024&quarter={quarter}{options}", headers=HEADERS)
+            assert response.status_code == 200, (quarter, options)
+            report = response.json()
+            assert report["period"] == f"{quarter.upper()} 2024"
+            assert all(category["totals"] == {"net": 0.0, "vat": 0.0} for category in report["categories"].values())
+            assert report["vat_calculation"] == {"vat_collected": 0.0, "vat_deductible": 0.0, "vat_payable": 0.0}
+
+
+def test_normalize_report_period():
+    for period, expected in (("", ""), ("year", ""), ("q3", "Q3"), ("2", "Feb"), ("02", "Feb"),
+                             ("february", "Feb"), ("FEB", "Feb"), ("X", "X"), ("13", "13"), ("Q5", "Q5")):
+        assert vat_app.normalize_report_period(period) == expected, period
+
+
+def test_report_transactions_periods():
+    for period in ("", "Q1", "Feb", "2", "february"):
+        page = client.get(f"/report-transactions?year=2024&period={period}&category=1a", headers=HEADERS).json()
+        assert [tx["net_amount"] for tx in page["transactions"]] == [100.0], period
+
+
+def test_unknown_period_is_an_empty_transaction_page():
+    # Not the current month's transactions: the same (empty) selection as the report totals
+    today = date.today()
+    invoice = dict(INVOICE, date=today.isoformat(), file_name="test_report_periods_today.pdf")
+    assert client.post("/process-invoices", json=[invoice], headers=HEADERS).json()["details"]["processed"] == 1
+    current = client.get(f"/report-transactions?year={today.year}&period={today.month}&category=1a", headers=HEADERS)
+    assert len(current.json()["transactions"]) == 1
+    for period in ("X", "13", "Q5"):
+        response = client.get(f"/report-transactions?year={today.year}&period={period}&category=1a", headers=HEADERS)
+        assert response.status_code == 200, period
+        page = response.json()
+        assert page["period"] == f"{period} {today.year}"
+        assert page["transactions"] == [] and page["next_cursor"] is None
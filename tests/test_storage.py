@@ -0,0 +1,145 @@
+"""
+Storage backends: invoices come back exactly as stored (compact records in
+memory, JSON in SQLite), and a snapshot keeps seeing the data of the moment it
+was taken while writes go on.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import copy
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aggregation import check_totals
+from records import InvoiceRecord
+from storage import MemoryStore, SQLiteStore, ensure_period_keys
+
+USER = "test_storage"
+
+
+def invoice(invoice_no, date, net, vat, transaction_type="sale", **fields):
+    return {
+        "invoice_no": invoice_no, "date": date, "invoice_to": "Klant B.V.", "country": "NL",
+        "vat_no": "NL123456789B01", "transaction_type": transaction_type,
+        "transactions": [{"description": "Consulting", "amount_pre_vat": net, "vat_percentage": "21%",
+                          "vat_category": "1a" if transaction_type == "sale" else "5b"}],
+        "subtotal": net, "vat_amount": vat, "total_amount": net + vat if isinstance(net, float) else "121.00",
+        "source_file": f"{invoice_no}.pdf", **fields
+    }
+
+
+INVOICES = [
+    invoice("INV-1", "2024-01-15", 100.0, 21.0),
+    invoice("INV-2", "15-02-2024", 1234.56, 259.26, "purchase"),
+    # Amounts as strings, integers, negative (credit note), -0.0 and more than 2 decimals
+    invoice("INV-3", "2024-02-29", "100.00", "21.00"),
+    invoice("INV-4", "2024-03-01", -50.5, -10.61, vat_percentage="21"),
+    invoice("INV-5", "2024-04-30", 0.125, -0.0),
+    invoice("INV-6", "2024-05-01", 7, 1, client_no=None, notes={"unknown": ["keys", 1, 2.5]}),
+    invoice("Fäctuur 日本", "not a date", 10.0, 2.1, extra_field=True),
+]
+
+
+def stored_form(invoices):
+    """Invoices as a store returns them: with the period keys added at ingest"""
+    invoices = copy.deepcopy(invoices)
+    for entry in invoices:
+        ensure_period_keys(entry)
+    return invoices
+
+
+def exact(invoices):
+    """Comparable form that also tells apart key order, 1 / 1.0 / "1" and 0.0 / -0.0"""
+    return json.dumps(invoices)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / "vat_data.db"))
+
+
+def add(store, invoices, year="2024"):
+    store.add_invoices(USER, [(year, entry) for entry in copy.deepcopy(invoices)])
+
+
+def test_records_round_trip():
+    for entry in stored_form(INVOICES):
+        assert exact(InvoiceRecord.from_dict(entry).to_dict()) == exact(entry)
+
+
+def test_invoices_round_trip(store):
+    add(store, INVOICES)
+    expected = stored_form(INVOICES)
+    assert exact(store.get_invoices(USER, "2024")) == exact(expected)
+    assert exact(list(store.iter_invoices(USER, "2024", batch_size=2))) == exact(expected)
+    assert exact(store.get_user_invoices(USER)) == exact({"2024": expected})
+    assert store.count_invoices(USER, "2024") == len(INVOICES)
+
+    february = [entry for entry in expected if entry["period_month"] == 2]
+    assert len(february) == 2
+    assert exact(store.get_invoices(USER, "2024", months=[2])) == exact(february)
+    assert exact(list(store.iter_invoices(USER, "2024", months=[2], batch_size=1))) == exact(february)
+    assert store.has_invoice(USER, "2024", invoice_no="INV-2")
+    assert not store.has_invoice(USER, "2023", invoice_no="INV-2")
+    assert check_totals(store, USER, "2024") == []
+
+
+def test_backends_agree(tmp_path):
+    memory, sqlite = MemoryStore(), SQLiteStore(str(tmp_path / "vat_data.db"))
+    for backend in (memory, sqlite):
+        add(backend, INVOICES[:4])
+        add(backend, INVOICES[4:])
+    assert exact(memory.get_invoices(USER, "2024")) == exact(sqlite.get_invoices(USER, "2024"))
+    assert sorted(memory.get_category_totals(USER, "2024")) == sorted(sqlite.get_category_totals(USER, "2024"))
+    assert sorted(memory.get_invoice_totals(USER, "2024")) == sorted(sqlite.get_invoice_totals(USER, "2024"))
+
+
+def read_all(reader):
+    """Everything a report reads, from a store or a snapshot"""
+    return (
+        exact(reader.get_invoices(USER, "2024")),
+        exact(list(reader.iter_invoices(USER, "2024", batch_size=2))),
+        reader.count_invoices(USER, "2024"),
+        sorted(reader.get_category_totals(USER, "2024")),
+        sorted(reader.get_invoice_totals(USER, "2024")),
+        reader.get_data_version(USER),
+        reader.get_company_details(USER)
+    )
+
+
+def test_snapshot_does_not_see_later_writes(store):
+    store.set_company_details(USER, "Example B.V.", "NL001")
+    add(store, INVOICES[:3])
+    before = read_all(store)
+
+    with store.snapshot(USER) as snapshot:
+        assert read_all(snapshot) == before
+        add(store, INVOICES[3:])
+        store.set_company_details(USER, "Renamed B.V.", "NL002")
+        assert read_all(snapshot) == before
+
+        after = read_all(store)
+        assert after != before and after[2] == len(INVOICES) and after[5] > before[5]
+        with store.snapshot(USER) as current:
+            assert read_all(current) == after
+
+        store.clear_user(USER)
+        assert read_all(snapshot) == before
+    assert store.get_invoices(USER, "2024") == [] and store.get_company_details(USER) is None
+
+
+def test_snapshot_before_first_write(store):
+    with store.snapshot(USER) as snapshot:
+        add(store, INVOICES[:1])
+        assert snapshot.get_invoices(USER, "2024") == []
+        assert snapshot.get_category_totals(USER, "2024") == []
+        assert snapshot.get_data_version(USER) == 0
+    assert store.count_invoices(USER, "2024") == 1
@@ -0,0 +1,95 @@
+"""
+Streamed reports (stream=true): the same body and ETag as the buffered report,
+503 when the worker pool is full, and the store snapshot always closed.
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import os
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("VAT_STORAGE_BACKEND", "memory")
+
+from fastapi.testclient import TestClient
+
+import app as vat_app
+from worker_pool import WorkerPool
+
+client = TestClient(vat_app.app)
+HEADERS = {"X-User-ID": "test_streamed_reports"}
+
+INVOICES = [
+    {"date": f"2024-{month:02d}-10", "type": "Sales" if month % 2 else "Purchase", "net_amount": 100 * month,
+     "vat_amount": 21 * month, "vat_percentage": "21", "description": f"Item {month}",
+     "file_name": f"test_streamed_{month}.pdf", "VAT Category (NL) Code": "1a" if month % 2 else "5b"}
+    for month in range(1, 13)
+]
+
+REPORTS = ["/vat-report-quarterly?year=2024&quarter=Q2", "/vat-report-yearly?year=2024"]
+
+
+def setup_module():
+    response = client.post("/process-invoices", json=INVOICES, headers=HEADERS)
+    assert response.json()["details"]["processed"] == len(INVOICES)
+
+
+def teardown_module():
+    client.delete("/clear-user-data", headers=HEADERS)
+
+
+def without_generated_at(body):
+    return re.sub(rb'"generated_at":"[^"]*"', b"", body)
+
+
+@pytest.fixture
+def snapshots(monkeypatch):
+    """[opened, closed] counts of the store snapshots taken during a test"""
+    counts = [0, 0]
+    take_snapshot = vat_app.store.snapshot
+
+    def snapshot(user_id):
+        reader = take_snapshot(user_id)
+        close = reader.close
+        counts[0] += 1
+
+        def counted_close():
+            counts[1] += 1
+            close()
+        reader.close = counted_close
+        return reader
+
+    monkeypatch.setattr(vat_app.store, "snapshot", snapshot)
+    return counts
+
+
+@pytest.mark.parametrize("url", REPORTS)
+def test_streamed_report_matches_buffered(url, snapshots):
+    buffered = client.get(url, headers=HEADERS)
+    streamed = client.get(url + "&stream=true", headers=HEADERS)
+    assert streamed.status_code == 200
+    # Byte-identical but for the build time
+    assert without_generated_at(streamed.content) == without_generated_at(buffered.content)
+    assert streamed.headers["ETag"] == buffered.headers["ETag"]
+    assert any(category["transactions"] for category in streamed.json()["categories"].values())
+
+    not_modified = client.get(url + "&stream=true", headers=dict(HEADERS, **{"If-None-Match": streamed.headers["ETag"]}))
+    assert not_modified.status_code == 304
+    assert snapshots[0] == snapshots[1]
+
+
+@pytest.mark.parametrize("url", REPORTS)
+def test_full_worker_pool_is_a_503(url, snapshots, monkeypatch):
+    full_pool = WorkerPool(workers=1, max_queue=0)
+    full_pool._pending = 1  # the only thread is busy
+    monkeypatch.setattr(vat_app, "worker_pool", full_pool)
+    response = client.get(url + "&stream=true", headers=HEADERS)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert full_pool.rejected == 1
+    assert snapshots == [1, 1]
@@ -0,0 +1,243 @@
+"""
+Table-driven VAT category classification.
+
+Uploads without a Dutch VAT code are classified from their VAT category
+string, transaction type, VAT rate and country. The rules are decision tables:
+ordered rules, the first matching rule gives the code. A rule matches when
+- each of its term groups has a term in the (lowercase) category string
+- none of its excluded terms is in it
+- the transaction type, rate and country class are among the listed ones
+  (a rule without them matches any)
+
+Inputs are reduced to a key for the table: (lowercase category, lowercase type,
+rate class 21/9/0/"other", country class "NL"/"EU"/"OTHER"/""). Uploads repeat
+a few combinations of inputs over and over, so codes are memoized per distinct
+input in a bounded LRU cache (VAT_CLASSIFIER_CACHE entries per table, default:
+4096), and classify_many() classifies each distinct input of a batch once
+(InvoiceBatch.flush in app.py classifies its uploads' items this way).
+
+Two tables: SIMPLE_RULES for /process-invoices items (map_vat_category_simple
+in app.py) and REGISTER_RULES for register entries (map_vat_category_to_code in
+processor.py). They differ (e.g. "Zero Rated" EU sales are 3b / 3a, reverse
+charge wins over every category only for register entries), so each keeps its
+own rules.
+"""
+
+import functools
+import itertools
+
+from env_settings import env_setting
+
+# Jurisdiction Constants
+DOMESTIC_COUNTRY = "NL"
+
+# List of EU Countries (excluding NL)
+EU_COUNTRIES = [
+    "AT", "BE", "BG", "HR", "CY", "CZ", "DK", "EE", "FI", "FR", "DE", "GR",
+    "HU", "IE", "IT", "LV", "LT", "LU", "MT", "PL", "PT", "RO", "SK", "SI",
+    "ES", "SE"
+]
+# Note: GB (United Kingdom) is NON-EU.
+
+SALE = frozenset({"sale", "sales"})
+PURCHASE = frozenset({"purchase"})
+PURCHASES = frozenset({"purchase", "purchases"})
+# Countries outside the EU list: NL too, where no rule for NL comes first
+NON_EU = frozenset({"NL", "OTHER"})
+
+
+def rule(code, *terms, exclude=(), types=None, rate=None, countries=None):
+    """
+    One table row: terms are strings or tuples of alternatives (all groups must
+    match), rate one rate class, countries a set of country classes
+    """
+    groups = tuple((term,) if isinstance(term, str) else tuple(term) for term in terms)
+    return groups, tuple(exclude), types, rate, frozenset(countries) if countries else None, code
+
+
+STANDARD = ("standard vat", "standard rate")
+ZERO_RATED = ("zero rated", "zero-rated")
+REVERSE_CHARGE = ("reverse charge", "reverse-charge")
+
+SIMPLE_RULES = (
+    # Standard / reduced rates (check the percentage)
+    rule("1a", STANDARD, types=SALE, rate=21),
+    rule("1b", STANDARD, types=SALE, rate=9),
+    rule("1a", STANDARD, types=SALE),
+    rule("5b", STANDARD, types=PURCHASE),
+    rule("1b", "reduced", types=SALE),
+    rule("5b", "reduced", types=PURCHASE),
+    # Zero rated (0% by country)
+    rule("1e", ZERO_RATED, types=SALE, rate=0, countries={"NL"}),
+    rule("3b", ZERO_RATED, types=SALE, rate=0, countries={"EU"}),
+    rule("3a", ZERO_RATED, types=SALE, rate=0, countries={"OTHER"}),
+    rule("1c", ZERO_RATED, types=SALE),
+    rule("4b", ZERO_RATED, types=PURCHASE, rate=0, countries={"EU"}),
+    rule("4a", ZERO_RATED, types=PURCHASE),
+    # EU
+    rule("3a", "eu goods", types=SALE),
+    rule("4a", "eu goods", types=PURCHASE),
+    rule("3b", "eu services", types=SALE),
+    rule("4b", "eu services", types=PURCHASE),
+    rule("3a", "eu", exclude=("goods", "services"), types=SALE),
+    rule("4a", "eu", exclude=("goods", "services"), types=PURCHASE),
+    # Others
+    rule("2a", REVERSE_CHARGE, types=PURCHASE),
+    rule("4c", "import", types=PURCHASE),
+    # Category not recognized: type, rate and country
+    rule("1a", types=SALE, rate=21),
+    rule("1b", types=SALE, rate=9),
+    rule("1e", types=SALE, rate=0, countries={"NL"}),
+    rule("3b", types=SALE, rate=0, countries={"EU"}),
+    rule("3a", types=SALE, rate=0, countries={"OTHER"}),
+    rule("1c", types=SALE, rate=0),
+    rule("1a", types=SALE),
+    rule("4b", types=PURCHASE, rate=0, countries={"EU"}),
+    rule("4a", types=PURCHASE, rate=0, countries=NON_EU),
+    rule("2a", types=PURCHASE, rate=0),
+    rule("5b", types=PURCHASE),
+    rule("5b")
+)
+
+EU_SUPPLY = ("eu", "intra-community")
+
+REGISTER_RULES = (
+    rule("2a", REVERSE_CHARGE),
+    # Zero rated
+    rule("3a", ZERO_RATED, ("eu", "intra"), types=SALE),
+    rule("1c", ZERO_RATED, types=SALE),
+    rule("4a", ZERO_RATED, types=PURCHASES),
+    rule("1c", ZERO_RATED),
+    # Standard rate
+    rule("1a", "standard rate", types=SALE, rate=21),
+    rule("1b", "standard rate", types=SALE, rate=9),
+    rule("1a", "standard rate", types=SALE),
+    rule("5b", "standard rate", types=PURCHASES),
+    rule("1a", "standard rate"),
+    # EU supplies
+    rule("3a", EU_SUPPLY, "goods", types=SALE),
+    rule("3b", EU_SUPPLY, "services", types=SALE),
+    rule("3a", EU_SUPPLY, types=SALE),
+    rule("4a", EU_SUPPLY, "goods", types=PURCHASES),
+    rule("4b", EU_SUPPLY, "services", types=PURCHASES),
+    rule("4a", EU_SUPPLY, types=PURCHASES),
+    # Import / export
+    rule("4c", "import"),
+    rule("1c", "export"),
+    # Type and rate
+    rule("1a", types=SALE, rate=21),
+    rule("1b", types=SALE, rate=9),
+    rule("1c", types=SALE, rate=0),
+    rule("1a", types=SALE),
+    rule("2a", types=PURCHASES, rate=0),
+    rule("5b", types=PURCHASES),
+    rule("1c", rate=0),
+    rule("1b", rate=9),
+    rule("1a")
+)
+
+
+def rate_class(percentage):
+    """21, 9, 0 or "other" """
+    if percentage == 21:
+        return 21
+    if percentage == 9:
+        return 9
+    if percentage == 0:
+        return 0
+    return "other"
+
+
+def country_class(country_upper):
+    """ "NL", "EU", "OTHER" (any other country) or "" (none) """
+    if country_upper == DOMESTIC_COUNTRY:
+        return "NL"
+    if country_upper in EU_COUNTRIES:
+        return "EU"
+    return "OTHER" if country_upper else ""
+
+
+def simple_key(vat_category_str, transaction_type, vat_percentage, country=""):
+    """Key of a /process-invoices item (percentage given as 21, "21" or "21%")"""
+    category = str(vat_category_str).strip() if vat_category_str else ""
+    country_upper = str(country).strip().upper() if country else ""
+    try:
+        percentage = float(str(vat_percentage).replace("%", "").strip())
+    except (ValueError, TypeError):
+        percentage = 0.0
+    return category.lower(), str(transaction_type).strip().lower(), rate_class(percentage), country_class(country_upper)
+
+
+def register_key(vat_category_str, transaction_type, vat_percentage=0):
+    """Key of a register entry (the percentage is compared as given: "21" is no 21)"""
+    return str(vat_category_str).strip().lower(), str(transaction_type).strip().lower(), rate_class(vat_percentage), ""
+
+
+# Argument types that never compare equal to a value of another type
+PLAIN_TYPES = frozenset({str, type(None)})
+
+
+class VatClassifier:
+    """Decision table with a key function and a bounded LRU cache of codes per distinct input"""
+
+    def __init__(self, rules, key, max_size=4096):
+        self.rules = rules
+        self.key = key
+        # Cached per input as given (typed: 1, 1.0 and True are different inputs)
+        self._cached = functools.lru_cache(maxsize=max_size, typed=True)(self._classify)
+
+    def match(self, key):
+        """Code of the first rule matching a key"""
+        category, tx_type, rate, country = key
+        for groups, exclude, types, rule_rate, countries, code in self.rules:
+            if types is not None and tx_type not in types:
+                continue
+            if rule_rate is not None and rate != rule_rate:
+                continue
+            if countries is not None and country not in countries:
+                continue
+            if not all(any(term in category for term in group) for group in groups):
+                continue
+            if any(term in category for term in exclude):
+                continue
+            return code
+        raise ValueError(f"No rule matches {key!r}")
+
+    def _classify(self, *args):
+        return self.match(self.key(*args))
+
+    def classify(self, *args):
+        """Code for one input (the arguments of the key function)"""
+        try:
+            return self._cached(*args)
+        except TypeError:
+            # Unhashable input (e.g. a list from JSON): not cached
+            return self._classify(*args)
+
+    def classify_many(self, inputs):
+        """
+        Codes for a list of argument tuples. Each distinct input is classified once,
+        also when a batch has more distinct inputs than the cache holds.
+        """
+        try:
+            if set(map(type, itertools.chain.from_iterable(inputs))) <= PLAIN_TYPES:
+                # Strings and None: inputs that compare equal are the same input
+                codes = {args: self.classify(*args) for args in dict.fromkeys(inputs)}
+                return [codes[args] for args in inputs]
+            # Numbers: distinct like the cache, typed (1, 1.0 and True differ)
+            keys = [(args, tuple(map(type, args))) for args in inputs]
+            codes = {key: self.classify(*key[0]) for key in dict.fromkeys(keys)}
+            return [codes[key] for key in keys]
+        except TypeError:
+            return [self.classify(*args) for args in inputs]
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+
+def cache_size():
+    return env_setting("VAT_CLASSIFIER_CACHE", 4096, 0)
+
+
+simple_classifier = VatClassifier(SIMPLE_RULES, simple_key, cache_size())
+register_classifier = VatClassifier(REGISTER_RULES, register_key, cache_size())
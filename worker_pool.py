@@ -0,0 +1,89 @@
+"""
+Bounded worker pool for CPU-heavy request work (building reports, normalizing uploads).
+
+The handlers are async, but aggregating a year of invoices is plain Python: run
+on the event loop it would stall every other request (even /health) until it's
+done. WorkerPool.run() hands such work to a fixed number of threads instead, so
+the event loop keeps serving small requests while reports are built.
+
+Threads rather than processes: reports read store snapshots (and MemoryStore
+lives in this process), and the GIL is released every few milliseconds, which
+is all the event loop needs to stay responsive.
+
+At most max_queue calls wait for a free thread; further calls are rejected right
+away with WorkerPoolFull (the API answers 503 with Retry-After) instead of piling
+up. Configure with VAT_WORKER_THREADS (default: 4; 0 runs the work on the event
+loop like before) and VAT_WORKER_QUEUE (default: 64).
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from env_settings import env_setting
+
+
+class WorkerPoolFull(Exception):
+    """Raised by WorkerPool.run() when all threads are busy and the queue is full"""
+
+
+class WorkerPool:
+    """Fixed-size thread pool with a bounded queue and counters"""
+
+    def __init__(self, workers=4, max_queue=64):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vat-worker") if workers else None
+        self._lock = threading.Lock()
+        # Submitted calls that haven't finished yet (running + queued)
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on a worker thread and return its result"""
+        if self._executor is None:
+            result = func(*args, **kwargs)
+            self.completed += 1
+            return result
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise WorkerPoolFull(f"{self._pending} calls running or queued")
+            self._pending += 1
+        try:
+            future = self._executor.submit(functools.partial(func, *args, **kwargs))
+        except BaseException:
+            self._release(None)
+            raise
+        # Released when the call finishes, even if the request was cancelled meanwhile
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future is not None:
+                self.completed += 1
+
+    def stats(self):
+        """Pool size, running/queued calls and counters"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": min(self._pending, self.workers),
+                "queued": max(self._pending - self.workers, 0),
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_worker_pool():
+    """Create the worker pool sized by VAT_WORKER_THREADS / VAT_WORKER_QUEUE"""
+    return WorkerPool(workers=env_setting("VAT_WORKER_THREADS", 4, 0), max_queue=env_setting("VAT_WORKER_QUEUE", 64, 0))